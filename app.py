@@ -12,7 +12,7 @@ def send_gotify(message: str, title: str = None, priority: int = 10):
     """
     try:
         gotify_cfg = CFG.get("gotify", {})
-        url = gotify_cfg.get("url", "").rstrip("/") + "/message"
+        url = CFG.gotify_url
         token = gotify_cfg.get("token", "")
         if not url or not token:
             print("[Gotify] URL or token not configured")
@@ -23,31 +23,49 @@ def send_gotify(message: str, title: str = None, priority: int = 10):
             "priority": priority
         }
         headers = {"X-Gotify-Key": token, "Content-Type": "application/json"}
-        r = requests.post(url, json=payload, headers=headers, timeout=5)
-        if r.status_code == 200:
+        attempt = DeliveryAttempt("gotify", url)
+        server = CFG.gotify_server
+        if not HEALTH.allow("gotify", server, _endpoint_addr(server)):
+            print(f"[Gotify] Skipped: circuit open for {server}")
+            attempt.finish(False, "circuit open")
+            return False
+        started = time.perf_counter()
+        try:
+            r = OUTBOUND.run(OUTBOUND.http.request("POST", url, json.dumps(payload).encode(), headers,
+                                                   timeout=HEALTH.timeout("gotify", server, 5)))
+        except Exception as e:
+            HEALTH.record("gotify", server, False, error=str(e) or type(e).__name__)
+            attempt.finish(False, str(e) or type(e).__name__)
+            raise
+        HEALTH.record("gotify", server, True, time.perf_counter() - started)
+        attempt.first_byte(r.first_byte_at)
+        if r.status == 200:
             print("[Gotify] Sent successfully")
-            return True
-        print(f"[Gotify] Failed: HTTP {r.status_code} – {r.text}")
+            return attempt.finish(True)
+        print(f"[Gotify] Failed: HTTP {r.status} – {r.body.decode('utf-8', errors='replace')}")
+        attempt.finish(False, f"HTTP {r.status}")
     except Exception as e:
         print(f"[Gotify] Exception: {e}")
     return False
 def update_rss_token(a: str):
     """Increment RSS token for alert and update timestamp"""
-    FEED_STATE[a] = (FEED_STATE.get(a, 0) + 1) % 10000
-    print(f"[RSS] Updated {a} → {FEED_STATE[a]}")
+    token = STORE.bump_rss(a)
+    print(f"[RSS] Updated {a} → {token}")
 # ---------------- Common outbound notifications ----------------
-def send_resolution_notice(resolved_by: str = ""):
+def send_resolution_notice(resolved_by: str = "", alert_id=None):
     """Broadcast an 'All Clear / Resolution' notice on the same channels as an alert."""
     who = resolved_by or "System"
     msg = f"RESOLUTION: The emergency has ended. (Resolved by {who})"
+    handle = DispatchHandle("RESOLUTION", priority="RESOLUTION")
+    handle.alert_id = alert_id
     # Email (uses existing template, but with a clearer subject/details)
     try:
-        _fire_and_forget(send_email, "RESOLUTION", "RESOLUTION", "Resolution – the emergency has ended.")
+        DISPATCH.submit(handle, "email", send_email, "RESOLUTION", "RESOLUTION", "Resolution – the emergency has ended.")
     except Exception as e:
         print(f"[Resolution] Email error: {e}")
     # Gotify
     try:
-        _fire_and_forget(send_gotify, msg, f"{_service_name()} – Resolution", 8)
+        DISPATCH.submit(handle, "gotify", send_gotify, msg, f"{_service_name()} – Resolution", 8)
     except Exception as e:
         print(f"[Resolution] Gotify error: {e}")
     # Web banner
@@ -57,21 +75,19 @@ def send_resolution_notice(resolved_by: str = ""):
         print(f"[Resolution] web banner error: {e}")
     # Displays (show briefly, then return to IDLE)
     try:
-        for did in list(DISPLAY_STATE.keys()) or ["display-1"]:
-            DISPLAY_STATE[did] = {"mode": "MESSAGE", "text": "ALL CLEAR"}
+        all_clear = {"mode": "MESSAGE", "text": "ALL CLEAR"}
+        STORE.set_displays({did: all_clear for did in list(STORE.displays) or ["display-1"]})
         def _return_idle():
-            time.sleep(10)
-            for did in list(DISPLAY_STATE.keys()):
-                if DISPLAY_STATE.get(did, {}).get('mode') == 'MESSAGE' and DISPLAY_STATE.get(did, {}).get('text') == 'ALL CLEAR':
-                    DISPLAY_STATE[did] = {"mode": "IDLE", "text": ""}
-        _fire_and_forget(_return_idle)
+            STORE.set_displays({did: IDLE_DISPLAY for did in STORE.displays}, expect=all_clear)
+        _after(10, _return_idle)
     except Exception as e:
         print(f"[Resolution] display update error: {e}")
     # ClockWise (optional) – many sites want an explicit end trigger
     try:
-        _fire_and_forget(clockwise_udp_trigger, "RESOLUTION", "ALL")
+        DISPATCH.submit(handle, "clockwise", clockwise_udp_trigger, "RESOLUTION", "ALL")
     except Exception as e:
         print(f"[Resolution] ClockWise error: {e}")
+    return handle
 
 
 def send_announcement(message: str, sent_by: str = ""):
@@ -83,14 +99,16 @@ def send_announcement(message: str, sent_by: str = ""):
     if not message:
         return
     who = (sent_by or "System").strip()
+    # lowest priority: queued behind any alert or resolution traffic
+    handle = DispatchHandle("ANNOUNCEMENT", priority="ANNOUNCEMENT")
 
     try:
-        _fire_and_forget(send_email, "ANNOUNCEMENT", "ANNOUNCEMENT", f"{message}\n\nSent by {who}.")
+        DISPATCH.submit(handle, "email", send_email, "ANNOUNCEMENT", "ANNOUNCEMENT", f"{message}\n\nSent by {who}.")
     except Exception as e:
         print(f"[Announcement] Email error: {e}")
 
     try:
-        _fire_and_forget(send_gotify, f"Announcement: {message} (by {who})", f"{_service_name()} – Announcement", 5)
+        DISPATCH.submit(handle, "gotify", send_gotify, f"Announcement: {message} (by {who})", f"{_service_name()} – Announcement", 5)
     except Exception as e:
         print(f"[Announcement] Gotify error: {e}")
 
@@ -100,8 +118,8 @@ def send_announcement(message: str, sent_by: str = ""):
         print(f"[Announcement] web banner error: {e}")
 
     try:
-        for did in list(DISPLAY_STATE.keys()) or ["display-1"]:
-            DISPLAY_STATE[did] = {"mode": "MESSAGE", "text": message[:64]}
+        state = {"mode": "MESSAGE", "text": message[:64]}
+        STORE.set_displays({did: state for did in list(STORE.displays) or ["display-1"]})
     except Exception as e:
         print(f"[Announcement] display error: {e}")
 
@@ -128,52 +146,411 @@ def clockwise_udp_trigger(trigger_name: str, zone: str = "ALL"):
         print("[ClockWise] Disabled in config")
         return
     mode = (cfg.get("mode") or "udp").lower().strip()
-    action_map = cfg.get("triggers", {})
-    base_payload = action_map.get(trigger_name.upper(), trigger_name.upper())
-    zone_suffix_map = cfg.get("zone_suffix", {})
-    suffix = zone_suffix_map.get(zone.upper(), "")
-    payload = f"{base_payload}{suffix}"
+    payload = ZONES.route(zone).clockwise_payloads.get(trigger_name.upper())
+    if payload is None:
+        payload = (cfg.get("triggers", {}) or {}).get(trigger_name.upper(), trigger_name.upper())
     if mode == "http":
         http_url = cfg.get("http_url")
         if not http_url:
             print("[ClockWise-HTTP] http_url not configured")
             return
+        attempt = None
         try:
             # simple template replacement
             url = http_url.replace("{payload}", payload).replace("{zone}", zone)
-            import urllib.request
-            req = urllib.request.Request(url, method="GET")
-            with urllib.request.urlopen(req, timeout=3) as resp:
-                _ = resp.read()
+            attempt = DeliveryAttempt("clockwise", url)
+            server = "{0.scheme}://{0.netloc}".format(urllib.parse.urlsplit(url))
+            if not HEALTH.allow("clockwise", server, _endpoint_addr(server)):
+                raise ConnectionError(f"circuit open for {server}")
+            started = time.perf_counter()
+            try:
+                r = OUTBOUND.run(OUTBOUND.http.request("GET", url, timeout=HEALTH.timeout("clockwise", server, 3)))
+            except Exception as e:
+                HEALTH.record("clockwise", server, False, error=str(e) or type(e).__name__)
+                raise
+            HEALTH.record("clockwise", server, True, time.perf_counter() - started)
+            attempt.first_byte(r.first_byte_at)
+            if r.status >= 400:
+                raise ConnectionError(f"HTTP {r.status}")
             print(f"[ClockWise-HTTP] GET {url}")
+            return attempt.finish(True)
         except Exception as e:
             print(f"[ClockWise-HTTP] Failed: {e}")
-        return
+            if attempt is not None:
+                attempt.finish(False, str(e) or type(e).__name__)
+        return False
     # default: UDP mode
     udp_ip = cfg.get("ip", "172.16.50.191")
     udp_port = int(cfg.get("port", 8090))
+    attempt = DeliveryAttempt("clockwise", f"udp://{udp_ip}:{udp_port}/{payload}")
     try:
         msg = payload.encode("ascii", errors="ignore")
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(msg, (udp_ip, udp_port))
-        sock.close()
+        OUTBOUND.run(udp_send(udp_ip, udp_port, msg), timeout=3)
         print(f"[ClockWise-UDP] Sent '{payload}' for '{trigger_name}' zone '{zone}' to {udp_ip}:{udp_port}")
+        return attempt.finish(True)
     except Exception as e:
         print(f"[ClockWise-UDP] Failed: {e}")
-# in-memory display state for LED panels
-DISPLAY_STATE = {}
-# last seen timestamp per display id
-DISPLAY_LAST_SEEN = {}
-# last alert for Chrome extension / API
-LAST_ALERT = {"id": None, "mode": "IDLE", "action": None, "text": "", "details": "", "severity": "", "timestamp": 0, "zone": "ALL"}
-# acknowledgment log (in-memory)
-ACK_LOG = []
+        return attempt.finish(False, str(e))
+# ---------------- State store ----------------
+from collections import deque
+# last alert for Chrome extension / API when nothing is active
+IDLE_ALERT = {"id": None, "mode": "IDLE", "action": None, "text": "", "details": "", "severity": "", "timestamp": 0, "zone": "ALL",
+              "initiators": []}
+IDLE_DISPLAY = {"mode": "IDLE", "text": ""}
+class StateStore:
+    """Versioned in-memory state: current alert, LED panel states and RSS tokens.
+
+    Writers build a new value and swap it in under one lock (copy-on-write),
+    so readers grab the current snapshot without locking and never see a
+    half-written alert. Snapshots are shared; treat them as read-only.
+
+    Every change bumps one global version and records the version of its
+    (topic, key), which drives /api/stream, the ?since= long-poll and ETags.
+    Subscriber callbacks run after the lock is released.
+    """
+    HISTORY = 1024
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._subscribers = []
+        self._events = deque(maxlen=self.HISTORY)
+        self._key_versions = {}
+        self.version = 0
+        self.alert = dict(IDLE_ALERT)
+        self.displays = {}
+        self.rss_tokens = {}
+        # when each token last changed; feeds key their cache on (token, ts)
+        self.rss_changed = {}
+    def subscribe(self, callback, remote: bool = False):
+        """Call callback(topic, key, data, version) after every local change.
+
+        With remote=True it is also called for changes applied from other
+        workers through the shared state backend.
+        """
+        if all(cb is not callback for cb, _ in self._subscribers):
+            self._subscribers.append((callback, remote))
+    def _commit(self, changes) -> list:
+        # caller holds self._cond
+        out = []
+        for topic, key, data in changes:
+            self.version += 1
+            self._events.append((self.version, topic, key, data))
+            self._key_versions[(topic, key)] = self.version
+            out.append((topic, key, data, self.version))
+        self._cond.notify_all()
+        return out
+    def _notify(self, committed, remote: bool = False):
+        for topic, key, data, version in committed:
+            for callback, wants_remote in list(self._subscribers):
+                if remote and not wants_remote:
+                    continue
+                try:
+                    callback(topic, key, data, version)
+                except Exception as e:
+                    print(f"[State] Subscriber failed on {topic}: {e}")
+    def set_alert(self, alert: dict) -> dict:
+        """Publish a whole new alert state in one step; missing fields take IDLE defaults."""
+        alert = dict(IDLE_ALERT, **alert)
+        with self._cond:
+            self.alert = alert
+            committed = self._commit([("alert", None, alert)])
+        self._notify(committed)
+        return alert
+    def update_alert(self, **fields) -> dict:
+        with self._cond:
+            alert = dict(self.alert, **fields)
+            self.alert = alert
+            committed = self._commit([("alert", None, alert)])
+        self._notify(committed)
+        return alert
+    def set_displays(self, states: dict, expect: dict = None):
+        """Swap in several panel states at once.
+
+        With expect, a panel only changes if its current state still equals
+        expect (e.g. return to IDLE only if nobody replaced the ALL CLEAR).
+        """
+        with self._cond:
+            displays = dict(self.displays)
+            changes = []
+            for did, state in states.items():
+                if expect is not None and displays.get(did) != expect:
+                    continue
+                displays[did] = state
+                changes.append(("display", did, dict(state, id=did)))
+            if not changes:
+                return
+            self.displays = displays
+            committed = self._commit(changes)
+        self._notify(committed)
+    def bump_rss(self, action: str) -> int:
+        with self._cond:
+            tokens = dict(self.rss_tokens)
+            tokens[action] = (tokens.get(action, 0) + 1) % 10000
+            changed = dict(self.rss_changed)
+            changed[action] = int(time.time())
+            self.rss_tokens, self.rss_changed = tokens, changed
+            committed = self._commit([("rss", action, {"action": action, "token": tokens[action], "ts": changed[action]})])
+        self._notify(committed)
+        return tokens[action]
+    def publish_event(self, topic: str, data: dict):
+        """Versioned event that keeps no state (e.g. web banners, ack counters)."""
+        with self._cond:
+            committed = self._commit([(topic, None, data)])
+        self._notify(committed)
+    def apply_remote(self, topic: str, key, data: dict):
+        """Apply a change made by another worker (see StateBackend)."""
+        with self._cond:
+            if topic == "alert":
+                data = dict(IDLE_ALERT, **data)
+                self.alert = data
+            elif topic == "display":
+                displays = dict(self.displays)
+                displays[key] = {k: v for k, v in data.items() if k != "id"}
+                self.displays = displays
+            elif topic == "rss":
+                tokens = dict(self.rss_tokens)
+                tokens[key] = int(data.get("token", 0))
+                changed = dict(self.rss_changed)
+                changed[key] = int(data.get("ts") or time.time())
+                self.rss_tokens, self.rss_changed = tokens, changed
+            committed = self._commit([(topic, key, data)])
+        self._notify(committed, remote=True)
+    def restore(self, alert: dict = None, displays: dict = None, rss_tokens: dict = None, rss_changed: dict = None):
+        """Load state recovered at startup without publishing it as new changes."""
+        with self._cond:
+            if alert:
+                self.alert = dict(IDLE_ALERT, **alert)
+            if displays:
+                self.displays = dict(displays)
+            if rss_tokens:
+                self.rss_tokens = dict(rss_tokens)
+            if rss_changed:
+                self.rss_changed = dict(rss_changed)
+    def key_version(self, topic: str, key=None) -> int:
+        return self._key_versions.get((topic, key), 0)
+    def snapshot(self, topic: str, key=None):
+        """(version, value) of one key, read together so a body is never paired with a newer version.
+
+        value is the alert for "alert", the panel state (or None) for
+        "display" and None for stateless topics such as "acks".
+        """
+        with self._cond:
+            if topic == "alert":
+                value = self.alert
+            elif topic == "display":
+                value = self.displays.get(key)
+            else:
+                value = None
+            return self._key_versions.get((topic, key), 0), value
+    def events_since(self, since: int):
+        """Events newer than since, or None if they already fell out of the history."""
+        with self._cond:
+            # since from another worker (or before a restart) can be ahead of us
+            if since > self.version or (self._events and since < self._events[0][0] - 1):
+                return None
+            return [e for e in self._events if e[0] > since]
+    def wait(self, since: int, timeout: float) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self.version > since, timeout)
+    def wait_key(self, topic: str, key, since: int, timeout: float) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self._key_versions.get((topic, key), 0) > since, timeout)
+STORE = StateStore()
+def set_display(display_id: str, mode: str, text: str = ""):
+    """Set one panel's state and publish the change to stream / long-poll clients."""
+    STORE.set_displays({display_id: {"mode": mode, "text": text}})
 ROOT = os.path.dirname(os.path.abspath(__file__))
 CONFIG_PATH = os.path.join(ROOT, "config.yaml")
 DB_PATH = os.path.join(ROOT, "gschool_ems.db")
 # ---- Load config ----
-with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-    CFG = yaml.safe_load(f)
+import atexit, copy
+from collections.abc import Mapping
+from types import MappingProxyType
+from email.utils import formataddr
+class ConfigError(ValueError):
+    """config.yaml content that cannot be used (wrong type, bad number, ...)."""
+# top-level sections; each must be a mapping when present
+CONFIG_SECTIONS = ("app", "branding", "email", "asterisk", "cisco", "clockwise", "gotify", "ui", "zones",
+                   "dispatch", "health", "acks", "drills", "database", "state", "fleet", "websub")
+# (section, key) that must be whole numbers / lists of strings
+CONFIG_INTS = (("asterisk", "ami_port"), ("clockwise", "port"), ("email", "smtp_port"))
+CONFIG_LISTS = (("branding", "fixed_recipients"), ("cisco", "phones"), ("websub", "callback_hosts"))
+def validate_config(data) -> dict:
+    """Check and normalise parsed YAML into a new dict; raises ConfigError if it is unusable."""
+    if not isinstance(data, dict):
+        raise ConfigError("config must be a mapping")
+    data = copy.deepcopy(data)
+    for section in CONFIG_SECTIONS:
+        if data.get(section) is not None and not isinstance(data[section], dict):
+            raise ConfigError(f"{section} must be a mapping")
+    if not (data.get("app") or {}).get("secret_key"):
+        raise ConfigError("app.secret_key is required")
+    for section, key in CONFIG_INTS:
+        sec = data.get(section) or {}
+        if sec.get(key) not in (None, ""):
+            try:
+                sec[key] = int(sec[key])
+            except (TypeError, ValueError):
+                raise ConfigError(f"{section}.{key} must be a number, got {sec[key]!r}")
+    for section, key in CONFIG_LISTS:
+        sec = data.get(section) or {}
+        value = sec.get(key)
+        if isinstance(value, str):
+            sec[key] = [value]
+        elif value is not None and not isinstance(value, list):
+            raise ConfigError(f"{section}.{key} must be a list")
+    return data
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+def _thaw(value):
+    if isinstance(value, Mapping):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+class ConfigSnapshot(Mapping):
+    """One validated, read-only version of config.yaml plus values derived from it.
+
+    Reads like the parsed YAML (CFG["cisco"]["phones"], CFG.get(...)) but
+    nested dicts are read-only and lists are tuples. A snapshot never
+    changes; CONFIG swaps in a new one, so a reader holding it sees one
+    consistent config.
+    """
+    def __init__(self, data: dict, version: int = 1):
+        self._data = _freeze(data)
+        self.version = version
+        self.loaded_at = time.time()
+        b, e = data.get("branding") or {}, data.get("email") or {}
+        c, g = data.get("cisco") or {}, data.get("gotify") or {}
+        self.service_name = b.get("service_name", "G Schools EMS")
+        self.site_name = b.get("site_name", "Glenwood Academy")
+        self.public_url = b.get("public_url", "http://172.16.50.191")
+        self.recipients = tuple(dict.fromkeys(b.get("fixed_recipients") or []))
+        self.sender = formataddr((b.get("from_display", "G-District Alerts"), e.get("from_alias", "")))
+        self.cisco_auth = (c.get("username", "admin"), c.get("password", "admin"))
+        self.gotify_server = (g.get("url") or "").rstrip("/")
+        self.gotify_url = self.gotify_server + "/message" if self.gotify_server else ""
+    def __getitem__(self, key):
+        return self._data[key]
+    def __iter__(self):
+        return iter(self._data)
+    def __len__(self):
+        return len(self._data)
+    def to_dict(self) -> dict:
+        """A mutable deep copy, e.g. to edit and pass to CONFIG.save()."""
+        return _thaw(self._data)
+class ConfigStore:
+    """Owns config.yaml: the current snapshot, saves and hot reload.
+
+    save() validates and swaps the new snapshot in at once; the file write
+    happens on a writer thread that coalesces saves within DEBOUNCE_SECS and
+    replaces the file atomically (temp file + rename). A watcher thread
+    reloads the file when it changes on disk (hand edits, another worker);
+    an invalid edit is logged and the running config kept. Listeners (zone
+    table, email templates) run after every swap.
+    """
+    DEBOUNCE_SECS = 0.5
+    WATCH_SECS = 2.0
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._pending = None
+        self._dirty = threading.Event()
+        self._writer = None
+        self._watcher = None
+        self._stat = self._file_stat()
+        self.snapshot = ConfigSnapshot(validate_config(self._read()))
+    def _read(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            return yaml.safe_load(f)
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+    def on_change(self, callback):
+        """Call callback(snapshot) after every swap."""
+        self._listeners.append(callback)
+    def _swap(self, data: dict) -> ConfigSnapshot:
+        global CFG
+        with self._lock:
+            snap = ConfigSnapshot(data, self.snapshot.version + 1)
+            self.snapshot = CFG = snap
+        for callback in list(self._listeners):
+            try:
+                callback(snap)
+            except Exception as e:
+                print(f"[config] change listener failed: {e}")
+        return snap
+    def save(self, data: dict) -> ConfigSnapshot:
+        """Validate data, make it the live config and queue the file write. Raises ConfigError."""
+        snap = self._swap(validate_config(data))
+        with self._lock:
+            self._pending = snap
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="config-writer", daemon=True)
+                self._writer.start()
+        self._dirty.set()
+        return snap
+    def _write_loop(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(self.DEBOUNCE_SECS)
+            self._dirty.clear()
+            self.flush()
+    def flush(self):
+        """Write a pending save now (also run at exit)."""
+        with self._lock:
+            snap, self._pending = self._pending, None
+        if snap is None:
+            return
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                yaml.safe_dump(snap.to_dict(), f, sort_keys=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            with self._lock:
+                # our own write; the watcher should not reload it
+                self._stat = self._file_stat()
+            print(f"[config] wrote {os.path.basename(self.path)} (version {snap.version})")
+        except Exception as e:
+            print(f"[config] failed to write {self.path}: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+    def start(self):
+        """Start the file watcher (idempotent)."""
+        if self._watcher and self._watcher.is_alive():
+            return
+        self._watcher = threading.Thread(target=self._watch_loop, name="config-watcher", daemon=True)
+        self._watcher.start()
+    def _watch_loop(self):
+        while True:
+            time.sleep(self.WATCH_SECS)
+            st = self._file_stat()
+            with self._lock:
+                if st is None or st == self._stat or self._pending is not None:
+                    continue
+                self._stat = st
+            try:
+                data = validate_config(self._read())
+            except (ConfigError, yaml.YAMLError, OSError) as e:
+                print(f"[config] ignoring unusable {os.path.basename(self.path)}: {e}")
+                continue
+            if data != self.snapshot.to_dict():
+                snap = self._swap(data)
+                print(f"[config] reloaded {os.path.basename(self.path)} (version {snap.version})")
+CONFIG = ConfigStore(CONFIG_PATH)
+CFG = CONFIG.snapshot
+atexit.register(CONFIG.flush)
 app = Flask(__name__)
 @app.template_filter("datetimeformat")
 def datetimeformat(value):
@@ -188,168 +565,289 @@ app.secret_key = CFG["app"]["secret_key"]
 HAS_SIO = False
 socketio = None
 # ---------------- DB helpers ----------------
-def db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
-def ensure_alerts_table():
-    """Ensure alerts_history table exists (and migrate columns if needed)."""
-    try:
-        conn = db(); c = conn.cursor()
-        c.execute(
-            "CREATE TABLE IF NOT EXISTS alerts_history ("
-            "id INTEGER PRIMARY KEY AUTOINCREMENT,"
-            "mode TEXT,"
-            "action TEXT,"
-            "text TEXT,"
-            "details TEXT,"
-            "severity TEXT,"
-            "zone TEXT,"
-            "started_at INTEGER,"
-            "resolved_at INTEGER,"
-            "resolved_by TEXT,"
-            "total_acks INTEGER"
-            ")"
-        )
-        # lightweight migrations for older dbs
-        cols = {r[1] for r in c.execute('PRAGMA table_info(alerts_history)').fetchall()}
-        if 'details' not in cols:
-            c.execute('ALTER TABLE alerts_history ADD COLUMN details TEXT')
-        if 'severity' not in cols:
-            c.execute('ALTER TABLE alerts_history ADD COLUMN severity TEXT')
-        conn.commit(); conn.close()
-    except Exception as e:
-        print(f"[alerts_history] table init/migrate failed: {e}")
-def ensure_drills_table():
-    """Ensure scheduled_drills table exists."""
-    try:
-        conn = db(); c = conn.cursor()
-        c.execute(
-            "CREATE TABLE IF NOT EXISTS scheduled_drills ("
-            "id INTEGER PRIMARY KEY AUTOINCREMENT,"
-            "label TEXT,"
-            "mode TEXT,"
-            "action TEXT,"
-            "zone TEXT,"
-            "run_at INTEGER,"
-            "enabled INTEGER,"
-            "last_run_at INTEGER,"
-            "created_by TEXT,"
-            "created_at INTEGER"
-            ")"
-        )
-        conn.commit(); conn.close()
-    except Exception as e:
-        print(f"[drills] table init failed: {e}")
-def fire_scheduled_alert(mode: str, action: str, zone: str = "ALL"):
-    """
-    Fire an alert from the scheduler without requiring a logged-in teacher.
-    Mirrors core of trigger_action but without form/session.
+import queue
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to the pool instead of closing it."""
+    pool = None
+    in_pool = False
+    def close(self):
+        if self.pool is None:
+            return super().close()
+        self.pool.checkin(self)
+    def discard(self):
+        super().close()
+class ConnectionPool:
+    """Pool of long-lived SQLite connections opened once in WAL mode.
+
+    db() checks a connection out and conn.close() returns it, so existing
+    "conn = db() ... conn.close()" code keeps working without reconnecting
+    and re-preparing statements (each connection keeps its own statement
+    cache) on every call. Anything left uncommitted is rolled back on return.
     """
-    mode = (mode or "DRILL").upper().strip()
-    action = (action or "").upper().strip()
-    zone = (zone or "ALL").upper().strip()
-    if action not in ALLOWED:
-        print(f"[scheduler] invalid action {action}")
-        return
-    threads = []
-    details = ""
-    severity = ""
-    # Cisco broadcast
-    try:
-        threads.append(_fire_and_forget(cisco_broadcast, action))
-    except Exception as e:
-        print(f"[scheduler] Cisco failed: {e}")
-    # PBX / Asterisk page
-    try:
-        threads.append(_fire_and_forget(page_group))
-    except Exception as e:
-        print(f"[scheduler] PBX failed: {e}")
-    # RSS token update
-    try:
-        threads.append(_fire_and_forget(update_rss_token, action))
-    except Exception as e:
-        print(f"[scheduler] RSS failed: {e}")
-    # Gotify push
-    try:
-        msg = f"{mode} {action} triggered by SCHEDULER"
-        threads.append(_fire_and_forget(
-            send_gotify,
-            msg,
-            f"{_service_name()} Alert: {action}"
-        ))
-    except Exception as e:
-        print(f"[scheduler] Gotify error: {e}")
-    # ClockWise UDP
-    try:
-        threads.append(_fire_and_forget(clockwise_udp_trigger, action, zone))
-    except Exception as e:
-        print(f"[scheduler] ClockWise error: {e}")
-    # Web banner for dashboards
-    broadcast_web_banner(action, mode)
-    # Determine displays for this zone
-    zones_cfg = CFG.get("zones", {})
-    target_displays = []
-    if zones_cfg:
-        z_cfg = zones_cfg.get(zone) or zones_cfg.get(zone.upper())
-        if z_cfg and isinstance(z_cfg, dict):
-            target_displays = z_cfg.get("displays", [])
-        if not target_displays:
-            all_cfg = zones_cfg.get("ALL") or {}
-            target_displays = all_cfg.get("displays", [])
-    if not target_displays:
-        target_displays = ["display-1", "display-2"]
-    for display_id in target_displays:
-        DISPLAY_STATE[display_id] = {"mode": "ALERT", "text": (f"{mode} {action} – {details}" if details else f"{mode} {action}")[:64]}
-    # Update latest alert
-    LAST_ALERT["mode"] = mode
-    LAST_ALERT["action"] = action
-    LAST_ALERT["text"] = f"{mode} {action}"
-    LAST_ALERT["details"] = details
-    LAST_ALERT["severity"] = severity
-    LAST_ALERT["timestamp"] = int(time.time())
-    LAST_ALERT["zone"] = zone
-    LAST_ALERT["id"] = None
-    # New alert -> clear previous acknowledgements
-    ACK_LOG.clear()
-    # Insert into alerts_history table
-    try:
-        ensure_alerts_table()
-        conn = db(); c = conn.cursor()
-        c.execute(
-            "INSERT INTO alerts_history (mode, action, text, details, severity, zone, started_at, resolved_at, resolved_by, total_acks) "
-            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (mode, action, f"{mode} {action}", details, severity, zone, int(time.time()), None, "SCHEDULER", 0),
-        )
-        LAST_ALERT["id"] = c.lastrowid
-        conn.commit(); conn.close()
-    except Exception as e:
-        print(f"[scheduler] alerts_history insert failed: {e}")
-def init_db():
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("""CREATE TABLE IF NOT EXISTS teachers(
+    def __init__(self, path: str, size: int = 8, busy_timeout_ms: int = 5000, synchronous: str = "NORMAL"):
+        self.path = path
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.synchronous = synchronous
+        self._idle = queue.LifoQueue()
+        self._pid = os.getpid()
+    def _open(self) -> PooledConnection:
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, factory=PooledConnection,
+                               check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.pool = self
+        return conn
+    def dedicated(self) -> sqlite3.Connection:
+        """A connection outside the pool, owned by the caller for its lifetime."""
+        conn = self._open()
+        conn.pool = None
+        return conn
+    def checkout(self) -> PooledConnection:
+        if self._pid != os.getpid():
+            # forked (e.g. gunicorn --preload): never share the parent's connections
+            self._idle, self._pid = queue.LifoQueue(), os.getpid()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            return self._open()
+        conn.in_pool = False
+        return conn
+    def checkin(self, conn: PooledConnection):
+        if conn.in_pool:
+            # closed twice; it is already idle
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = sqlite3.Row
+        except sqlite3.Error:
+            conn.discard()
+            return
+        if self._idle.qsize() >= self.size:
+            conn.discard()
+        else:
+            conn.in_pool = True
+            self._idle.put(conn)
+_DB_CFG = CFG.get("database", {}) or {}
+DB_POOL = ConnectionPool(
+    DB_PATH,
+    size=int(_DB_CFG.get("pool_size", 8)),
+    busy_timeout_ms=int(_DB_CFG.get("busy_timeout_ms", 5000)),
+    synchronous=str(_DB_CFG.get("synchronous", "NORMAL")).upper(),
+)
+def db():
+    return DB_POOL.checkout()
+def _add_missing_columns(c, table, columns):
+    cols = {r[1] for r in c.execute(f"PRAGMA table_info({table})").fetchall()}
+    for name, decl in columns:
+        if name not in cols:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+def _migration_core(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS teachers(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         username TEXT UNIQUE NOT NULL,
         password TEXT NOT NULL,
         name TEXT,
         room TEXT
     )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS attendance(
+    c.execute("""CREATE TABLE IF NOT EXISTS attendance(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         teacher_id INTEGER,
         student TEXT,
         status TEXT,
         ts INTEGER
     )""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS roster(
+    c.execute("""CREATE TABLE IF NOT EXISTS roster(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         teacher_id INTEGER,
         student TEXT
     )""")
+def _migration_alerts_history(c):
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS alerts_history ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "mode TEXT,"
+        "action TEXT,"
+        "text TEXT,"
+        "details TEXT,"
+        "severity TEXT,"
+        "zone TEXT,"
+        "started_at INTEGER,"
+        "resolved_at INTEGER,"
+        "resolved_by TEXT,"
+        "total_acks INTEGER"
+        ")"
+    )
+    # older dbs predate details / severity
+    _add_missing_columns(c, "alerts_history", [("details", "TEXT"), ("severity", "TEXT")])
+def _migration_drills(c):
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS scheduled_drills ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "label TEXT,"
+        "mode TEXT,"
+        "action TEXT,"
+        "zone TEXT,"
+        "run_at INTEGER,"
+        "enabled INTEGER,"
+        "last_run_at INTEGER,"
+        "created_by TEXT,"
+        "created_at INTEGER"
+        ")"
+    )
+def _migration_delivery(c):
+    # one row per channel / target per alert
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS delivery_attempts ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "alert_id INTEGER,"
+        "channel TEXT,"
+        "target TEXT,"
+        "enqueued_ms INTEGER,"
+        "first_byte_ms INTEGER,"
+        "completed_ms INTEGER,"
+        "status TEXT,"
+        "error TEXT"
+        ")"
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_delivery_alert ON delivery_attempts(alert_id)")
+def _migration_state_journal(c):
+    # append-only log of state changes
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS state_journal ("
+        "seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+        "ts INTEGER,"
+        "topic TEXT NOT NULL,"
+        "key TEXT,"
+        "data TEXT"
+        ")"
+    )
+def _migration_acks(c):
+    # one row per station per alert
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS alert_acks ("
+        "alert_id INTEGER NOT NULL,"
+        "station TEXT NOT NULL,"
+        "station_group TEXT,"
+        "first_ack_ts INTEGER,"
+        "last_ack_ts INTEGER,"
+        "repeats INTEGER DEFAULT 1,"
+        "PRIMARY KEY (alert_id, station)"
+        ")"
+    )
+def _migration_history_indexes(c):
+    # keyset pages walk (started_at, id) newest first; filters seek on their column first
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_started ON alerts_history(started_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_action ON alerts_history(action, started_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_mode ON alerts_history(mode, started_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_zone ON alerts_history(zone, started_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_open ON alerts_history(started_at, id) WHERE resolved_at IS NULL")
+def _migration_drill_recurrence(c):
+    _add_missing_columns(c, "scheduled_drills", [("recurrence", "TEXT"), ("last_jitter_ms", "REAL")])
+    c.execute("CREATE INDEX IF NOT EXISTS idx_drills_due ON scheduled_drills(enabled, run_at)")
+def _migration_shared_state(c):
+    # origin = node id of the worker that made the change; leases = leader election
+    _add_missing_columns(c, "state_journal", [("origin", "TEXT")])
+    c.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT, expires_at REAL)")
+def _migration_trigger_dedupe(c):
+    # everyone who pressed for an alert (the first one plus coalesced presses)
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS alert_initiators ("
+        "alert_id INTEGER NOT NULL,"
+        "initiator TEXT,"
+        "created_by TEXT,"
+        "source TEXT,"
+        "ts INTEGER"
+        ")"
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_initiators_alert ON alert_initiators(alert_id)")
+    # idempotency keys already seen on /trigger
+    c.execute("CREATE TABLE IF NOT EXISTS trigger_keys (key TEXT PRIMARY KEY, alert_id INTEGER, created_at INTEGER)")
+def _migration_websub(c):
+    # push subscribers of the RSS feeds (WebSubHub)
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS websub_subscriptions ("
+        "topic TEXT NOT NULL,"
+        "callback TEXT NOT NULL,"
+        "secret TEXT,"
+        "expires_at INTEGER,"
+        "PRIMARY KEY (topic, callback)"
+        ")"
+    )
+def _migration_display_registry(c):
+    # known LED panels (DisplayFleet); last_seen / polls are flushed in batches
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS display_devices ("
+        "id TEXT PRIMARY KEY,"
+        "zone TEXT,"
+        "model TEXT,"
+        "label TEXT,"
+        "registered_at INTEGER,"
+        "last_seen INTEGER,"
+        "polls INTEGER DEFAULT 0"
+        ")"
+    )
+def _migration_trigger_key_scope(c):
+    # the request a key was claimed for; keys only dedupe an identical (mode, action, zone)
+    _add_missing_columns(c, "trigger_keys", [("mode", "TEXT"), ("action", "TEXT"), ("zone", "TEXT")])
+# (version, name, fn(cursor)); append only, never renumber
+MIGRATIONS = [
+    (1, "core tables", _migration_core),
+    (2, "alerts_history", _migration_alerts_history),
+    (3, "scheduled_drills", _migration_drills),
+    (4, "delivery_attempts", _migration_delivery),
+    (5, "state_journal", _migration_state_journal),
+    (6, "alert_acks", _migration_acks),
+    (7, "alerts_history indexes", _migration_history_indexes),
+    (8, "scheduled_drills recurrence", _migration_drill_recurrence),
+    (9, "shared state backend", _migration_shared_state),
+    (10, "trigger de-duplication", _migration_trigger_dedupe),
+    (11, "websub subscriptions", _migration_websub),
+    (12, "display registry", _migration_display_registry),
+    (13, "trigger key scope", _migration_trigger_key_scope),
+]
+def migrate_db():
+    """Apply pending MIGRATIONS once at startup, each in its own transaction."""
+    conn = db(); c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name TEXT, applied_at INTEGER)")
     conn.commit()
+    applied = {r[0] for r in c.execute("SELECT version FROM schema_migrations").fetchall()}
+    for version, name, fn in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            fn(c)
+            c.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                      (version, name, int(time.time())))
+            conn.commit()
+            print(f"[db] applied migration {version}: {name}")
+        except Exception as e:
+            conn.rollback()
+            print(f"[db] migration {version} ({name}) failed: {e}")
+            break
     conn.close()
-init_db()
+def fire_scheduled_alert(mode: str, action: str, zone: str = "ALL"):
+    """
+    Fire an alert from the scheduler without requiring a logged-in teacher.
+    Mirrors core of trigger_action but without form/session.
+    """
+    mode = (mode or "DRILL").upper().strip()
+    action = (action or "").upper().strip()
+    zone = (zone or "ALL").upper().strip()
+    if action not in ALLOWED:
+        print(f"[scheduler] invalid action {action}")
+        return
+    # Scheduled drills never emailed; keep that behaviour.
+    return activate_alert(
+        mode, action, zone,
+        initiator="SCHEDULER", created_by="SCHEDULER", total_acks=0,
+        channels=[ch for ch in ALERT_CHANNELS if ch != "email"],
+    )
+migrate_db()
 def seed_teacher():
     conn = db()
     c = conn.cursor()
@@ -366,14 +864,15 @@ seed_teacher()
 # ---------------- helpers ----------------
 def check_admin_passcode(code: str) -> bool:
     return (code or "") == CFG["app"]["admin_passcode"]
-def _fire_and_forget(func, *args, **kwargs):
-    """Run a function in a background thread so channels can fire in parallel."""
+def _after(delay: float, func, *args):
+    """Run func once after delay seconds on a timer thread (e.g. returning panels to IDLE)."""
     def wrapper():
         try:
-            func(*args, **kwargs)
+            func(*args)
         except Exception as e:
-            print(f"[Background error in {func.__name__}] {e}")
-    t = threading.Thread(target=wrapper, daemon=True)
+            print(f"[Background error in {getattr(func, '__name__', 'timer')}] {e}")
+    t = threading.Timer(delay, wrapper)
+    t.daemon = True
     t.start()
     return t
 def _icon_bytes(action: str) -> bytes:
@@ -387,11 +886,11 @@ def _icon_bytes(action: str) -> bytes:
     except Exception:
         return b""
 def _brand_site() -> str:
-    return CFG.get("branding",{}).get("site_name","Glenwood Academy")
+    return CFG.site_name
 def _service_name() -> str:
-    return CFG.get("branding",{}).get("service_name","G Schools EMS")
+    return CFG.service_name
 def _public_url() -> str:
-    return CFG.get("branding", {}).get("public_url", "http://172.16.50.191")
+    return CFG.public_url
 def default_copy(action: str):
     if action == "HOLD":
         return ("G Schools EMS - Action Alert! - Glenwood Academy - Emergency",
@@ -419,7 +918,9 @@ def default_copy(action: str):
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
-import smtplib, ssl
+from email.header import Header
+from email.utils import formataddr
+import smtplib, ssl, uuid
 def catapult_style_email_html(action: str, mode: str, details_text: str, directive_text: str) -> str:
     catapult_red = "#A00000"; drill_blue  = "#1B32A8"; directive_red = "#E00000"
     border_gray = "#E5E7EB"; label_gray  = "#6B7280"
@@ -503,43 +1004,247 @@ def catapult_style_email_html(action: str, mode: str, details_text: str, directi
   </body>
 </html>"""
     return html
+class SMTPPool:
+    """Warm, authenticated SMTP connections shared by every email send.
+
+    Settings come from CFG["email"]: pool_size (parallel connections, default 3),
+    batch_size (recipients per envelope, default 50 – Gmail caps a message at
+    100), keepalive_secs (NOOP interval for idle connections, default 60).
+    A failed connection is discarded and the batch retried once on a fresh one.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = []
+        self._settings = None
+        self._workers = None
+        self._keepalive_thread = None
+    def _cfg(self):
+        e = CFG.get("email", {}) or {}
+        return (e.get("smtp_host"), int(e.get("smtp_port", 587) or 587), bool(e.get("use_ssl")),
+                bool(e.get("use_tls", True)), e.get("username", ""), e.get("app_password", ""))
+    def _connect(self, settings):
+        host, port, use_ssl, use_tls, user, password = settings
+        timeout = HEALTH.timeout("smtp", f"{host}:{port}", 15)
+        if use_ssl:
+            server = smtplib.SMTP_SSL(host, port, context=ssl.create_default_context(), timeout=timeout)
+        else:
+            server = smtplib.SMTP(host, port, timeout=timeout)
+            if use_tls:
+                server.starttls(context=ssl.create_default_context())
+        server.login(user, password)
+        return server
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+    def _checkout(self):
+        settings = self._cfg()
+        stale = []
+        with self._lock:
+            if settings != self._settings:
+                stale, self._idle, self._settings = self._idle, [], settings
+            server = self._idle.pop() if self._idle else None
+        for s in stale:
+            self._close(s)
+        return server or self._connect(settings), settings
+    def _checkin(self, server, settings):
+        with self._lock:
+            if settings == self._settings and len(self._idle) < self._pool_size():
+                self._idle.append(server)
+                return
+        self._close(server)
+    def _pool_size(self) -> int:
+        return max(1, int((CFG.get("email", {}) or {}).get("pool_size", 3)))
+    def _send_batch(self, sender, batch, message, attempt):
+        host, port = self._cfg()[:2]
+        endpoint = f"{host}:{port}"
+        if not HEALTH.allow("smtp", endpoint, (host, port)):
+            raise ConnectionError(f"circuit open for {endpoint}")
+        started = time.perf_counter()
+        try:
+            self._send_batch_once(sender, batch, message, attempt)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError) as e:
+            HEALTH.record("smtp", endpoint, False, error=str(e) or type(e).__name__)
+            raise
+        except Exception:
+            # server answered (e.g. refused recipients): reachable, just not a clean send
+            HEALTH.record("smtp", endpoint, True)
+            raise
+        HEALTH.record("smtp", endpoint, True, time.perf_counter() - started)
+    def _send_batch_once(self, sender, batch, message, attempt):
+        for tries in (1, 2):
+            server, settings = self._checkout()
+            attempt.first_byte()
+            try:
+                server.sendmail(sender, batch, message)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPSenderRefused, OSError) as e:
+                self._close(server)
+                if tries == 2:
+                    raise
+                print(f"[Email] connection dropped ({e}); retrying batch on a fresh connection")
+                continue
+            except Exception:
+                self._close(server)
+                raise
+            self._checkin(server, settings)
+            return
+    def send(self, sender: str, recipients, message: str, handle=None) -> list:
+        """Send message to recipients in parallel batches; returns per-batch timing dicts."""
+        self.start()
+        e = CFG.get("email", {}) or {}
+        size = max(1, int(e.get("batch_size", 50)))
+        batches = [recipients[i:i + size] for i in range(0, len(recipients), size)]
+        handle = handle if handle is not None else current_dispatch()
+        with self._lock:
+            if self._workers is None:
+                self._workers = PriorityExecutor(self._pool_size(), "smtp")
+            pool = self._workers
+        pool.workers = self._pool_size()
+        # batches of a LIVE alert jump ahead of drill / announcement batches still queued
+        priority = getattr(handle, "priority", "DRILL")
+        def run(batch):
+            attempt = DeliveryAttempt("email", ",".join(batch), handle)
+            started = time.perf_counter()
+            try:
+                self._send_batch(sender, batch, message, attempt)
+                ok, err = True, ""
+            except Exception as ex:
+                ok, err = False, str(ex)
+            attempt.finish(ok, err)
+            return {"recipients": len(batch), "ok": ok, "error": err,
+                    "ms": round((time.perf_counter() - started) * 1000, 1)}
+        results = [f.result() for f in [pool.submit(priority, run, b) for b in batches]]
+        for i, r in enumerate(results, 1):
+            print(f"[Email] batch {i}/{len(results)}: {r['recipients']} recipient(s) "
+                  f"{'sent' if r['ok'] else 'FAILED'} in {r['ms']} ms" + (f" – {r['error']}" if r["error"] else ""))
+        return results
+    def stats(self) -> dict:
+        return self._workers.stats() if self._workers is not None else {}
+    def start(self):
+        """Start the NOOP keepalive thread (idempotent); it also opens the first warm connection."""
+        with self._lock:
+            if self._keepalive_thread and self._keepalive_thread.is_alive():
+                return
+            self._keepalive_thread = threading.Thread(target=self._keepalive, name="smtp-keepalive", daemon=True)
+            self._keepalive_thread.start()
+    def _keepalive(self):
+        while True:
+            try:
+                if self._cfg()[0]:
+                    with self._lock:
+                        idle, self._idle = self._idle, []
+                    alive = []
+                    for server in idle:
+                        try:
+                            if server.noop()[0] == 250:
+                                alive.append(server)
+                                continue
+                        except Exception:
+                            pass
+                        self._close(server)
+                    for server in alive:
+                        self._checkin(server, self._settings)
+                    if not alive:
+                        server, settings = self._checkout()
+                        self._checkin(server, settings)
+            except Exception as e:
+                print(f"[Email] SMTP keepalive failed: {e}")
+            time.sleep(float((CFG.get("email", {}) or {}).get("keepalive_secs", 60)))
+SMTP_POOL = SMTPPool()
+def _smtp_send(recipients, message: str):
+    """Deliver one message through the SMTP pool; raises if any recipient batch failed."""
+    results = SMTP_POOL.send(CFG["email"]["from_alias"], list(recipients), message)
+    failed = [r for r in results if not r["ok"]]
+    if failed:
+        raise RuntimeError(f"{len(failed)}/{len(results)} batch(es) failed: {failed[0]['error']}")
+class EmailTemplateCache:
+    """Pre-rendered alert email parts per (action, mode).
+
+    The HTML skeleton is split around the details text and the inline icon is
+    read and base64-encoded once, so a send only splices in the details,
+    subject and recipients. rebuild() runs at startup and on config save;
+    other (action, mode) pairs are rendered on first use.
+    """
+    DETAILS_MARK = "\x00details\x00"
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = {}
+    def _render(self, action: str, mode: str):
+        _, _, directive = default_copy(action)
+        html = catapult_style_email_html(action, mode, self.DETAILS_MARK, directive)
+        head, tail = html.split(self.DETAILS_MARK, 1)
+        icon_part = ""
+        icon = _icon_bytes(action)
+        if icon:
+            part = MIMEImage(icon); part.add_header("Content-ID", "<action_icon>")
+            part.add_header("Content-Disposition", "inline", filename="icon.png")
+            icon_part = part.as_string()
+        return head, tail, icon_part
+    def rebuild(self):
+        cache = {(a, m): self._render(a, m) for a in ALERTS for m in ("DRILL", "LIVE")}
+        with self._lock:
+            self._cache = cache
+    def get(self, action: str, mode: str):
+        parts = self._cache.get((action, mode))
+        if parts is None:
+            parts = self._render(action, mode)
+            with self._lock:
+                self._cache[(action, mode)] = parts
+        return parts
+    def build(self, action: str, mode: str, details_text: str, subject: str, sender: str, recipients) -> str:
+        """Return the full multipart/related message text ready for sendmail."""
+        head, tail, icon_part = self.get(action, mode)
+        html = head + (details_text or "More details soon") + tail
+        related, alternative = f"===============r{uuid.uuid4().hex}==", f"===============a{uuid.uuid4().hex}=="
+        if not subject.isascii():
+            subject = Header(subject, "utf-8").encode()
+        lines = [
+            f'Content-Type: multipart/related; boundary="{related}"',
+            "MIME-Version: 1.0",
+            f"From: {sender}",
+            "To: " + ",\n ".join(recipients),
+            f"Subject: {subject}",
+            "",
+            f"--{related}",
+            f'Content-Type: multipart/alternative; boundary="{alternative}"',
+            "MIME-Version: 1.0",
+            "",
+            f"--{alternative}",
+            'Content-Type: text/html; charset="utf-8"',
+            "MIME-Version: 1.0",
+            "Content-Transfer-Encoding: base64",
+            "",
+            base64.encodebytes(html.encode("utf-8")).decode("ascii"),
+            f"--{alternative}--",
+            "",
+        ]
+        if icon_part:
+            lines += [f"--{related}", icon_part]
+        lines.append(f"--{related}--")
+        return "\n".join(lines) + "\n"
+EMAIL_TEMPLATES = EmailTemplateCache()
+CONFIG.on_change(lambda snap: EMAIL_TEMPLATES.rebuild())
 def send_email(mode: str, action: str, extra_details: str = ""):
     try:
-        _, _, directive = default_copy(action)
         subject = f"{_service_name()} – Action Alert! – {_brand_site()} – Emergency"
         if mode == "DRILL":
             subject += " (DRILL)"
             details_text = "THIS IS A DRILL!\n\n" + (extra_details or "More details soon")
         else:
             details_text = (extra_details or "More details soon")
-        html = catapult_style_email_html(action, mode, details_text, directive)
-        recipients = list(set(CFG["branding"]["fixed_recipients"]))
-        msg = MIMEMultipart("related")
-        msg["From"] = f"{CFG['branding']['from_display']} <{CFG['email']['from_alias']}>"
-        msg["To"] = ", ".join(recipients)
-        msg["Subject"] = subject
-        alt = MIMEMultipart("alternative")
-        alt.attach(MIMEText(html, "html"))
-        msg.attach(alt)
-        icon = _icon_bytes(action)
-        if icon:
-            part = MIMEImage(icon); part.add_header("Content-ID", "<action_icon>")
-            part.add_header("Content-Disposition", "inline", filename="icon.png")
-            msg.attach(part)
-        if CFG["email"].get("use_ssl"):
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(CFG["email"]["smtp_host"], CFG["email"]["smtp_port"], context=context) as server:
-                server.login(CFG["email"]["username"], CFG["email"]["app_password"])
-                server.sendmail(CFG["email"]["from_alias"], recipients, msg.as_string())
-        else:
-            with smtplib.SMTP(CFG["email"]["smtp_host"], CFG["email"]["smtp_port"]) as server:
-                if CFG["email"].get("use_tls", True):
-                    server.starttls(context=ssl.create_default_context())
-                server.login(CFG["email"]["username"], CFG["email"]["app_password"])
-                server.sendmail(CFG["email"]["from_alias"], recipients, msg.as_string())
+        recipients = list(CFG.recipients)
+        sender = CFG.sender
+        _smtp_send(recipients, EMAIL_TEMPLATES.build(action, mode, details_text, subject, sender, recipients))
         print("[Email] Sent successfully")
+        return True
     except Exception as e:
         print(f"[Email] Failed: {e}")
+        return False
 # ---------------- Resolution / Announcement ----------------
 def send_resolution_email(message: str, resolved_by: str = ""):
     """Send an 'all clear' style email to fixed recipients."""
@@ -568,7 +1273,7 @@ def send_resolution_email(message: str, resolved_by: str = ""):
     </table>
   </body>
 </html>"""
-        recipients = list(set(CFG.get("branding", {}).get("fixed_recipients", []) or []))
+        recipients = list(CFG.recipients)
         if not recipients:
             print("[Email] No fixed recipients configured")
             return
@@ -577,17 +1282,7 @@ def send_resolution_email(message: str, resolved_by: str = ""):
         msg["To"] = ", ".join(recipients)
         msg["Subject"] = subject
         msg.attach(MIMEText(html, "html"))
-        if CFG["email"].get("use_ssl"):
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(CFG["email"]["smtp_host"], CFG["email"]["smtp_port"], context=context) as server:
-                server.login(CFG["email"]["username"], CFG["email"]["app_password"])
-                server.sendmail(CFG["email"]["from_alias"], recipients, msg.as_string())
-        else:
-            with smtplib.SMTP(CFG["email"]["smtp_host"], CFG["email"]["smtp_port"]) as server:
-                if CFG["email"].get("use_tls", True):
-                    server.starttls(context=ssl.create_default_context())
-                server.login(CFG["email"]["username"], CFG["email"]["app_password"])
-                server.sendmail(CFG["email"]["from_alias"], recipients, msg.as_string())
+        _smtp_send(recipients, msg.as_string())
         print("[Email] Resolution sent")
     except Exception as e:
         print(f"[Email] Resolution failed: {e}")
@@ -595,14 +1290,15 @@ def broadcast_resolution_all_channels(message: str, resolved_by: str = ""):
     """Best-effort 'all clear' notification across configured channels."""
     who = (resolved_by or "System").strip()
     body = (message or "Resolution: the emergency has ended.").strip()
+    handle = DispatchHandle("RESOLUTION", priority="RESOLUTION")
     # Email
     try:
-        _fire_and_forget(send_resolution_email, body, who)
+        DISPATCH.submit(handle, "email", send_resolution_email, body, who)
     except Exception as e:
         print(f"[Resolution] email error: {e}")
     # Gotify
     try:
-        _fire_and_forget(send_gotify, f"RESOLUTION / ALL CLEAR by {who}: {body}", f"{_service_name()} – All Clear", 8)
+        DISPATCH.submit(handle, "gotify", send_gotify, f"RESOLUTION / ALL CLEAR by {who}: {body}", f"{_service_name()} – All Clear", 8)
     except Exception as e:
         print(f"[Resolution] gotify error: {e}")
     # Web banners
@@ -611,113 +1307,2613 @@ def broadcast_resolution_all_channels(message: str, resolved_by: str = ""):
     except Exception as e:
         print(f"[Resolution] web banner error: {e}")
     # Displays: show 'ALL CLEAR' briefly, then return to IDLE
-    def _display_all_clear():
+    try:
+        state = {"mode": "MESSAGE", "text": ("ALL CLEAR" if not body else f"ALL CLEAR – {body}")[:64]}
+        STORE.set_displays({did: state for did in list(STORE.displays) or ["display-1", "display-2"]})
+        _after(12, lambda: STORE.set_displays({did: IDLE_DISPLAY for did in list(STORE.displays) or ["display-1", "display-2"]}))
+    except Exception as e:
+        print(f"[Resolution] display cycle error: {e}")
+    return handle
+# ---------------- PBX ----------------
+class AMIManager:
+    """One long-lived, authenticated AMI session shared by every PBX action.
+
+    A reader thread splits the stream into framed messages (blank-line
+    terminated) and hands each Response to the caller waiting on its
+    ActionID. A keepalive thread pings the session and reconnects with
+    exponential backoff when Asterisk goes away.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+        self._sock = None
+        self._settings = None
+        self._pending = {}
+        self._seq = 0
+        self._keepalive_thread = None
+    def _cfg(self):
+        a = CFG.get("asterisk", {}) or {}
+        return (a.get("ami_host"), int(a.get("ami_port", 5038) or 5038),
+                a.get("ami_username", ""), a.get("ami_secret", ""))
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+    def start(self):
+        """Start the keepalive / reconnect thread (idempotent)."""
+        if self._keepalive_thread and self._keepalive_thread.is_alive():
+            return
+        self._keepalive_thread = threading.Thread(target=self._keepalive, name="ami-keepalive", daemon=True)
+        self._keepalive_thread.start()
+    def _next_action_id(self) -> str:
+        with self._lock:
+            self._seq += 1
+            return f"gems-{os.getpid()}-{self._seq}"
+    def _connect(self):
+        settings = self._cfg()
+        host, port, user, secret = settings
+        if not host:
+            raise ConnectionError("ami_host not configured")
+        sock = socket.create_connection((host, port), timeout=5)
+        sock.settimeout(None)
+        with self._lock:
+            self._sock, self._settings = sock, settings
+        threading.Thread(target=self._reader, args=(sock,), name="ami-reader", daemon=True).start()
+        resp = self._request({"Action": "Login", "Username": user, "Secret": secret, "Events": "off"}, timeout=5)
+        if resp.get("Response", "").lower() != "success":
+            self._drop(sock, f"login rejected: {resp.get('Message', '')}")
+            raise PermissionError(f"AMI login rejected: {resp.get('Message', '')}")
+        print(f"[PBX] AMI session established to {host}:{port}")
+    def _ensure(self):
+        with self._connect_lock:
+            if self._sock is not None and self._settings != self._cfg():
+                self._drop(self._sock, "settings changed")
+            if self._sock is None:
+                self._connect()
+    def _drop(self, sock, reason: str):
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+            pending, self._pending = self._pending, {}
         try:
-            for did in list(DISPLAY_STATE.keys()) or ["display-1", "display-2"]:
-                DISPLAY_STATE[did] = {"mode": "MESSAGE", "text": ("ALL CLEAR" if not body else f"ALL CLEAR – {body}")[:64]}
-            time.sleep(12)
-            for did in list(DISPLAY_STATE.keys()) or ["display-1", "display-2"]:
-                DISPLAY_STATE[did] = {"mode": "IDLE", "text": ""}
+            sock.close()
+        except Exception:
+            pass
+        for slot in pending.values():
+            slot["error"] = reason
+            slot["event"].set()
+        print(f"[PBX] AMI session closed: {reason}")
+    def _reader(self, sock):
+        buf = b""
+        try:
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    raise ConnectionError("connection closed by peer")
+                buf += chunk
+                while b"\r\n\r\n" in buf:
+                    raw, buf = buf.split(b"\r\n\r\n", 1)
+                    msg = {}
+                    for line in raw.decode("utf-8", errors="replace").split("\r\n"):
+                        if ": " in line:
+                            k, v = line.split(": ", 1)
+                            msg.setdefault(k.strip(), v.strip())
+                    with self._lock:
+                        slot = self._pending.pop(msg.get("ActionID"), None) if "Response" in msg else None
+                    if slot is not None:
+                        slot["response"] = msg
+                        slot["event"].set()
         except Exception as e:
-            print(f"[Resolution] display cycle error: {e}")
-    _fire_and_forget(_display_all_clear)
-# ---------------- PBX ----------------
+            self._drop(sock, str(e))
+    def _request(self, fields: dict, timeout: float) -> dict:
+        action_id = self._next_action_id()
+        slot = {"event": threading.Event(), "response": None, "error": None}
+        payload = "".join(f"{k}: {v}\r\n" for k, v in fields.items()) + f"ActionID: {action_id}\r\n\r\n"
+        with self._lock:
+            sock = self._sock
+            if sock is None:
+                raise ConnectionError("AMI not connected")
+            self._pending[action_id] = slot
+            try:
+                sock.sendall(payload.encode("utf-8"))
+            except OSError:
+                self._pending.pop(action_id, None)
+                raise ConnectionError("AMI send failed")
+        if not slot["event"].wait(timeout):
+            with self._lock:
+                self._pending.pop(action_id, None)
+            raise TimeoutError(f"AMI {fields.get('Action')} got no response in {timeout}s")
+        if slot["error"]:
+            raise ConnectionError(slot["error"])
+        return slot["response"]
+    def action(self, fields: dict, timeout: float = 5) -> dict:
+        """Send one action over the warm session (connecting if needed) and return its Response."""
+        self._ensure()
+        try:
+            return self._request(fields, timeout)
+        except ConnectionError:
+            # session died between keepalives: reconnect once and retry
+            self._ensure()
+            return self._request(fields, timeout)
+    def _keepalive(self):
+        backoff = 1
+        while True:
+            interval = float((CFG.get("asterisk", {}) or {}).get("keepalive_secs", 20))
+            try:
+                if self._cfg()[0]:
+                    if self._sock is None:
+                        self._ensure()
+                    else:
+                        self.action({"Action": "Ping"}, timeout=5)
+                backoff = 1
+                time.sleep(interval)
+            except Exception as e:
+                print(f"[PBX] AMI keepalive failed ({e}); retrying in {backoff}s")
+                if self._sock is not None:
+                    self._drop(self._sock, "keepalive failed")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+AMI = AMIManager()
 def ami_send(command: str) -> bool:
+    """Send a "Key: value" per line AMI action over the shared session; True on Response: Success."""
+    attempt = None
     try:
         a = CFG["asterisk"]
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM); s.settimeout(5)
-        s.connect((a["ami_host"], a["ami_port"]))
-        def send(line): s.sendall((line + "\r\n").encode("utf-8"))
-        def drain():
-            try: s.recv(4096)
-            except: pass
-        send("Action: Login"); send(f"Username: {a['ami_username']}"); send(f"Secret: {a['ami_secret']}"); send("")
-        drain()
+        fields = {}
         for ln in command.split("\n"):
-            if ln.strip(): send(ln)
-        send(""); drain(); send("Action: Logoff"); send("")
-        s.close(); return True
+            if ":" in ln:
+                k, v = ln.split(":", 1)
+                fields[k.strip()] = v.strip()
+        attempt = DeliveryAttempt("pbx", f"{a['ami_host']}:{a['ami_port']} {fields.get('Action', '')}")
+        endpoint = f"{a['ami_host']}:{a['ami_port']}"
+        if not HEALTH.allow("pbx", endpoint, (a["ami_host"], int(a["ami_port"]))):
+            print(f"[PBX] Skipped: circuit open for {endpoint}")
+            return attempt.finish(False, "circuit open")
+        started = time.perf_counter()
+        try:
+            resp = AMI.action(fields, timeout=HEALTH.timeout("pbx", endpoint, 5))
+        except Exception as e:
+            HEALTH.record("pbx", endpoint, False, error=str(e) or type(e).__name__)
+            raise
+        HEALTH.record("pbx", endpoint, True, time.perf_counter() - started)
+        attempt.first_byte()
+        ok = resp.get("Response", "").lower() == "success"
+        print(f"[PBX] {fields.get('Action')} -> {resp.get('Response')} in {(time.perf_counter() - started) * 1000:.0f} ms"
+              + ("" if ok else f": {resp.get('Message', '')}"))
+        return attempt.finish(ok, "" if ok else resp.get("Message", ""))
     except Exception as e:
-        print(f"[PBX] AMI connection failed: {e}"); return False
-def page_group():
+        print(f"[PBX] AMI connection failed: {e}")
+        if attempt is not None:
+            attempt.finish(False, str(e))
+        return False
+def page_group(zone: str = "ALL"):
     try:
-        pg = CFG["asterisk"]["page_extension"]
-        cmd = (
-            "Action: Originate\n"
-            f"Channel: Local/{pg}@from-internal\n"
-            "Context: from-internal\n"
-            f"Exten: {pg}\n"
-            "Priority: 1\n"
-            "Async: true"
-        )
-        ami_send(cmd)
+        extensions = ZONES.route(zone).page_extensions
+        if not extensions:
+            print("[PBX] No page extension configured"); return False
+        ok = True
+        for pg in extensions:
+            cmd = (
+                "Action: Originate\n"
+                f"Channel: Local/{pg}@from-internal\n"
+                "Context: from-internal\n"
+                f"Exten: {pg}\n"
+                "Priority: 1\n"
+                "Async: true"
+            )
+            ok = ami_send(cmd) and ok
+        return ok
     except Exception as e:
         print(f"[PBX] Failed to page group: {e}")
-# ---------------- Cisco ----------------
-def _push_phone(ip, action, auth):
-    xml_url = f"{_public_url()}/xml/{action.lower()}"
-    execute_xml = (
-        "<CiscoIPPhoneExecute>\n"
-        '  <ExecuteItem URL="Play:tone.raw"/>\n'
-        f'  <ExecuteItem URL="{xml_url}"/>\n'
-        "</CiscoIPPhoneExecute>"
-    )
+        return False
+# ---------------- Async outbound loop ----------------
+import asyncio, base64, json, urllib.parse
+from collections import namedtuple
+AsyncResponse = namedtuple("AsyncResponse", "status headers body first_byte_at")
+class AsyncHTTP:
+    """Minimal HTTP/1.1 client for the outbound loop with per-host keep-alive reuse.
+
+    Only used from the loop thread, so the idle-connection cache needs no lock.
+    """
+    MAX_IDLE_PER_HOST = 128
+    def __init__(self):
+        self._idle = {}
+    async def request(self, method: str, url: str, body: bytes = b"", headers: dict = None,
+                      auth=None, timeout: float = 5.0) -> AsyncResponse:
+        u = urllib.parse.urlsplit(url)
+        secure = u.scheme == "https"
+        key = (u.scheme or "http", u.hostname, u.port or (443 if secure else 80))
+        path = (u.path or "/") + (f"?{u.query}" if u.query else "")
+        hdrs = {"Host": u.netloc, "User-Agent": "gschool-ems", "Connection": "keep-alive",
+                "Content-Length": str(len(body))}
+        if auth:
+            hdrs["Authorization"] = "Basic " + base64.b64encode(f"{auth[0]}:{auth[1]}".encode()).decode()
+        hdrs.update(headers or {})
+        head = f"{method} {path} HTTP/1.1\r\n" + "".join(f"{k}: {v}\r\n" for k, v in hdrs.items()) + "\r\n"
+        payload = head.encode("latin-1") + body
+        return await asyncio.wait_for(self._send(key, secure, payload), timeout)
+    async def _send(self, key, secure, payload):
+        idle = self._idle.get(key) or []
+        while idle:
+            reader, writer = idle.pop()
+            if reader.at_eof() or writer.is_closing():
+                writer.close(); continue
+            try:
+                return await self._exchange(key, reader, writer, payload)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()  # stale keep-alive connection; fall through to a fresh one
+        reader, writer = await asyncio.open_connection(key[1], key[2], ssl=ssl.create_default_context() if secure else None)
+        return await self._exchange(key, reader, writer, payload)
+    async def _exchange(self, key, reader, writer, payload):
+        try:
+            writer.write(payload)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError("connection closed before response")
+            first_byte_at = time.time()
+            status = int(status_line.split()[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                k, _, v = line.decode("latin-1").partition(":")
+                headers[k.strip().lower()] = v.strip()
+            reusable = headers.get("connection", "").lower() != "close"
+            if headers.get("transfer-encoding", "").lower() == "chunked":
+                chunks = []
+                while True:
+                    size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+                    if size == 0:
+                        await reader.readline()
+                        break
+                    chunks.append(await reader.readexactly(size))
+                    await reader.readline()
+                body = b"".join(chunks)
+            elif "content-length" in headers:
+                body = await reader.readexactly(int(headers["content-length"]))
+            else:
+                body = await reader.read()
+                reusable = False
+        except BaseException:
+            writer.close()
+            raise
+        idle = self._idle.setdefault(key, [])
+        if reusable and len(idle) < self.MAX_IDLE_PER_HOST:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+        return AsyncResponse(status, headers, body, first_byte_at)
+async def udp_send(host: str, port: int, payload: bytes):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
     try:
-        r = requests.post(
-            f"http://{ip}/CGI/Execute",
-            auth=auth,
-            data={"XML": execute_xml},
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            timeout=7
-        )
-        if r.status_code == 200 and "CiscoIPPhoneError" not in r.text:
-            print(f"[Cisco] OK {ip}"); return True, ip, None
-        return False, ip, f"HTTP {r.status_code} – {r.text.strip()}"
-    except requests.exceptions.RequestException as e:
-        return False, ip, str(e)
+        transport.sendto(payload)
+    finally:
+        transport.close()
+class OutboundLoop:
+    """One background asyncio event loop that carries outbound channel I/O as coroutines.
+
+    Any thread (Flask handlers, dispatch workers) can submit() a coroutine and
+    get a concurrent.futures.Future back, or run() it and block for the result.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self.http = AsyncHTTP()
+    def start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="outbound-loop", daemon=True).start()
+            self._loop = loop
+    def submit(self, coro):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+    def run(self, coro, timeout: float = None):
+        return self.submit(coro).result(timeout)
+OUTBOUND = OutboundLoop()
+# ---------------- Endpoint health ----------------
+class EndpointHealth:
+    """Rolling latency / error stats and a circuit breaker per outbound endpoint.
+
+    Endpoints are (channel, target) pairs: a phone IP, the AMI host, the SMTP
+    host, the Gotify or ClockWise server. After failure_threshold failures in
+    a row the breaker opens and calls are skipped at once. It reopens for a
+    single trial call (half-open) after open_secs, doubling up to
+    max_open_secs while the endpoint stays dead. Endpoints with a TCP address
+    are probed with a plain connect from a background thread instead of
+    spending a real alert on them. Timeouts adapt to observed latency:
+    timeout_multiplier x p99 of recent successes, kept between min_timeout
+    and the caller's configured timeout. Settings come from CFG["health"].
+    """
+    WINDOW = 100
+    MIN_SAMPLES = 20
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._prober = None
+    def _cfg(self) -> dict:
+        h = CFG.get("health", {}) or {}
+        return {
+            "enabled": bool(h.get("enabled", True)),
+            "failure_threshold": max(1, int(h.get("failure_threshold", 3))),
+            "open_secs": float(h.get("open_secs", 30)),
+            "max_open_secs": float(h.get("max_open_secs", 300)),
+            "timeout_multiplier": float(h.get("timeout_multiplier", 4)),
+            "min_timeout": float(h.get("min_timeout", 1.0)),
+            "probe_timeout": float(h.get("probe_timeout", 1.0)),
+        }
+    def _get(self, channel: str, target: str, probe=None) -> dict:
+        # caller holds self._lock
+        ep = self._endpoints.get((channel, target))
+        if ep is None:
+            ep = self._endpoints[(channel, target)] = {
+                "channel": channel, "target": target, "probe": probe,
+                "state": "closed", "latencies": deque(maxlen=self.WINDOW), "outcomes": deque(maxlen=self.WINDOW),
+                "ok": 0, "failed": 0, "skipped": 0, "consecutive": 0, "trial": False,
+                "open_secs": 0.0, "retry_at": 0.0, "last_ok": None, "last_error": "", "last_error_at": None,
+            }
+        elif probe is not None:
+            ep["probe"] = probe
+        return ep
+    def allow(self, channel: str, target: str, probe=None) -> bool:
+        """False while the endpoint's breaker is open; half-open lets one trial call through."""
+        cfg = self._cfg()
+        if not cfg["enabled"]:
+            return True
+        with self._lock:
+            ep = self._get(channel, target, probe)
+            if ep["state"] == "open" and time.time() >= ep["retry_at"] and ep["probe"] is None:
+                ep["state"] = "half_open"
+            if ep["state"] == "closed":
+                return True
+            if ep["state"] == "half_open" and not ep["trial"]:
+                ep["trial"] = True
+                return True
+            ep["skipped"] += 1
+            return False
+    def timeout(self, channel: str, target: str, default: float) -> float:
+        """Adaptive timeout: multiplier x p99 of recent successes, capped at default."""
+        cfg = self._cfg()
+        if not cfg["enabled"]:
+            return default
+        with self._lock:
+            ep = self._endpoints.get((channel, target))
+            if ep is None:
+                return default
+            if ep["state"] == "half_open":
+                return min(default, max(cfg["probe_timeout"], cfg["min_timeout"]))
+            samples = sorted(ep["latencies"])
+        if len(samples) < self.MIN_SAMPLES:
+            return default
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+        return min(default, max(cfg["min_timeout"], p99 * cfg["timeout_multiplier"]))
+    def record(self, channel: str, target: str, ok: bool, latency: float = None, error: str = ""):
+        """Record one call's outcome (latency in seconds) and move the breaker."""
+        cfg = self._cfg()
+        now = time.time()
+        opened = False
+        with self._lock:
+            ep = self._get(channel, target)
+            ep["outcomes"].append(bool(ok))
+            ep["trial"] = False
+            if ok:
+                ep["ok"] += 1
+                ep["consecutive"] = 0
+                ep["last_ok"] = now
+                if latency is not None:
+                    ep["latencies"].append(latency)
+                if ep["state"] != "closed":
+                    print(f"[Health] {channel} {target} recovered")
+                ep["state"], ep["open_secs"] = "closed", 0.0
+                return
+            ep["failed"] += 1
+            ep["consecutive"] += 1
+            ep["last_error"], ep["last_error_at"] = (error or "failed")[:200], now
+            if ep["state"] == "half_open" or ep["consecutive"] >= cfg["failure_threshold"]:
+                ep["open_secs"] = min(cfg["max_open_secs"], ep["open_secs"] * 2 or cfg["open_secs"])
+                ep["retry_at"] = now + ep["open_secs"]
+                if ep["state"] != "open":
+                    print(f"[Health] {channel} {target} circuit open for {ep['open_secs']:.0f}s: {ep['last_error']}")
+                ep["state"] = "open"
+                opened = ep["probe"] is not None
+        if opened:
+            self._ensure_prober()
+    def reset(self, channel: str = None, target: str = None):
+        """Close breakers by hand (e.g. after a phone was replaced); no args resets all."""
+        with self._lock:
+            for (ch, tg), ep in self._endpoints.items():
+                if (channel is None or ch == channel) and (target is None or tg == target):
+                    ep.update(state="closed", consecutive=0, open_secs=0.0, trial=False)
+    def _ensure_prober(self):
+        with self._lock:
+            if self._prober and self._prober.is_alive():
+                return
+            self._prober = threading.Thread(target=self._probe_loop, name="health-prober", daemon=True)
+            self._prober.start()
+    def _probe_loop(self):
+        while True:
+            time.sleep(1)
+            now = time.time()
+            with self._lock:
+                due = [ep for ep in self._endpoints.values()
+                       if ep["state"] == "open" and ep["probe"] is not None and now >= ep["retry_at"]]
+            timeout = self._cfg()["probe_timeout"]
+            for ep in due:
+                try:
+                    socket.create_connection(ep["probe"], timeout=timeout).close()
+                    reachable, err = True, ""
+                except OSError as e:
+                    reachable, err = False, f"probe: {e}"
+                with self._lock:
+                    if ep["state"] != "open":
+                        continue
+                    if reachable:
+                        # let the next real call confirm it
+                        ep["state"], ep["trial"] = "half_open", False
+                    else:
+                        ep["open_secs"] = min(self._cfg()["max_open_secs"], ep["open_secs"] * 2)
+                        ep["retry_at"] = time.time() + ep["open_secs"]
+                        ep["last_error"], ep["last_error_at"] = err[:200], time.time()
+    def snapshot(self) -> list:
+        """Per endpoint: breaker state, counts, error rate, p50 / p99 latency and current timeout."""
+        now = time.time()
+        with self._lock:
+            eps = [dict(ep, latencies=sorted(ep["latencies"]), outcomes=list(ep["outcomes"]))
+                   for ep in self._endpoints.values()]
+        out = []
+        for ep in eps:
+            lat = ep["latencies"]
+            def pct(p):
+                return round(lat[min(len(lat) - 1, int(len(lat) * p))] * 1000, 1) if lat else None
+            out.append({
+                "channel": ep["channel"], "target": ep["target"], "state": ep["state"],
+                "ok": ep["ok"], "failed": ep["failed"], "skipped": ep["skipped"],
+                "error_rate": round(ep["outcomes"].count(False) / len(ep["outcomes"]), 3) if ep["outcomes"] else 0.0,
+                "p50_ms": pct(0.5), "p99_ms": pct(0.99),
+                "retry_in": max(0, round(ep["retry_at"] - now)) if ep["state"] == "open" else None,
+                "last_ok": int(ep["last_ok"]) if ep["last_ok"] else None,
+                "last_error": ep["last_error"],
+                "last_error_at": int(ep["last_error_at"]) if ep["last_error_at"] else None,
+            })
+        out.sort(key=lambda e: ({"open": 0, "half_open": 1}.get(e["state"], 2), e["channel"], e["target"]))
+        return out
+HEALTH = EndpointHealth()
+def _endpoint_addr(url: str, default_port: int = 80):
+    """(host, port) of an http(s) URL for health probes, or None."""
+    try:
+        u = urllib.parse.urlsplit(url)
+        if not u.hostname:
+            return None
+        return (u.hostname, u.port or (443 if u.scheme == "https" else default_port))
+    except ValueError:
+        return None
+# ---------------- Cisco ----------------
 from concurrent.futures import ThreadPoolExecutor, as_completed
-def cisco_broadcast(action):
+class CiscoXML:
+    """Pre-rendered Cisco XML bodies, so neither a push nor a phone's callback renders anything.
+
+    Screens (CiscoIPPhoneText) are kept as bytes per action and, for alerts
+    with details, per (action, details) under a short key that the pushed
+    callback URL carries (/xml/<action>?k=<key>). push_bodies() builds the
+    url-encoded /CGI/Execute bodies once per broadcast for CFG["cisco"]
+    push_mode:
+      - callback (default): one Execute with the tone and the callback URL;
+        the phone then fetches the screen, served from memory.
+      - embed: the screen itself is POSTed to /CGI/Execute (firmware that
+        accepts pushed display objects), followed by the tone unless
+        embed_tone is off. No callback into the server at all.
+    """
+    MAX_VARIANTS = 64
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bodies = {}
+    @staticmethod
+    def key(action: str, details: str = "") -> str:
+        if not details:
+            return action.lower()
+        return f"{action.lower()}-{hashlib.sha1(details.encode('utf-8')).hexdigest()[:12]}"
+    @staticmethod
+    def _render(action: str, details: str = "") -> bytes:
+        _, pretty, directive = default_copy(action)
+        text = f"{action} - {directive}" + (f"\n{details}" if details else "")
+        return (
+            '<?xml version="1.0"?>\n'
+            "<CiscoIPPhoneText>\n"
+            "  <Title>G School Alerts</Title>\n"
+            f"  <Prompt>{action}</Prompt>\n"
+            f"  <Text>{_xml_escape(text)}</Text>\n"
+            "</CiscoIPPhoneText>"
+        ).encode("utf-8")
+    def screen(self, action: str, details: str = ""):
+        """(key, body bytes) for this action / details, rendered at most once."""
+        key = self.key(action, details)
+        body = self._bodies.get(key)
+        if body is None:
+            body = self._render(action, details)
+            with self._lock:
+                bodies = dict(self._bodies)
+                if len(bodies) >= self.MAX_VARIANTS + len(ALLOWED):
+                    # drop the oldest details variant; plain screens stay
+                    oldest = next((k for k in bodies if "-" in k), None)
+                    bodies.pop(oldest, None)
+                bodies[key] = body
+                self._bodies = bodies
+        return key, body
+    def get(self, key: str):
+        return self._bodies.get(key)
+    def lookup(self, action: str, key: str):
+        """Screen for a callback key, or None if the key is unknown.
+
+        Details variants are only cached by the worker that ran the push; any
+        other worker rebuilds the variant from the active alert (shared state)
+        when its details hash to the same key.
+        """
+        body = self._bodies.get(key) if key.split("-")[0] == action.lower() else None
+        if body is None and key != action.lower():
+            alert = STORE.alert
+            details = alert.get("details") or ""
+            if details and (alert.get("action") or "").upper() == action and self.key(action, details) == key:
+                body = self.screen(action, details)[1]
+        return body
+    def warm(self):
+        """Render every plain action screen up front."""
+        for action in ALLOWED:
+            self.screen(action)
+    def push_bodies(self, action: str, details: str = "", cisco: dict = None) -> list:
+        cisco = cisco if cisco is not None else (CFG.get("cisco", {}) or {})
+        tone = cisco.get("tftp_audio") or "tone.raw"
+        key, screen = self.screen(action, details)
+        play = f'  <ExecuteItem URL="Play:{_xml_escape(tone)}"/>\n'
+        if (cisco.get("push_mode") or "callback").lower() == "embed":
+            bodies = [screen.decode("utf-8")]
+            if cisco.get("embed_tone", True):
+                bodies.append("<CiscoIPPhoneExecute>\n" + play + "</CiscoIPPhoneExecute>")
+        else:
+            xml_url = f"{_public_url()}/xml/{action.lower()}" + (f"?k={key}" if details else "")
+            bodies = ["<CiscoIPPhoneExecute>\n" + play +
+                      f'  <ExecuteItem URL="{_xml_escape(xml_url)}"/>\n' + "</CiscoIPPhoneExecute>"]
+        return [urllib.parse.urlencode({"XML": b}).encode() for b in bodies]
+CISCO_XML = CiscoXML()
+class CiscoPusher:
+    """Process-wide Cisco push subsystem.
+
+    Pushes run as coroutines on the outbound loop, bounded by a semaphore and
+    sharing its keep-alive connections. Settings come from CFG["cisco"]:
+    concurrency (default 64 in flight), timeout per phone (default 7s,
+    counted from when that phone's push starts) and retry (one extra pass
+    over failed phones, default on). Each broadcast keeps its own progress
+    counters, so one that preempts another doesn't reset the other's.
+    """
+    KEEP_RUNS = 8
+    IDLE_PROGRESS = {"action": None, "priority": None, "started_at": None, "finished_at": None,
+                     "total": 0, "pushed": 0, "failed": 0, "pending": 0, "pass": 0}
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs = deque(maxlen=self.KEEP_RUNS)
+    def _count(self, progress: dict, **delta):
+        with self._lock:
+            for k, v in delta.items():
+                progress[k] += v
+    def snapshot(self, all_runs: bool = False):
+        """Counters of the latest broadcast (or of the last few, newest first)."""
+        with self._lock:
+            if all_runs:
+                return [dict(p) for p in reversed(self._runs)]
+            return dict(self._runs[-1]) if self._runs else dict(self.IDLE_PROGRESS)
+    def broadcast(self, action: str, phones, auth, concurrency: int = 64, timeout: float = 7, retry: bool = True,
+                  details: str = "") -> dict:
+        handle = current_dispatch()
+        phones = list(dict.fromkeys(phones))
+        # rendered and encoded once for every phone
+        bodies = CISCO_XML.push_bodies(action, details)
+        return OUTBOUND.run(self._broadcast(handle, action, bodies, phones, auth, max(1, int(concurrency)), timeout, retry))
+    async def _broadcast(self, handle, action, bodies, phones, auth, concurrency, timeout, retry) -> dict:
+        progress = {"action": action, "priority": getattr(handle, "priority", None), "started_at": time.time(),
+                    "finished_at": None, "total": len(phones), "pushed": 0, "failed": 0, "pending": len(phones), "pass": 1}
+        with self._lock:
+            self._runs.append(progress)
+        sem = asyncio.Semaphore(concurrency)
+        async def push(ip):
+            async with sem:
+                attempt = DeliveryAttempt("cisco", ip, handle)
+                if DISPATCH.preempted(handle):
+                    # a more urgent alert is on its way to the phones; don't overwrite it
+                    attempt.finish(False, "preempted")
+                    return False, ip, "preempted"
+                # the deadline runs from this phone's start, not the pass's, so queued phones keep theirs
+                deadline = timeout * len(bodies) + 2
+                try:
+                    return await asyncio.wait_for(_push_phone(ip, bodies, auth, attempt, timeout), deadline)
+                except asyncio.TimeoutError:
+                    err = f"no answer within {deadline:.0f}s"
+                    attempt.finish(False, err)
+                    return False, ip, err
+        failures = {}
+        todo = phones
+        for attempt_pass in (1, 2) if retry else (1,):
+            if not todo or DISPATCH.preempted(handle):
+                break
+            if attempt_pass == 2:
+                print(f"[Cisco] retrying {len(todo)} phone(s)")
+                with self._lock:
+                    progress["pass"] = 2
+            results = await asyncio.gather(*(push(ip) for ip in todo))
+            todo = []
+            for ok, ip, err in results:
+                if ok:
+                    failures.pop(ip, None)
+                    self._count(progress, pushed=1, pending=-1)
+                else:
+                    failures[ip] = err
+                    todo.append(ip)
+        self._count(progress, failed=len(failures), pending=-len(failures))
+        with self._lock:
+            progress["finished_at"] = time.time()
+            result = dict(progress)
+        for ip, err in failures.items():
+            print(f"[Cisco] push failed for {ip}: {err}")
+        print(f"[Cisco] {result['pushed']}/{result['total']} phones pushed in "
+              f"{(result['finished_at'] - result['started_at']) * 1000:.0f} ms")
+        return result
+CISCO = CiscoPusher()
+async def _push_phone(ip, bodies, auth, attempt=None, timeout: float = 7):
+    """POST each pre-encoded body (see CiscoXML.push_bodies) to the phone's /CGI/Execute in turn."""
+    attempt = attempt or DeliveryAttempt("cisco", ip)
+    # unplugged phones are skipped instead of costing a full timeout on every alert
+    if not HEALTH.allow("cisco", ip, _endpoint_addr(f"http://{ip}/")):
+        attempt.finish(False, "circuit open")
+        return False, ip, "circuit open"
+    started = time.perf_counter()
+    try:
+        for body in bodies:
+            try:
+                r = await OUTBOUND.http.request(
+                    "POST", f"http://{ip}/CGI/Execute", body=body,
+                    headers={"Content-Type": "application/x-www-form-urlencoded"},
+                    auth=auth, timeout=HEALTH.timeout("cisco", ip, timeout),
+                )
+            except Exception as e:
+                HEALTH.record("cisco", ip, False, error=str(e) or type(e).__name__)
+                raise
+            if attempt.first_byte_at is None:
+                attempt.first_byte(r.first_byte_at)
+            text = r.body.decode("utf-8", errors="replace")
+            if r.status != 200 or "CiscoIPPhoneError" in text:
+                HEALTH.record("cisco", ip, True, time.perf_counter() - started)
+                err = f"HTTP {r.status} – {text.strip()}"
+                attempt.finish(False, err)
+                return False, ip, err
+        HEALTH.record("cisco", ip, True, time.perf_counter() - started)
+        print(f"[Cisco] OK {ip}"); attempt.finish(True); return True, ip, None
+    except Exception as e:
+        err = str(e) or type(e).__name__
+        attempt.finish(False, err)
+        return False, ip, err
+def cisco_broadcast(action, zone: str = "ALL", details: str = ""):
     try:
         cisco = CFG.get("cisco", {})
         if not cisco.get("enabled", True): print("[Cisco] Disabled"); return
-        phones = cisco.get("phones", [])
+        phones = ZONES.route(zone).phones
         if not phones: print("[Cisco] No phones"); return
-        auth = (cisco.get("username","admin"), cisco.get("password","admin"))
+        auth = CFG.cisco_auth
         print("[Cisco] Triggering phones first...")
-        with ThreadPoolExecutor(max_workers=min(8,len(phones) or 1)) as ex:
-            futs = [ex.submit(_push_phone, ip, action, auth) for ip in phones]
-            for fut in as_completed(futs):
-                ok, ip, err = fut.result()
-                if not ok: print(f"[Cisco] push failed for {ip}: {err}")
+        result = CISCO.broadcast(
+            action, phones, auth,
+            concurrency=int(cisco.get("concurrency", 64)),
+            timeout=float(cisco.get("timeout", 7)),
+            retry=bool(cisco.get("retry", True)),
+            details=details,
+        )
+        return result["failed"] == 0
     except Exception as e:
         print(f"[Cisco] broadcast failed: {e}")
+        return False
+@app.get("/api/cisco/progress")
+def api_cisco_progress():
+    """Pushed / failed / pending counters for the current (or last) Cisco broadcast; ?all=1 for the last few."""
+    if request.args.get("all"):
+        return jsonify({"broadcasts": CISCO.snapshot(all_runs=True)})
+    return jsonify(CISCO.snapshot())
+# ---------------- Zone routing ----------------
+from types import MappingProxyType
+ZoneRoute = namedtuple("ZoneRoute", "zone path displays phones page_extensions clockwise_payloads")
+# panels used when nothing in the config names any
+DEFAULT_DISPLAYS = ("display-1", "display-2")
+class ZoneRouter:
+    """Zone -> target devices, compiled once from CFG["zones"] into a read-only table.
+
+    A zone may list displays, phones (Cisco IPs), page_extension(s) and a
+    clockwise_suffix, and may sit under another zone, either with
+    parent: NAME or nested under children:. An alert for a zone reaches the
+    zone and everything below it (building > wing > room). Target types that
+    the subtree does not list come from the nearest parent that has some, then
+    from the ALL route, so an unmapped zone still reaches everyone. ALL is ALL's own entry plus the global
+    cisco.phones / asterisk.page_extension and every zone's devices. Unknown
+    zones route to ALL. Call rebuild() after changing the config.
+    """
+    def __init__(self):
+        self._table = None
+    @staticmethod
+    def _list(value) -> list:
+        if value is None or value == "":
+            return []
+        if isinstance(value, (list, tuple)):
+            return [str(v).strip() for v in value if str(v).strip()]
+        return [str(value).strip()]
+    def _flatten(self, zones: dict, parent=None, out=None) -> dict:
+        out = {} if out is None else out
+        for name, zc in (zones or {}).items():
+            name = str(name).upper().strip()
+            zc = zc if isinstance(zc, Mapping) else {}
+            out[name] = {
+                "parent": str(zc.get("parent") or parent or "").upper().strip() or None,
+                "displays": self._list(zc.get("displays")),
+                "phones": self._list(zc.get("phones")),
+                "page_extensions": self._list(zc.get("page_extensions", zc.get("page_extension"))),
+                "clockwise_suffix": zc.get("clockwise_suffix"),
+            }
+            if isinstance(zc.get("children"), Mapping):
+                self._flatten(zc["children"], name, out)
+        return out
+    def compile(self, cfg: dict):
+        zones = self._flatten(cfg.get("zones") or {})
+        children = {}
+        for name, z in zones.items():
+            if z["parent"] and z["parent"] != name and z["parent"] in zones:
+                children.setdefault(z["parent"], []).append(name)
+        def subtree(name):
+            seen, todo = [], [name]
+            while todo:
+                n = todo.pop()
+                if n not in seen:
+                    seen.append(n)
+                    todo.extend(children.get(n, []))
+            return seen
+        def ancestry(name):
+            # name, its parent, grandparent, ... (cycle-safe)
+            parts, n = [], name
+            while n and n in zones and n not in parts:
+                parts.append(n)
+                n = zones[n]["parent"]
+            return parts
+        def union(names, key):
+            return list(dict.fromkeys(v for n in names for v in zones[n][key]))
+        cw = cfg.get("clockwise", {}) or {}
+        triggers = cw.get("triggers", {}) or {}
+        suffixes = {str(k).upper(): v for k, v in (cw.get("zone_suffix", {}) or {}).items()}
+        actions = list(ALERTS) + ["RESOLUTION"]
+        def payloads(name):
+            # own suffix, else the nearest parent's
+            suffix = ""
+            for n in ancestry(name) or [name]:
+                own = zones[n]["clockwise_suffix"] if n in zones else None
+                if own is None:
+                    own = suffixes.get(n)
+                if own is not None:
+                    suffix = own
+                    break
+            return MappingProxyType({a: f"{triggers.get(a, a)}{suffix}" for a in actions})
+        everything = list(zones)
+        all_own = zones.get("ALL", {"displays": [], "phones": [], "page_extensions": []})
+        every = {
+            "displays": list(dict.fromkeys(all_own["displays"] + union(everything, "displays"))) or list(DEFAULT_DISPLAYS),
+            "phones": list(dict.fromkeys(all_own["phones"] + self._list((cfg.get("cisco", {}) or {}).get("phones"))
+                                         + union(everything, "phones"))),
+            "page_extensions": list(dict.fromkeys(
+                all_own["page_extensions"] + self._list((cfg.get("asterisk", {}) or {}).get("page_extension"))
+                + union(everything, "page_extensions"))),
+        }
+        table = {"ALL": ZoneRoute("ALL", "ALL", tuple(every["displays"]), tuple(every["phones"]),
+                                  tuple(every["page_extensions"]), payloads("ALL"))}
+        def targets(name, key):
+            # nearest zone up the chain whose subtree lists this target type, else ALL
+            for n in ancestry(name):
+                found = union(subtree(n), key)
+                if found:
+                    return tuple(found)
+            return tuple(every[key])
+        for name in zones:
+            if name == "ALL":
+                continue
+            route = ZoneRoute(name, "/".join(reversed(ancestry(name))),
+                              *(targets(name, key) for key in ("displays", "phones", "page_extensions")),
+                              payloads(name))
+            table[name] = route
+            table.setdefault(route.path, route)
+        for name in suffixes:
+            # a zone only named in clockwise.zone_suffix (the dashboard zone is free text):
+            # every ALL target, with its own ClockWise suffix
+            if name not in table:
+                table[name] = ZoneRoute(name, name, *table["ALL"][2:5], payloads(name))
+        return MappingProxyType(table)
+    def rebuild(self):
+        self._table = self.compile(CFG)
+        return self._table
+    def route(self, zone: str) -> ZoneRoute:
+        table = self._table if self._table is not None else self.rebuild()
+        zone = (zone or "ALL").upper().strip()
+        return table.get(zone) or table["ALL"]
+    def table(self):
+        return self._table if self._table is not None else self.rebuild()
+ZONES = ZoneRouter()
+CONFIG.on_change(lambda snap: ZONES.rebuild())
+# ---------------- Dispatch engine ----------------
+# Channels are launched in this order (Cisco -> PBX -> RSS -> Email -> ...).
+ALERT_CHANNELS = ["cisco", "pbx", "rss", "email", "gotify", "clockwise", "displays"]
+# Worker threads per channel queue; override with CFG["dispatch"]["workers"].
+DISPATCH_WORKERS = {"cisco": 2, "pbx": 1, "rss": 1, "email": 2, "gotify": 2, "clockwise": 2, "displays": 1}
+# Seconds a job may spend queued + running before the handle reports it as timed out;
+# override with CFG["dispatch"]["deadlines"].
+DISPATCH_DEADLINES = {"cisco": 30, "pbx": 10, "rss": 2, "email": 30, "gotify": 10, "clockwise": 5, "displays": 2}
+# Priority classes, most urgent first. Queued work always runs in this order.
+PRIORITY_CLASSES = ("LIVE", "RESOLUTION", "DRILL", "ANNOUNCEMENT")
+PRIORITY_RANK = {cls: rank for rank, cls in enumerate(PRIORITY_CLASSES)}
+# Channels whose output replaces what people see or hear (phone screens, pages,
+# panels): lower-priority work here is dropped once a more urgent fan-out starts
+# instead of running after it. Other channels just wait their turn.
+DISPATCH_PREEMPTIBLE = {"cisco", "pbx", "clockwise", "displays"}
+import heapq, itertools
+from concurrent.futures import Future
+class PriorityExecutor:
+    """Worker threads draining one heap of jobs: most urgent class first, FIFO within a class.
+
+    Threads are started on demand (and again after a fork), like
+    ThreadPoolExecutor. Queue depth and wait time are tracked per class.
+    """
+    def __init__(self, workers: int, name: str):
+        self.workers = max(1, int(workers))
+        self.name = name
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._threads = []
+        self._idle = 0
+        self._pid = os.getpid()
+        self._stats = {cls: {"queued": 0, "running": 0, "done": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+                       for cls in PRIORITY_CLASSES}
+    def submit(self, priority: str, func, *args, **kwargs) -> Future:
+        priority = priority if priority in PRIORITY_RANK else "DRILL"
+        fut = Future()
+        with self._cond:
+            if self._pid != os.getpid():
+                # forked: the parent's threads do not exist here
+                self._pid, self._threads, self._idle, self._heap = os.getpid(), [], 0, []
+            heapq.heappush(self._heap, (PRIORITY_RANK[priority], next(self._seq), time.perf_counter(),
+                                        priority, fut, func, args, kwargs))
+            self._stats[priority]["queued"] += 1
+            self._threads = [t for t in self._threads if t.is_alive()]
+            # idle workers already notified still count in _idle until they wake, but their
+            # jobs are still in the heap too; spawn while queued jobs outnumber idle workers
+            if len(self._heap) > self._idle and len(self._threads) < self.workers:
+                t = threading.Thread(target=self._work, name=f"{self.name}-{len(self._threads)}", daemon=True)
+                self._threads.append(t)
+                t.start()
+            self._cond.notify()
+        return fut
+    def _work(self):
+        me = threading.current_thread()
+        while True:
+            with self._cond:
+                self._idle += 1
+                while not self._heap:
+                    self._cond.wait()
+                self._idle -= 1
+                if len(self._threads) > self.workers and me in self._threads:
+                    # shrunk by a config change
+                    self._threads.remove(me)
+                    self._cond.notify()
+                    return
+                _, _, queued_at, priority, fut, func, args, kwargs = heapq.heappop(self._heap)
+                waited = (time.perf_counter() - queued_at) * 1000
+                st = self._stats[priority]
+                st["queued"] -= 1
+                st["running"] += 1
+                st["wait_ms_total"] += waited
+                st["wait_ms_max"] = max(st["wait_ms_max"], waited)
+            if fut.set_running_or_notify_cancel():
+                try:
+                    fut.set_result(func(*args, **kwargs))
+                except BaseException as e:
+                    fut.set_exception(e)
+            with self._cond:
+                st["running"] -= 1
+                st["done"] += 1
+    def stats(self) -> dict:
+        """Per class: queued, running, done and mean / max queue wait in ms."""
+        with self._cond:
+            out = {}
+            for cls, st in self._stats.items():
+                started = st["done"] + st["running"]
+                out[cls] = {
+                    "queued": st["queued"], "running": st["running"], "done": st["done"],
+                    "wait_ms_avg": round(st["wait_ms_total"] / started, 1) if started else 0.0,
+                    "wait_ms_max": round(st["wait_ms_max"], 1),
+                }
+            return out
+class DispatchPreempted(Exception):
+    """Raised in place of a job that a more urgent fan-out made obsolete."""
+class DispatchHandle:
+    """One alert's fan-out: a future, a deadline and timings per channel."""
+    def __init__(self, label: str, priority: str = "DRILL"):
+        self.label = label
+        self.priority = priority if priority in PRIORITY_RANK else "DRILL"
+        self.rank = PRIORITY_RANK[self.priority]
+        self.alert_id = None
+        self.created_at = time.time()
+        self.launched_ms = None
+        self.futures = {}
+        self.deadlines = {}
+        self.timings = {}
+        self.enqueued_at = {}
+        self._t0 = time.perf_counter()
+    def _mark(self, channel: str, key: str):
+        self.timings.setdefault(channel, {})[key] = round((time.perf_counter() - self._t0) * 1000, 1)
+    def status(self, channel: str) -> str:
+        fut = self.futures.get(channel)
+        if fut is None:
+            return "skipped"
+        if not fut.done():
+            if time.monotonic() > self.deadlines.get(channel, float("inf")):
+                return "timeout"
+            return "running" if "started_ms" in self.timings.get(channel, {}) else "queued"
+        if fut.cancelled():
+            return "cancelled"
+        exc = fut.exception()
+        if isinstance(exc, TimeoutError):
+            return "timeout"
+        if isinstance(exc, DispatchPreempted):
+            return "preempted"
+        if exc is not None or fut.result() is False:
+            return "failed"
+        return "ok"
+    def wait(self, timeout: float = None) -> bool:
+        """Block until every channel finishes or hits its deadline. True if all finished."""
+        end = time.monotonic() + timeout if timeout is not None else None
+        for channel, fut in list(self.futures.items()):
+            limit = self.deadlines.get(channel)
+            if end is not None:
+                limit = min(limit, end) if limit is not None else end
+            try:
+                fut.result(timeout=None if limit is None else max(0.0, limit - time.monotonic()))
+            except Exception:
+                pass
+        return all(f.done() for f in self.futures.values())
+    def summary(self) -> dict:
+        return {
+            "label": self.label,
+            "priority": self.priority,
+            "alert_id": self.alert_id,
+            "created_at": int(self.created_at),
+            "launched_ms": self.launched_ms,
+            "channels": {
+                ch: dict(self.timings.get(ch, {}), status=self.status(ch))
+                for ch in self.futures
+            },
+        }
+class DispatchEngine:
+    """Long-lived, bounded worker pools with one priority queue per outbound channel."""
+    def __init__(self, workers: dict, deadlines: dict):
+        self.deadlines = dict(deadlines)
+        self._pools = {ch: PriorityExecutor(n, f"dispatch-{ch}") for ch, n in workers.items()}
+        # perf_counter start of the newest fan-out per priority class
+        self._latest = [0.0] * len(PRIORITY_CLASSES)
+    def begin(self, handle: DispatchHandle):
+        """Mark handle's fan-out as started; less urgent fan-outs started before it are preempted."""
+        self._latest[handle.rank] = max(self._latest[handle.rank], handle._t0)
+    def preempted(self, handle) -> bool:
+        """True once a more urgent fan-out started after handle's."""
+        if handle is None:
+            return False
+        return any(t > handle._t0 for t in self._latest[:handle.rank])
+    def stats(self) -> dict:
+        return {ch: pool.stats() for ch, pool in self._pools.items()}
+    def submit(self, handle: DispatchHandle, channel: str, func, *args, **kwargs):
+        deadline = time.monotonic() + float(self.deadlines.get(channel, 30))
+        handle.deadlines[channel] = deadline
+        handle.enqueued_at[channel] = time.time()
+        handle._mark(channel, "queued_ms")
+        def run():
+            # channel-level ledger row (target "*"); per-target rows come from the channel itself
+            attempt = DeliveryAttempt(channel, "*", handle)
+            if time.monotonic() > deadline:
+                print(f"[Dispatch] {channel} for {handle.label} dropped: deadline passed in queue")
+                attempt.finish(False, "deadline passed before start")
+                raise TimeoutError(f"{channel} deadline passed before start")
+            if channel in DISPATCH_PREEMPTIBLE and self.preempted(handle):
+                print(f"[Dispatch] {channel} for {handle.label} dropped: preempted by a more urgent alert")
+                attempt.finish(False, "preempted")
+                raise DispatchPreempted(f"{channel} preempted")
+            handle._mark(channel, "started_ms")
+            _DISPATCH_CTX.handle = handle
+            ok, error = True, ""
+            try:
+                result = func(*args, **kwargs)
+                ok = result is not False
+                return result
+            except Exception as e:
+                ok, error = False, str(e)
+                print(f"[Background error in {func.__name__}] {e}")
+                raise
+            finally:
+                _DISPATCH_CTX.handle = None
+                handle._mark(channel, "finished_ms")
+                attempt.finish(ok, error)
+        self.begin(handle)
+        fut = self._pools[channel].submit(handle.priority, run)
+        handle.futures[channel] = fut
+        return fut
+def _dispatch_settings():
+    dcfg = CFG.get("dispatch", {}) or {}
+    workers = dict(DISPATCH_WORKERS, **(dcfg.get("workers") or {}))
+    deadlines = dict(DISPATCH_DEADLINES, **(dcfg.get("deadlines") or {}))
+    return workers, deadlines
+DISPATCH = DispatchEngine(*_dispatch_settings())
+def _alert_priority(mode: str) -> str:
+    return "LIVE" if (mode or "").upper() == "LIVE" else "DRILL"
+# handle of the most recent alert fan-out (see /api/dispatch/last)
+LAST_DISPATCH = None
+def _show_alert_on_displays(mode: str, action: str, zone: str, details: str = ""):
+    """Update display state so LED panels can show the alert text."""
+    state = {"mode": "ALERT", "text": (f"{mode} {action} – {details}" if details else f"{mode} {action}")[:64]}
+    STORE.set_displays({display_id: state for display_id in ZONES.route(zone).displays})
+def dispatch_alert(mode: str, action: str, zone: str = "ALL", details: str = "", severity: str = "",
+                   initiator: str = "Unknown", channels=None) -> DispatchHandle:
+    """Queue every alert channel on the dispatch engine and return the handle."""
+    global LAST_DISPATCH
+    handle = DispatchHandle(f"{mode} {action}", priority=_alert_priority(mode))
+    gotify_msg = f"{mode} {action} triggered by {initiator}" + (f" | Severity: {severity}" if severity else "") + (f" | {details}" if details else "")
+    jobs = {
+        "cisco": (cisco_broadcast, (action, zone, details)),
+        "pbx": (page_group, (zone,)),
+        "rss": (update_rss_token, (action,)),
+        "email": (send_email, (mode, action, details)),
+        "gotify": (send_gotify, (gotify_msg, f"{_service_name()} Alert: {action}")),
+        "clockwise": (clockwise_udp_trigger, (action, zone)),
+        "displays": (_show_alert_on_displays, (mode, action, zone, details)),
+    }
+    for channel in ALERT_CHANNELS:
+        if channels is not None and channel not in channels:
+            continue
+        func, args = jobs[channel]
+        try:
+            DISPATCH.submit(handle, channel, func, *args)
+        except Exception as e:
+            print(f"[Dispatch] {channel} failed to queue: {e}")
+    handle.launched_ms = round((time.perf_counter() - handle._t0) * 1000, 1)
+    print(f"[Dispatch] {handle.label}: {len(handle.futures)} channels launched in {handle.launched_ms} ms")
+    LAST_DISPATCH = handle
+    return handle
+def activate_alert(mode: str, action: str, zone: str = "ALL", details: str = "", severity: str = "",
+                   initiator: str = "Unknown", created_by: str = "", total_acks=None, channels=None) -> DispatchHandle:
+    """Fan out a new alert, then publish it to the state store and alerts_history.
+
+    With a shared state backend only the leader fans out; other workers
+    record and publish the alert and forward the dispatch to it.
+    """
+    forward = not BACKEND.is_leader()
+    if forward:
+        handle = DispatchHandle(f"{mode} {action}", priority=_alert_priority(mode))
+    else:
+        handle = dispatch_alert(mode, action, zone, details, severity, initiator, channels)
+    # Web banner for dashboards
+    broadcast_web_banner(action, mode)
+    # Persist into alerts_history first so the published alert carries its id
+    # (acks are keyed by it)
+    started_at = int(time.time())
+    try:
+        conn = db(); c = conn.cursor()
+        c.execute(
+            "INSERT INTO alerts_history (mode, action, text, details, severity, zone, started_at, resolved_at, resolved_by, total_acks) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (mode, action, f"{mode} {action}", details, severity, zone, started_at, None, created_by, total_acks),
+        )
+        handle.alert_id = c.lastrowid
+        c.execute("INSERT INTO alert_initiators (alert_id, initiator, created_by, source, ts) VALUES (?, ?, ?, ?, ?)",
+                  (handle.alert_id, initiator, created_by, "trigger", started_at))
+        conn.commit(); conn.close()
+    except Exception as e:
+        print(f"[alerts_history] insert failed: {e}")
+    if forward:
+        BACKEND.send("dispatch", {
+            "mode": mode, "action": action, "zone": zone, "details": details, "severity": severity,
+            "initiator": initiator, "channels": channels, "alert_id": handle.alert_id,
+        })
+    # Update latest alert for API consumers (Chrome extension, PWA, etc.)
+    # A new alert id starts with an empty ack set.
+    STORE.set_alert({
+        "id": handle.alert_id,
+        "mode": mode,
+        "action": action,
+        "text": f"{mode} {action}",
+        "details": details,
+        "severity": severity,
+        "timestamp": started_at,
+        "zone": zone,
+        "initiators": [initiator],
+    })
+    return handle
+def _forwarded_dispatch(payload: dict):
+    """Leader side of a dispatch forwarded by another worker."""
+    handle = dispatch_alert(payload["mode"], payload["action"], payload.get("zone") or "ALL",
+                            payload.get("details") or "", payload.get("severity") or "",
+                            payload.get("initiator") or "Unknown", payload.get("channels"))
+    handle.alert_id = payload.get("alert_id")
+# ---------------- Trigger de-duplication ----------------
+# A trigger matching the active alert's (mode, action, zone) within this many
+# seconds of it joins that alert instead of dispatching again;
+# override with CFG["dispatch"]["coalesce_secs"] (0 turns it off).
+COALESCE_SECS = 60
+# How long /trigger remembers an idempotency key.
+IDEMPOTENCY_TTL = 24 * 3600
+_TRIGGER_LOCK = threading.Lock()
+def _coalesce_secs() -> int:
+    try:
+        return int((CFG.get("dispatch", {}) or {}).get("coalesce_secs", COALESCE_SECS))
+    except (TypeError, ValueError):
+        return COALESCE_SECS
+def _trigger_key(key: str, mode: str, action: str, zone: str) -> str:
+    # one page key is shared by every button on it, so a claim covers only the exact request;
+    # escalating HOLD -> LOCKDOWN or DRILL -> LIVE from the same page is a new claim
+    return f"{key}|{mode}|{action}|{zone}"
+def _claim_trigger_key(key: str, mode: str, action: str, zone: str):
+    """Claim an idempotency key for (mode, action, zone). Returns (claimed, alert_id of an earlier claim)."""
+    now = int(time.time())
+    key = _trigger_key(key, mode, action, zone)
+    conn = db(); c = conn.cursor()
+    try:
+        c.execute("DELETE FROM trigger_keys WHERE created_at < ?", (now - IDEMPOTENCY_TTL,))
+        # the primary key makes the claim atomic across workers
+        c.execute("INSERT OR IGNORE INTO trigger_keys (key, alert_id, created_at, mode, action, zone) "
+                  "VALUES (?, NULL, ?, ?, ?, ?)", (key, now, mode, action, zone))
+        claimed = c.rowcount == 1
+        row = None if claimed else c.execute("SELECT alert_id FROM trigger_keys WHERE key=?", (key,)).fetchone()
+        conn.commit()
+        return claimed, (row[0] if row else None)
+    finally:
+        conn.close()
+def _release_trigger_key(key: str, mode: str, action: str, zone: str):
+    """Forget a claim whose alert never started, so a retry is not swallowed as a duplicate."""
+    try:
+        conn = db()
+        conn.execute("DELETE FROM trigger_keys WHERE key=? AND alert_id IS NULL", (_trigger_key(key, mode, action, zone),))
+        conn.commit(); conn.close()
+    except Exception as e:
+        print(f"[Trigger] idempotency key release failed: {e}")
+def _coalesce_target(mode: str, action: str, zone: str):
+    """The active alert an identical trigger should join, or None."""
+    window = _coalesce_secs()
+    alert = STORE.alert
+    if window <= 0 or not alert.get("id"):
+        return None
+    if (alert.get("mode"), alert.get("action"), alert.get("zone")) != (mode, action, zone):
+        return None
+    if time.time() - (alert.get("timestamp") or 0) > window:
+        return None
+    return alert
+def trigger_alert(mode: str, action: str, zone: str = "ALL", details: str = "", severity: str = "",
+                  initiator: str = "Unknown", created_by: str = "", key: str = ""):
+    """Trigger an alert unless it duplicates one already in flight.
+
+    Returns (outcome, alert_id) with outcome "sent", "joined" (coalesced into
+    the active alert; the initiator is recorded) or "duplicate" (idempotency
+    key seen before for the same mode, action and zone; nothing happens).
+    """
+    with _TRIGGER_LOCK:
+        if key:
+            claimed, alert_id = _claim_trigger_key(key, mode, action, zone)
+            if not claimed:
+                print(f"[Trigger] duplicate submission {key[:12]} ignored")
+                return "duplicate", alert_id
+        target = _coalesce_target(mode, action, zone)
+        if target is not None:
+            alert_id = target["id"]
+            try:
+                conn = db()
+                conn.execute("INSERT INTO alert_initiators (alert_id, initiator, created_by, source, ts) VALUES (?, ?, ?, ?, ?)",
+                             (alert_id, initiator, created_by, "coalesced", int(time.time())))
+                conn.commit(); conn.close()
+            except Exception as e:
+                print(f"[Trigger] initiator insert failed: {e}")
+            initiators = list(target.get("initiators") or [])
+            if initiator not in initiators:
+                STORE.update_alert(initiators=initiators + [initiator])
+            print(f"[Trigger] {mode} {action} by {initiator} joined alert {alert_id}")
+            outcome = "joined"
+        else:
+            try:
+                alert_id = activate_alert(mode, action, zone, details, severity,
+                                          initiator=initiator, created_by=created_by).alert_id
+            except Exception:
+                if key:
+                    _release_trigger_key(key, mode, action, zone)
+                raise
+            outcome = "sent"
+        if key:
+            try:
+                conn = db()
+                conn.execute("UPDATE trigger_keys SET alert_id=? WHERE key=?", (alert_id, _trigger_key(key, mode, action, zone)))
+                conn.commit(); conn.close()
+            except Exception as e:
+                print(f"[Trigger] idempotency key update failed: {e}")
+        return outcome, alert_id
+@app.get("/api/dispatch/last")
+def api_dispatch_last():
+    """Per-channel status and timings of the most recent alert fan-out."""
+    if LAST_DISPATCH is None:
+        return jsonify({"label": None, "channels": {}})
+    return jsonify(LAST_DISPATCH.summary())
+@app.get("/api/dispatch/queues")
+def api_dispatch_queues():
+    """Queue depth, running jobs and queue wait per channel and priority class."""
+    return jsonify({"classes": list(PRIORITY_CLASSES), "channels": DISPATCH.stats(), "email_batches": SMTP_POOL.stats()})
+# ---------------- Delivery ledger ----------------
+class DeliveryLedger:
+    """Single background writer that batches delivery_attempts rows into SQLite.
+
+    Rows reference the DispatchHandle rather than an alert id because channels
+    start before the alerts_history row exists; the writer holds a row back
+    until its handle has an id (or gives up after ORPHAN_SECS).
+    """
+    BATCH_SIZE = 500
+    FLUSH_SECS = 0.25
+    ORPHAN_SECS = 15
+    def __init__(self):
+        self._q = queue.Queue()
+        self._held = []
+        self._thread = None
+        self._lock = threading.Lock()
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="delivery-ledger", daemon=True)
+            self._thread.start()
+    def record(self, handle, channel, target, enqueued_at, first_byte_at, completed_at, status, error=""):
+        self.start()
+        self._q.put((handle, channel, str(target), enqueued_at, first_byte_at, completed_at, status, (error or "")[:500]))
+    def _run(self):
+        while True:
+            batch = list(self._held); self._held = []
+            try:
+                batch.append(self._q.get(timeout=self.FLUSH_SECS))
+                while len(batch) < self.BATCH_SIZE:
+                    batch.append(self._q.get_nowait())
+            except queue.Empty:
+                pass
+            if batch:
+                self._write(batch)
+    def _write(self, batch):
+        def ms(ts): return int(ts * 1000) if ts else None
+        now = time.time()
+        rows = []
+        for handle, channel, target, enq, first, done, status, error in batch:
+            alert_id = getattr(handle, "alert_id", handle)
+            if alert_id is None and now - (enq or now) < self.ORPHAN_SECS:
+                self._held.append((handle, channel, target, enq, first, done, status, error))
+                continue
+            rows.append((alert_id, channel, target, ms(enq), ms(first), ms(done), status, error))
+        if not rows:
+            return
+        try:
+            conn = db()
+            conn.executemany(
+                "INSERT INTO delivery_attempts (alert_id, channel, target, enqueued_ms, first_byte_ms, completed_ms, status, error) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.commit(); conn.close()
+        except Exception as e:
+            print(f"[delivery] batch write of {len(rows)} rows failed: {e}")
+LEDGER = DeliveryLedger()
+# dispatch handle / channel of the job running on the current worker thread
+_DISPATCH_CTX = threading.local()
+def current_dispatch():
+    return getattr(_DISPATCH_CTX, "handle", None)
+class DeliveryAttempt:
+    """Timing for one delivery to one target; recorded in the ledger on finish().
+
+    Outside a dispatch job (no handle) attempts are timed but not recorded.
+    """
+    def __init__(self, channel: str, target, handle=None, enqueued_at: float = None):
+        self.handle = handle if handle is not None else current_dispatch()
+        self.channel = channel
+        self.target = target
+        if enqueued_at is None and self.handle is not None:
+            enqueued_at = self.handle.enqueued_at.get(channel)
+        self.enqueued_at = enqueued_at or time.time()
+        self.first_byte_at = None
+    def first_byte(self, at: float = None):
+        if self.first_byte_at is None:
+            self.first_byte_at = at or time.time()
+    def finish(self, ok: bool, error: str = ""):
+        if self.handle is not None:
+            LEDGER.record(self.handle, self.channel, self.target, self.enqueued_at,
+                          self.first_byte_at, time.time(), "ok" if ok else "failed", error)
+        return ok
+@app.get("/api/alerts/<int:alert_id>/delivery")
+def api_alert_delivery(alert_id):
+    """Per-channel / per-target delivery timings recorded for one alert."""
+    if not require_teacher():
+        return jsonify({"error": "login required"}), 401
+    conn = db(); c = conn.cursor()
+    c.execute(
+        "SELECT channel, target, enqueued_ms, first_byte_ms, completed_ms, status, error "
+        "FROM delivery_attempts WHERE alert_id=? ORDER BY enqueued_ms, id",
+        (alert_id,),
+    )
+    rows = c.fetchall()
+    conn.close()
+    attempts = []
+    channels = {}
+    for r in rows:
+        enq = r["enqueued_ms"]
+        attempt = {
+            "channel": r["channel"],
+            "target": r["target"],
+            "enqueued_ms": enq,
+            "first_byte_ms": r["first_byte_ms"],
+            "completed_ms": r["completed_ms"],
+            "ttfb_ms": (r["first_byte_ms"] - enq) if (enq and r["first_byte_ms"]) else None,
+            "total_ms": (r["completed_ms"] - enq) if (enq and r["completed_ms"]) else None,
+            "status": r["status"],
+            "error": r["error"] or "",
+        }
+        attempts.append(attempt)
+        if attempt["target"] == "*":
+            continue
+        ch = channels.setdefault(r["channel"], {"targets": 0, "ok": 0, "failed": 0, "max_ms": None})
+        ch["targets"] += 1
+        ch["ok" if r["status"] == "ok" else "failed"] += 1
+        if attempt["total_ms"] is not None:
+            ch["max_ms"] = max(ch["max_ms"] or 0, attempt["total_ms"])
+    return jsonify({"alert_id": alert_id, "channels": channels, "attempts": attempts})
+# ---------------- State journal ----------------
+import atexit
+RSS_COUNTERS_PATH = os.path.join(ROOT, "rss_counters.json")
+class StateJournal:
+    """Write-ahead journal for the state store, replayed at startup.
+
+    Subscribed to STORE, so every alert, display and RSS token change is
+    queued and a single writer appends whatever has piled up in one
+    transaction (group commit); requests never wait on the disk. Once the
+    log grows past COMPACT_EVERY rows, entries superseded by a newer one for
+    the same (topic, key) are dropped, so replay stays a short scan.
+
+    RSS tokens are mirrored to rss_counters.json, which also seeds them when
+    the journal has none. With the sqlite state backend the journal doubles
+    as the log other workers tail, so it also carries banner / ack events and
+    forwarded commands (see SQLiteBackend).
+    """
+    TOPICS = ("alert", "display", "rss")
+    # superseded entries younger than this stay, so tailing workers never miss them
+    COMPACT_MIN_AGE = 60
+    BATCH_SIZE = 1000
+    COMPACT_EVERY = 5000
+    def __init__(self):
+        self._q = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._appended = 0
+        self.topics = set(self.TOPICS)
+        self.last_seq = 0
+    def replay(self, store) -> int:
+        """Restore store from the journal (and rss_counters.json); returns entries applied."""
+        t0 = time.perf_counter()
+        alert, displays, tokens, changed, n = None, {}, {}, {}, 0
+        try:
+            conn = db(); c = conn.cursor()
+            c.execute("SELECT seq, topic, key, data FROM state_journal ORDER BY seq")
+            for r in c.fetchall():
+                self.last_seq = r["seq"]
+                if r["topic"] not in self.TOPICS:
+                    continue
+                data = json.loads(r["data"])
+                if r["topic"] == "alert":
+                    alert = data
+                elif r["topic"] == "display":
+                    data.pop("id", None)
+                    displays[r["key"]] = data
+                elif r["topic"] == "rss":
+                    tokens[r["key"]] = int(data.get("token", 0))
+                    if data.get("ts"):
+                        changed[r["key"]] = int(data["ts"])
+                n += 1
+            conn.close()
+        except Exception as e:
+            print(f"[journal] replay failed: {e}")
+        if not tokens:
+            try:
+                with open(RSS_COUNTERS_PATH, "r", encoding="utf-8") as f:
+                    tokens = {str(k): int(v) for k, v in (json.load(f) or {}).items()}
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"[journal] could not read {RSS_COUNTERS_PATH}: {e}")
+        store.restore(alert=alert, displays=displays, rss_tokens=tokens, rss_changed=changed)
+        mode = (alert or {}).get("mode") or "IDLE"
+        print(f"[journal] restored {n} entries ({mode}, {len(displays)} display(s)) in {(time.perf_counter() - t0) * 1000:.1f} ms")
+        return n
+    def record(self, topic, key, data, version=None):
+        """STORE subscriber: queue one change for the writer."""
+        if topic in self.topics:
+            self._q.put((int(time.time()), topic, key, json.dumps(data, separators=(",", ":")), NODE_ID))
+    def start(self, store):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self.replay(store)
+            store.subscribe(self.record)
+            self._thread = threading.Thread(target=self._run, name="state-journal", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush, 2)
+    def flush(self, timeout: float = 5) -> bool:
+        """Block until everything queued so far is on disk."""
+        if not (self._thread and self._thread.is_alive()):
+            return True
+        done = threading.Event()
+        self._q.put(done)
+        return done.wait(timeout)
+    def _run(self):
+        conn = None
+        while True:
+            batch, waiters = [], []
+            item = self._q.get()
+            try:
+                while True:
+                    if isinstance(item, threading.Event):
+                        waiters.append(item)
+                    else:
+                        batch.append(item)
+                    if len(batch) >= self.BATCH_SIZE:
+                        break
+                    item = self._q.get_nowait()
+            except queue.Empty:
+                pass
+            if batch:
+                try:
+                    if conn is None:
+                        conn = db()
+                    conn.executemany("INSERT INTO state_journal (ts, topic, key, data, origin) VALUES (?, ?, ?, ?, ?)", batch)
+                    conn.commit()
+                    self._appended += len(batch)
+                    if self._appended >= self.COMPACT_EVERY:
+                        self._appended = 0
+                        conn.execute(
+                            "DELETE FROM state_journal WHERE ts < ? AND seq NOT IN "
+                            "(SELECT MAX(seq) FROM state_journal GROUP BY topic, key)",
+                            (int(time.time()) - self.COMPACT_MIN_AGE,),
+                        )
+                        conn.commit()
+                except Exception as e:
+                    print(f"[journal] write of {len(batch)} entries failed: {e}")
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                    conn = None
+                if any(item[1] == "rss" for item in batch):
+                    self._write_rss_counters()
+            for done in waiters:
+                done.set()
+    def _write_rss_counters(self):
+        tmp = RSS_COUNTERS_PATH + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(STORE.rss_tokens, f, indent=2, sort_keys=True)
+            os.replace(tmp, RSS_COUNTERS_PATH)
+        except Exception as e:
+            print(f"[journal] could not write {RSS_COUNTERS_PATH}: {e}")
+JOURNAL = StateJournal()
+# ---------------- Shared state backend ----------------
+def _node_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+# identifies this worker in the journal / pub-sub and in leader leases
+NODE_ID = _node_id()
+class StateBackend:
+    """Single-process backend (default): state lives in this process only.
+
+    Backends share STORE changes between workers and elect the one leader
+    that runs the drill scheduler and alert fan-out; other workers send() it
+    commands. Followers hold on to commands until the leader reports them
+    done, so a command sent just as the leader died is run by the next one.
+    Subclasses override start(), is_leader() and _transmit().
+    """
+    name = "memory"
+    # topics replicated to other workers (plus "cmd" / "cmd_done" for commands)
+    SHARED_TOPICS = ("alert", "display", "rss", "banner", "acks")
+    def __init__(self, cfg: dict = None):
+        self.cfg = cfg or {}
+        self.lease_secs = float(self.cfg.get("lease_secs", 10))
+        self._handlers = {}
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._pid = None
+        # a single process is always its own leader
+        self._leader = True
+    def ensure_started(self, store):
+        """start() once per process, and again in a forked child (gunicorn --preload)."""
+        global NODE_ID
+        if self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            NODE_ID = _node_id()
+        self._pid = os.getpid()
+        self.start(store)
+    def start(self, store):
+        pass
+    def is_leader(self) -> bool:
+        return self._leader
+    def on_command(self, name: str, handler):
+        """Run handler(payload) on the leader when any worker send()s name."""
+        self._handlers[name] = handler
+    def send(self, name: str, payload: dict):
+        if self.is_leader():
+            return self._run_command(name, payload)
+        cmd_id = uuid.uuid4().hex
+        with self._pending_lock:
+            # kept here too, in case the leader is gone and this worker takes over
+            self._pending[cmd_id] = (time.time(), name, payload)
+        self._transmit("cmd", cmd_id, {"name": name, "payload": payload})
+    def _transmit(self, topic: str, key, data: dict):
+        """Hand an event to the other workers."""
+    def _run_command(self, name: str, payload: dict):
+        handler = self._handlers.get(name)
+        if handler is None:
+            return
+        try:
+            handler(payload)
+        except Exception as e:
+            print(f"[state] command {name} failed: {e}")
+    def _apply(self, store, origin, topic, key, data):
+        if origin == NODE_ID:
+            return
+        if topic == "cmd":
+            if self.is_leader():
+                self._run_command(data["name"], data["payload"])
+                self._transmit("cmd_done", key, {})
+            else:
+                with self._pending_lock:
+                    self._pending[key] = (time.time(), data["name"], data["payload"])
+        elif topic == "cmd_done":
+            with self._pending_lock:
+                self._pending.pop(key, None)
+        elif topic in self.SHARED_TOPICS:
+            if topic == "acks":
+                ACKS.merge(data)
+            store.apply_remote(topic, key, data)
+    def _set_leader(self, leader: bool):
+        if leader != self._leader:
+            self._leader = leader
+            print(f"[state] {NODE_ID} is {'now' if leader else 'no longer'} the leader ({self.name} backend)")
+            SCHEDULER.wake()
+        if leader and self._pending:
+            # commands the previous leader may not have run; stale ones are dropped
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+            for cmd_id, (received, name, payload) in pending.items():
+                if time.time() - received < 2 * self.lease_secs:
+                    print(f"[state] running command {name} left by the previous leader")
+                    self._run_command(name, payload)
+                    self._transmit("cmd_done", cmd_id, {})
+class SQLiteBackend(StateBackend):
+    """Workers on one host share gschool_ems.db.
+
+    Each worker's changes go into state_journal (tagged with its NODE_ID) and
+    every worker tails it: PRAGMA data_version tells it cheaply when another
+    connection committed, so remote changes show up within poll_ms. The
+    leader holds a row in leases that it renews every lease_secs / 3; if it
+    dies, another worker takes over once the lease expires.
+    """
+    name = "sqlite"
+    def start(self, store):
+        self.poll = max(int(self.cfg.get("poll_ms", 10)), 1) / 1000
+        self._leader = False
+        JOURNAL.topics.update(self.SHARED_TOPICS + ("cmd", "cmd_done"))
+        self._last_seq = JOURNAL.last_seq
+        self._try_lead()
+        atexit.register(self._release)
+        threading.Thread(target=self._tail, args=(store,), name="state-tail", daemon=True).start()
+        threading.Thread(target=self._lease_loop, name="state-lease", daemon=True).start()
+    def _transmit(self, topic: str, key, data: dict):
+        JOURNAL.record(topic, key, data)
+    def is_leader(self) -> bool:
+        # take over straight away if the old leader's lease ran out
+        if not self._leader and time.time() >= getattr(self, "_next_try", 0):
+            self._try_lead()
+        return self._leader
+    def _try_lead(self):
+        self._next_try = time.time() + 1
+        now = time.time()
+        try:
+            conn = db(); c = conn.cursor()
+            c.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES ('leader', ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at "
+                "WHERE leases.holder=excluded.holder OR leases.expires_at < ?",
+                (NODE_ID, now + self.lease_secs, now),
+            )
+            conn.commit()
+            holder = c.execute("SELECT holder FROM leases WHERE name='leader'").fetchone()[0]
+            conn.close()
+            self._set_leader(holder == NODE_ID)
+        except Exception as e:
+            print(f"[state] lease check failed: {e}")
+            self._set_leader(False)
+    def _release(self):
+        """Give up the lease on shutdown so another worker can lead at once."""
+        try:
+            conn = db()
+            conn.execute("DELETE FROM leases WHERE name='leader' AND holder=?", (NODE_ID,))
+            conn.commit(); conn.close()
+        except Exception:
+            pass
+    def _lease_loop(self):
+        while True:
+            time.sleep(self.lease_secs / 3)
+            self._try_lead()
+    def _tail(self, store):
+        conn = DB_POOL.dedicated()  # data_version is per connection
+        seen = None
+        while True:
+            try:
+                version = conn.execute("PRAGMA data_version").fetchone()[0]
+                if version != seen:
+                    seen = version
+                    rows = conn.execute(
+                        "SELECT seq, topic, key, data, origin FROM state_journal WHERE seq > ? ORDER BY seq",
+                        (self._last_seq,),
+                    ).fetchall()
+                    conn.commit()
+                    for r in rows:
+                        self._last_seq = r["seq"]
+                        self._apply(store, r["origin"], r["topic"], r["key"], json.loads(r["data"]))
+            except Exception as e:
+                print(f"[state] tail failed: {e}")
+                time.sleep(1)
+            time.sleep(self.poll)
+class RedisBackend(StateBackend):
+    """Workers on any number of hosts share a Redis (or Redis-compatible) server.
+
+    Changes are published on <prefix>:events and the latest alert / display /
+    RSS values kept in the <prefix>:state hash, which a starting worker loads
+    over its local journal. Leadership is a SET NX PX key renewed by its
+    holder. Needs the redis package (pip install redis).
+    """
+    name = "redis"
+    def start(self, store):
+        import redis  # optional dependency, only for this backend
+        self.r = redis.Redis.from_url(self.cfg.get("redis_url", "redis://127.0.0.1:6379/0"))
+        self.prefix = self.cfg.get("redis_prefix", "gschool_ems")
+        self._leader = False
+        self._load(store)
+        store.subscribe(self._publish)
+        pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(f"{self.prefix}:events")
+        threading.Thread(target=self._listen, args=(store, pubsub), name="state-redis", daemon=True).start()
+        self._try_lead()
+        threading.Thread(target=self._lease_loop, name="state-lease", daemon=True).start()
+        atexit.register(self._release)
+    def _release(self):
+        try:
+            key = f"{self.prefix}:leader"
+            if (self.r.get(key) or b"").decode() == NODE_ID:
+                self.r.delete(key)
+        except Exception:
+            pass
+    def _load(self, store):
+        state = self.r.hgetall(f"{self.prefix}:state")
+        alert, displays, tokens, changed = None, {}, {}, {}
+        for field, value in state.items():
+            topic, _, key = field.decode().partition("|")
+            data = json.loads(value)
+            if topic == "alert":
+                alert = data
+            elif topic == "display":
+                displays[key] = {k: v for k, v in data.items() if k != "id"}
+            elif topic == "rss":
+                tokens[key] = int(data.get("token", 0))
+                if data.get("ts"):
+                    changed[key] = int(data["ts"])
+        store.restore(alert=alert, displays=displays, rss_tokens=tokens, rss_changed=changed)
+    def _event(self, topic, key, data) -> str:
+        return json.dumps({"origin": NODE_ID, "topic": topic, "key": key, "data": data}, separators=(",", ":"))
+    def _transmit(self, topic: str, key, data: dict):
+        self.r.publish(f"{self.prefix}:events", self._event(topic, key, data))
+    def _publish(self, topic, key, data, version):
+        if topic not in self.SHARED_TOPICS:
+            return
+        body = self._event(topic, key, data)
+        try:
+            pipe = self.r.pipeline()
+            if topic in StateJournal.TOPICS:
+                pipe.hset(f"{self.prefix}:state", f"{topic}|{key or ''}", json.dumps(data, separators=(",", ":")))
+            pipe.publish(f"{self.prefix}:events", body)
+            pipe.execute()
+        except Exception as e:
+            print(f"[state] redis publish failed: {e}")
+    def _listen(self, store, pubsub):
+        while True:
+            try:
+                for message in pubsub.listen():
+                    event = json.loads(message["data"])
+                    self._apply(store, event.get("origin"), event["topic"], event.get("key"), event["data"])
+            except Exception as e:
+                print(f"[state] redis subscription lost: {e}")
+                time.sleep(1)
+    def _try_lead(self):
+        key = f"{self.prefix}:leader"
+        ttl = int(self.lease_secs * 1000)
+        try:
+            if self.r.set(key, NODE_ID, nx=True, px=ttl):
+                return self._set_leader(True)
+            if (self.r.get(key) or b"").decode() == NODE_ID:
+                self.r.pexpire(key, ttl)
+                return self._set_leader(True)
+            self._set_leader(False)
+        except Exception as e:
+            print(f"[state] lease check failed: {e}")
+            self._set_leader(False)
+    def _lease_loop(self):
+        while True:
+            time.sleep(self.lease_secs / 3)
+            self._try_lead()
+STATE_BACKENDS = {"memory": StateBackend, "sqlite": SQLiteBackend, "redis": RedisBackend}
+def make_state_backend() -> StateBackend:
+    """Backend from EMS_STATE_BACKEND or state.backend in config (memory, sqlite, redis)."""
+    cfg = CFG.get("state", {}) or {}
+    name = (os.environ.get("EMS_STATE_BACKEND") or cfg.get("backend") or "memory").lower()
+    if name not in STATE_BACKENDS:
+        print(f"[state] unknown backend {name!r}; using memory")
+        name = "memory"
+    return STATE_BACKENDS[name](cfg)
+BACKEND = make_state_backend()
+# ---------------- Acknowledgements ----------------
+import itertools
+def _station_group(station: str) -> str:
+    """Group for a station from acks.groups in config ({group: [station prefixes]})."""
+    groups = (CFG.get("acks", {}) or {}).get("groups", {}) or {}
+    for group, prefixes in groups.items():
+        for prefix in prefixes or []:
+            if station.startswith(str(prefix)):
+                return str(group)
+    return ""
+class AckSet:
+    """Acknowledgements for one alert: station -> row, plus running counters."""
+    def __init__(self, alert_id):
+        self.alert_id = alert_id
+        self.stations = {}
+        self.groups = {}
+        self.repeats = 0
+    def upsert(self, station, group, ts):
+        row = self.stations.get(station)
+        if row is not None:
+            # copy-on-write so readers paging the old row never see it change
+            row = dict(row, last_ack_ts=ts, repeats=row["repeats"] + 1)
+            self.stations[station] = row
+            self.repeats += 1
+            return row, False
+        row = {"station": station, "group": group, "ack_ts": ts, "last_ack_ts": ts, "repeats": 1}
+        self.stations[station] = row
+        self.groups[group] = self.groups.get(group, 0) + 1
+        return row, True
+class AckStore:
+    """Acks keyed by (alert id, station) with O(1) upsert and per-group counters.
+
+    Each ack updates the in-memory set and is queued for a background writer
+    that upserts batches into alert_acks, so the request path never waits on
+    SQLite. Sets for alerts not in memory (e.g. after a restart) are loaded
+    from the table on first use.
+    """
+    BATCH_SIZE = 500
+    KEEP_ALERTS = 8
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sets = {}
+        self._q = queue.Queue()
+        self._thread = None
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="ack-writer", daemon=True)
+            self._thread.start()
+    def _load(self, alert_id) -> AckSet:
+        # caller holds self._lock
+        acks = self._sets.get(alert_id)
+        if acks is not None:
+            return acks
+        acks = AckSet(alert_id)
+        if alert_id is not None:
+            try:
+                conn = db(); c = conn.cursor()
+                c.execute(
+                    "SELECT station, station_group, first_ack_ts, last_ack_ts, repeats FROM alert_acks "
+                    "WHERE alert_id=? ORDER BY first_ack_ts",
+                    (alert_id,),
+                )
+                for r in c.fetchall():
+                    group = r["station_group"] or ""
+                    acks.stations[r["station"]] = {"station": r["station"], "group": group, "ack_ts": r["first_ack_ts"],
+                                                   "last_ack_ts": r["last_ack_ts"], "repeats": r["repeats"] or 1}
+                    acks.groups[group] = acks.groups.get(group, 0) + 1
+                    acks.repeats += (r["repeats"] or 1) - 1
+                conn.close()
+            except Exception as e:
+                print(f"[acks] load for alert {alert_id} failed: {e}")
+        self._sets[alert_id] = acks
+        while len(self._sets) > self.KEEP_ALERTS:
+            self._sets.pop(next(iter(self._sets)))
+        return acks
+    def ack(self, alert_id, station: str, group: str = "", ts: int = None):
+        """Record one ack; returns (row, first) where first is False for a repeat from the same station."""
+        self.start()
+        ts = ts or int(time.time())
+        with self._lock:
+            row, first = self._load(alert_id).upsert(station, group or _station_group(station), ts)
+        if alert_id is not None:
+            self._q.put((alert_id, row))
+        return row, first
+    def merge(self, event: dict):
+        """Apply an ack recorded by another worker (it persists the row itself)."""
+        alert_id, station = event.get("alert_id"), event.get("station")
+        if alert_id is None or not station:
+            return
+        with self._lock:
+            acks = self._load(alert_id)
+            if event.get("repeat") or station not in acks.stations:
+                acks.upsert(station, event.get("group") or "", event.get("ts") or int(time.time()))
+    def summary(self, alert_id, offset: int = 0, limit: int = None) -> dict:
+        """Counters and group rollup; with limit, also one page of rows in ack order."""
+        with self._lock:
+            acks = self._load(alert_id)
+            out = {
+                "count": len(acks.stations),
+                "repeats": acks.repeats,
+                "groups": dict(acks.groups),
+            }
+            if limit is not None:
+                out["acks"] = list(itertools.islice(acks.stations.values(), offset, offset + limit))
+        if limit is not None:
+            out["offset"] = offset
+            out["next_offset"] = offset + limit if offset + limit < out["count"] else None
+        return out
+    def flush(self, timeout: float = 5) -> bool:
+        """Block until everything queued so far is in SQLite."""
+        if not (self._thread and self._thread.is_alive()):
+            return True
+        done = threading.Event()
+        self._q.put(done)
+        return done.wait(timeout)
+    def count(self, alert_id) -> int:
+        """Stored count of stations that acked alert_id (pending writes flushed first)."""
+        self.flush()
+        try:
+            conn = db(); c = conn.cursor()
+            c.execute("SELECT COUNT(*) FROM alert_acks WHERE alert_id=?", (alert_id,))
+            n = c.fetchone()[0]
+            conn.close()
+            return n
+        except Exception as e:
+            print(f"[acks] count for alert {alert_id} failed: {e}")
+            with self._lock:
+                return len(self._load(alert_id).stations)
+    def _run(self):
+        while True:
+            batch, waiters = {}, []
+            try:
+                item = self._q.get()
+                while True:
+                    if isinstance(item, threading.Event):
+                        waiters.append(item)
+                    else:
+                        # later acks from the same station replace earlier ones in the batch
+                        alert_id, row = item
+                        batch[(alert_id, row["station"])] = row
+                    if len(batch) >= self.BATCH_SIZE:
+                        break
+                    # acks that arrived while the last batch was writing go in this one
+                    item = self._q.get_nowait()
+            except queue.Empty:
+                pass
+            if batch:
+                self._write(batch)
+            for done in waiters:
+                done.set()
+    def _write(self, batch):
+        rows = [(alert_id, row["station"], row["group"], row["ack_ts"], row["last_ack_ts"], row["repeats"])
+                for (alert_id, _), row in batch.items()]
+        try:
+            conn = db()
+            conn.executemany(
+                "INSERT INTO alert_acks (alert_id, station, station_group, first_ack_ts, last_ack_ts, repeats) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(alert_id, station) DO UPDATE SET last_ack_ts=excluded.last_ack_ts, repeats=excluded.repeats",
+                rows,
+            )
+            conn.commit(); conn.close()
+        except Exception as e:
+            print(f"[acks] batch write of {len(rows)} rows failed: {e}")
+ACKS = AckStore()
+# ---------------- Display fleet ----------------
+import bisect
+from collections import OrderedDict
+class _Panel:
+    __slots__ = ("id", "zone", "model", "label", "registered", "last_seen", "polls", "pending",
+                 "interval", "latency_ms", "online", "deadline")
+    def __init__(self, did, zone="", model="", label="", registered=False, last_seen=None, polls=0):
+        self.id, self.zone, self.model, self.label = did, zone or "", model or "", label or ""
+        self.registered, self.last_seen, self.polls = registered, last_seen, polls or 0
+        # polls served here and not yet added to the shared row
+        self.pending = 0
+        self.interval = None
+        self.latency_ms = None
+        self.online = None
+        self.deadline = 0
+    def row(self, now: float) -> dict:
+        return {
+            "id": self.id, "zone": self.zone, "model": self.model, "label": self.label,
+            "registered": self.registered, "online": self.online, "polls": self.polls,
+            "last_seen": int(self.last_seen) if self.last_seen else None,
+            "age": int(now - self.last_seen) if self.last_seen else None,
+            "interval_s": round(self.interval, 1) if self.interval is not None else None,
+            "latency_ms": round(self.latency_ms, 2) if self.latency_ms is not None else None,
+        }
+class DisplayFleet:
+    """Known LED panels, their heartbeats and offline detection.
+
+    Panels registered by an admin live in display_devices; ids named in the
+    zone table or holding a display state are known too (and get a row with
+    no registered_at once they poll). Each poll of /api/display/<id>/text is
+    a heartbeat that updates the panel's record in place (EWMA of the poll
+    interval and of the time spent answering it). Every flush_secs the
+    background thread adds this worker's heartbeats to the shared rows
+    (last_seen = max, polls += served here) and merges everyone else's back,
+    so all workers converge on one view of the fleet.
+
+    Offline detection uses a timing wheel of one-second slots: a heartbeat
+    files the panel under its deadline (max(offline_secs, 3 x its interval)
+    plus flush_secs of slack) and each tick only looks at one slot, so the
+    cost does not grow with the fleet. A panel that comes due is checked
+    against the shared last_seen first, since its polls may be landing on
+    another worker; only the leader announces it. Polls from unknown ids
+    share a token bucket (unregistered_rate / unregistered_burst) and are
+    answered 429 beyond it; the last MAX_UNKNOWN of them are kept for the
+    admin page. Settings come from CFG["fleet"].
+    """
+    SLOTS = 128
+    MAX_UNKNOWN = 256
+    ALPHA = 0.2
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._panels = {}
+        self._ids = []
+        self._unknown = OrderedDict()
+        self._wheel = [set() for _ in range(self.SLOTS)]
+        self._tick = int(time.time())
+        self._dirty = set()
+        self._tokens = None
+        self._refill_at = time.monotonic()
+        self._offline = set()
+        self._summary = None
+        self._thread = None
+        self._pid = None
+    def _cfg(self) -> dict:
+        f = CFG.get("fleet", {}) or {}
+        return {
+            "offline_secs": max(2.0, float(f.get("offline_secs", 90))),
+            "unregistered_rate": float(f.get("unregistered_rate", 2)),
+            "unregistered_burst": float(f.get("unregistered_burst", 10)),
+            "flush_secs": max(1.0, float(f.get("flush_secs", 5))),
+        }
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid is None:
+                atexit.register(self.flush)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="fleet-wheel", daemon=True)
+            self._thread.start()
+        self.sync()
+        print(f"[fleet] {sum(1 for p in self._panels.values() if p.registered)} registered display(s), "
+              f"{len(self._offline)} offline")
+    def _add(self, panel: _Panel):
+        # caller holds self._lock
+        if panel.id not in self._panels:
+            bisect.insort(self._ids, panel.id)
+        self._panels[panel.id] = panel
+    def _drop(self, did: str):
+        # caller holds self._lock
+        if self._panels.pop(did, None) is not None:
+            self._ids.remove(did)
+        self._offline.discard(did)
+        self._dirty.discard(did)
+    def _changed(self):
+        # caller holds self._lock; invalidates the cached summary
+        self._summary = None
+    def _threshold(self, panel: _Panel, cfg: dict) -> float:
+        # silence allowed before a panel counts as offline, incl. the lag of the shared last_seen
+        return max(cfg["offline_secs"], 3 * (panel.interval or 0)) + cfg["flush_secs"]
+    def _schedule(self, panel: _Panel, deadline: float):
+        # caller holds self._lock; stale slots are skipped when their tick comes
+        panel.deadline = deadline
+        self._wheel[int(deadline) % self.SLOTS].add(panel.id)
+    def _implicit(self, did: str):
+        """A record for an id named in the zone table or holding a display state, else None."""
+        if did not in STORE.displays and did not in ZONES.route("ALL").displays:
+            return None
+        zone = ""
+        for name, route in ZONES.table().items():
+            if name != "ALL" and did in route.displays and len(route.path) > len(zone):
+                zone = name
+        return _Panel(did, zone)
+    def admit(self, did: str) -> bool:
+        """False when did is unknown and the shared budget for unknown ids is spent."""
+        if did in self._panels:
+            return True
+        panel = self._implicit(did)
+        with self._lock:
+            if did in self._panels:
+                return True
+            if panel is not None:
+                self._add(panel)
+                self._changed()
+                return True
+            cfg = self._cfg()
+            now = time.monotonic()
+            if self._tokens is None:
+                self._tokens = cfg["unregistered_burst"]
+            self._tokens = min(cfg["unregistered_burst"], self._tokens + (now - self._refill_at) * cfg["unregistered_rate"])
+            self._refill_at = now
+            seen = self._unknown.pop(did, None) or {"id": did, "first_seen": int(time.time()), "polls": 0, "limited": 0}
+            seen["last_seen"] = int(time.time())
+            self._unknown[did] = seen
+            while len(self._unknown) > self.MAX_UNKNOWN:
+                self._unknown.popitem(last=False)
+            if self._tokens < 1:
+                seen["limited"] += 1
+                return False
+            self._tokens -= 1
+            seen["polls"] += 1
+            return True
+    def heartbeat(self, did: str, latency_ms: float = None):
+        """Record one poll from a known panel (admit() first)."""
+        panel = self._panels.get(did)
+        if panel is None:
+            return
+        now = time.time()
+        with self._lock:
+            if panel.last_seen:
+                gap = now - panel.last_seen
+                panel.interval = gap if panel.interval is None else panel.interval + self.ALPHA * (gap - panel.interval)
+            if latency_ms is not None:
+                panel.latency_ms = latency_ms if panel.latency_ms is None else \
+                    panel.latency_ms + self.ALPHA * (latency_ms - panel.latency_ms)
+            panel.last_seen = now
+            panel.polls += 1
+            panel.pending += 1
+            self._dirty.add(did)
+            deadline = now + self._threshold(panel, self._cfg())
+            # re-file only when the deadline moves to another slot
+            if int(deadline) != int(panel.deadline):
+                self._schedule(panel, deadline)
+            else:
+                panel.deadline = deadline
+            back = panel.online is False
+            panel.online = True
+            if back:
+                self._offline.discard(did)
+                self._changed()
+            elif panel.polls == 1:
+                self._changed()
+        if back:
+            self._announce(panel, "online")
+    def _run(self):
+        last_sync = time.monotonic()
+        while True:
+            time.sleep(1)
+            try:
+                self._advance(time.time())
+                if time.monotonic() - last_sync >= self._cfg()["flush_secs"]:
+                    last_sync = time.monotonic()
+                    self.sync()
+            except Exception as e:
+                print(f"[fleet] tick failed: {e}")
+    def _shared_last_seen(self, ids) -> dict:
+        """last_seen of ids as flushed by every worker."""
+        try:
+            conn = db(); c = conn.cursor()
+            c.execute(f"SELECT id, last_seen FROM display_devices WHERE id IN ({','.join('?' * len(ids))})", list(ids))
+            out = {r["id"]: r["last_seen"] for r in c.fetchall() if r["last_seen"]}
+            conn.close()
+            return out
+        except Exception as e:
+            print(f"[fleet] shared last_seen read failed: {e}")
+            return {}
+    def _advance(self, now: float):
+        due = []
+        with self._lock:
+            # catch up every slot passed since the last tick (at most one lap)
+            start = max(self._tick + 1, int(now) - self.SLOTS + 1)
+            for tick in range(start, int(now) + 1):
+                slot = self._wheel[tick % self.SLOTS]
+                if not slot:
+                    continue
+                ids = [did for did in slot if did in self._panels]
+                slot.clear()
+                for did in ids:
+                    panel = self._panels[did]
+                    if not panel.online:
+                        continue
+                    if int(panel.deadline) > tick:
+                        # a later lap (or a heartbeat moved it); back into its own slot
+                        self._wheel[int(panel.deadline) % self.SLOTS].add(did)
+                        continue
+                    due.append(did)
+            self._tick = int(now)
+        if not due:
+            return
+        # silent here, but its polls may be landing on another worker
+        shared = self._shared_last_seen(due)
+        cfg, gone = self._cfg(), []
+        with self._lock:
+            for did in due:
+                panel = self._panels.get(did)
+                if panel is None or not panel.online or panel.deadline > now:
+                    continue
+                if shared.get(did) and shared[did] > (panel.last_seen or 0):
+                    panel.last_seen = shared[did]
+                deadline = (panel.last_seen or 0) + self._threshold(panel, cfg)
+                if deadline > now:
+                    self._schedule(panel, deadline)
+                    continue
+                panel.online = False
+                self._offline.add(did)
+                gone.append(panel)
+            if gone:
+                self._changed()
+        for panel in gone:
+            self._announce(panel, "offline")
+    def _announce(self, panel: _Panel, status: str):
+        if not BACKEND.is_leader():
+            return
+        alert = STORE.alert
+        active = alert.get("mode") != "IDLE"
+        age = int(time.time() - panel.last_seen) if panel.last_seen else None
+        where = f" in zone {panel.zone}" if panel.zone else ""
+        if status == "offline" and active:
+            print(f"[fleet] WARNING display {panel.id}{where} went OFFLINE during active "
+                  f"{alert.get('mode')} {alert.get('action')} (last poll {age}s ago)")
+        else:
+            print(f"[fleet] display {panel.id}{where} is {status}")
+        STORE.publish_event("fleet", {"id": panel.id, "zone": panel.zone, "status": status,
+                                      "last_seen": int(panel.last_seen) if panel.last_seen else None,
+                                      "during_alert": active})
+    def flush(self):
+        """Add the heartbeats served here since the last flush to the shared rows."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            rows = []
+            for did in dirty:
+                panel = self._panels.get(did)
+                if panel is None or not panel.last_seen:
+                    continue
+                rows.append((panel.registered, (did, panel.zone, int(panel.last_seen), panel.pending)))
+                panel.pending = 0
+        if not rows:
+            return
+        try:
+            conn = db()
+            # registered rows are only updated, so a panel removed on another worker stays removed
+            conn.executemany(
+                "UPDATE display_devices SET last_seen=MAX(COALESCE(last_seen, 0), ?), polls=COALESCE(polls, 0)+? WHERE id=?",
+                [(last_seen, pending, did) for registered, (did, _, last_seen, pending) in rows if registered],
+            )
+            conn.executemany(
+                "INSERT INTO display_devices (id, zone, model, label, registered_at, last_seen, polls) "
+                "VALUES (?, ?, '', '', NULL, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET last_seen=MAX(COALESCE(last_seen, 0), excluded.last_seen), "
+                "polls=COALESCE(polls, 0)+excluded.polls",
+                [r for registered, r in rows if not registered],
+            )
+            conn.commit(); conn.close()
+        except Exception as e:
+            print(f"[fleet] heartbeat flush of {len(rows)} panel(s) failed: {e}")
+    def sync(self):
+        """Flush, then merge the shared rows: registrations, last_seen and poll counts from every worker."""
+        self.flush()
+        try:
+            conn = db(); c = conn.cursor()
+            c.execute("SELECT id, zone, model, label, registered_at, last_seen, polls FROM display_devices")
+            rows = c.fetchall()
+            conn.close()
+        except Exception as e:
+            print(f"[fleet] registry sync failed: {e}")
+            return
+        now, cfg, back, changed = time.time(), self._cfg(), [], False
+        with self._lock:
+            shared = set()
+            for r in rows:
+                shared.add(r["id"])
+                registered = r["registered_at"] is not None
+                panel = self._panels.get(r["id"])
+                if panel is None:
+                    if not registered:
+                        # an implicit panel of another worker; known here on its first poll
+                        continue
+                    panel = _Panel(r["id"])
+                    self._add(panel)
+                    changed = True
+                if registered or panel.registered:
+                    if (panel.zone, panel.model, panel.label, panel.registered) != (r["zone"] or "", r["model"] or "", r["label"] or "", registered):
+                        panel.zone, panel.model, panel.label = r["zone"] or "", r["model"] or "", r["label"] or ""
+                        panel.registered = registered
+                        changed = True
+                if r["last_seen"] and r["last_seen"] > (panel.last_seen or 0):
+                    panel.last_seen = r["last_seen"]
+                panel.polls = (r["polls"] or 0) + panel.pending
+                deadline = (panel.last_seen or 0) + self._threshold(panel, cfg)
+                if deadline > now:
+                    if panel.online is not True:
+                        if panel.online is False:
+                            back.append(panel)
+                        panel.online = True
+                        self._offline.discard(panel.id)
+                        changed = True
+                    if deadline > panel.deadline:
+                        self._schedule(panel, deadline)
+                elif panel.online is None:
+                    # registered but silent everywhere (never polled, or not since a restart)
+                    panel.online = False
+                    self._offline.add(panel.id)
+                    changed = True
+            for did in [did for did, p in self._panels.items() if p.registered and did not in shared]:
+                # removed on another worker
+                self._drop(did)
+                changed = True
+            if changed:
+                self._changed()
+        for panel in back:
+            self._announce(panel, "online")
+    def register(self, did: str, zone: str = "", model: str = "", label: str = ""):
+        did = (did or "").strip()
+        if not did:
+            raise ValueError("display id is required")
+        zone = (zone or "").upper().strip()
+        with self._lock:
+            panel = self._panels.get(did) or _Panel(did)
+            panel.zone, panel.model, panel.label, panel.registered = zone, model or "", label or "", True
+            self._add(panel)
+            self._unknown.pop(did, None)
+            self._changed()
+        conn = db()
+        conn.execute(
+            "INSERT INTO display_devices (id, zone, model, label, registered_at, last_seen, polls) "
+            "VALUES (?, ?, ?, ?, ?, NULL, 0) "
+            "ON CONFLICT(id) DO UPDATE SET zone=excluded.zone, model=excluded.model, label=excluded.label, "
+            "registered_at=COALESCE(registered_at, excluded.registered_at)",
+            (did, zone, model or "", label or "", int(time.time())),
+        )
+        conn.commit(); conn.close()
+    def unregister(self, did: str):
+        with self._lock:
+            self._drop(did)
+            self._changed()
+        conn = db()
+        conn.execute("DELETE FROM display_devices WHERE id=?", (did,))
+        conn.commit(); conn.close()
+    def rows(self) -> list:
+        """Every known panel in id order."""
+        now = time.time()
+        with self._lock:
+            return [self._panels[did].row(now) for did in self._ids]
+    def unknown(self) -> list:
+        with self._lock:
+            return [dict(u) for u in reversed(self._unknown.values())]
+    def summary(self) -> bytes:
+        """Fleet health JSON; cached until a panel is added, removed or changes online state."""
+        cached = self._summary
+        if cached is not None:
+            return cached
+        with self._lock:
+            online = sum(1 for p in self._panels.values() if p.online)
+            body = json.dumps({
+                "total": len(self._panels),
+                "registered": sum(1 for p in self._panels.values() if p.registered),
+                "online": online,
+                "offline": len(self._offline),
+                "never_seen": len(self._panels) - online - len(self._offline),
+                "offline_ids": sorted(self._offline),
+                "unregistered_seen": len(self._unknown),
+            }).encode()
+            self._summary = body
+        return body
+FLEET = DisplayFleet()
 # ---------------- ClockWise via RSS ----------------
+import hashlib, hmac
+from email.utils import formatdate
 ALERTS = ["HOLD","SECURE","SHELTER","EVACUATE","LOCKDOWN"]
 ALLOWED = ALERTS
-FEED_STATE = {a: 0 for a in ALERTS}
+def _xml_escape(text) -> str:
+    return str(text).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+class RSSFeeds:
+    """Pre-rendered feed bytes per alert plus the combined feed, rebuilt only when a token changes.
+
+    Watchers poll these constantly; each poll is a dict lookup and, with
+    If-None-Match / If-Modified-Since, usually a bodiless 304. The ETag is
+    derived from the token (and public URL), so it is the same on every
+    worker. Feeds advertise the local WebSub hub (see WebSubHub).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._feeds = {}
+        self._boot = int(time.time())
+    def _self_url(self, name: str) -> str:
+        return f"{_public_url()}/rss/{name.lower()}.xml"
+    def _channel(self, name: str, title: str, description: str, built_at: float, items: list) -> bytes:
+        base = _public_url()
+        lines = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom">',
+            "  <channel>",
+            f"    <title>{_xml_escape(title)}</title>",
+            f"    <link>{_xml_escape(self._self_url(name))}</link>",
+            f'    <atom:link rel="self" href="{_xml_escape(self._self_url(name))}"/>',
+            f'    <atom:link rel="hub" href="{_xml_escape(base)}/websub"/>',
+            f"    <description>{_xml_escape(description)}</description>",
+            f"    <lastBuildDate>{formatdate(built_at, usegmt=True)}</lastBuildDate>",
+        ]
+        for action, token, changed_at in items:
+            lines += [
+                "    <item>",
+                f"      <title>{action} Update</title>",
+                f"      <description>Alert state token: {token}</description>",
+                f'      <guid isPermaLink="false">{token if name != "all" else f"{action}-{token}"}</guid>',
+                f"      <pubDate>{formatdate(changed_at, usegmt=True)}</pubDate>",
+                "    </item>",
+            ]
+        lines += ["  </channel>", "</rss>"]
+        return "\n".join(lines).encode("utf-8")
+    def _state(self, name: str, tokens: dict, changed: dict) -> str:
+        # token and change time are read together from STORE, so a feed is never keyed on one and dated by the other
+        if name == "all":
+            return ",".join(f"{a}={tokens.get(a, 0)}@{changed.get(a, self._boot)}" for a in sorted(ALERTS))
+        return f"{name}={tokens.get(name, 0)}@{changed.get(name, self._boot)}"
+    def _render(self, name: str, tokens: dict, changed: dict, url: str) -> dict:
+        if name == "all":
+            items = sorted(((a, tokens.get(a, 0), changed.get(a, self._boot)) for a in ALERTS),
+                           key=lambda i: -i[2])
+            modified = max(i[2] for i in items)
+            body = self._channel("all", "All Alerts Feed", "Auto-trigger feed for every alert type", modified, items)
+        else:
+            modified = changed.get(name, self._boot)
+            body = self._channel(name, f"{name} Alert Feed", f"Auto-trigger feed for {name} alerts", modified,
+                                 [(name, tokens.get(name, 0), modified)])
+        state = self._state(name, tokens, changed)
+        digest = hashlib.sha1(f"{state}|{url}".encode("utf-8")).hexdigest()[:16]
+        return {"key": (state, url), "body": body, "etag": f"rss-{name.lower()}-{digest}",
+                "modified": int(modified), "last_modified": formatdate(int(modified), usegmt=True)}
+    def get(self, name: str, fresh: bool = False) -> dict:
+        """Current feed for an alert name or "all" (rendered on first use, after a change or when fresh)."""
+        with STORE._cond:
+            tokens, changed = STORE.rss_tokens, STORE.rss_changed
+        url = _public_url()
+        feed = self._feeds.get(name)
+        if fresh or feed is None or feed["key"] != (self._state(name, tokens, changed), url):
+            feed = self._render(name, tokens, changed, url)
+            with self._lock:
+                feeds = dict(self._feeds)
+                feeds[name] = feed
+                self._feeds = feeds
+        return feed
+    def on_change(self, topic, key, data, version):
+        """STORE subscriber: re-render the changed feed and the combined feed, then notify the hub."""
+        if topic != "rss" or key not in ALERTS:
+            return
+        for name in (key, "all"):
+            HUB.publish(name, self.get(name, fresh=True))
+FEEDS = RSSFeeds()
+class WebSubHub:
+    """Minimal local WebSub hub for the RSS feeds, so watchers can get pushes instead of polling.
+
+    POST /websub with hub.mode=subscribe|unsubscribe, hub.topic (a feed URL),
+    hub.callback and optional hub.lease_seconds / hub.secret. The hub checks
+    intent with a GET challenge to the callback, as WebSub requires, and then
+    POSTs the new feed body to each subscriber when its feed changes, signed
+    with X-Hub-Signature (sha256) if a secret was given. Subscriptions are
+    stored in SQLite; only the leader worker delivers.
+
+    The hub only calls out to callbacks on hosts listed in
+    CFG["websub"]["callback_hosts"] (subdomains included) unless a teacher
+    is logged in, keeps at most max_subscriptions (default 50) and drops
+    expired subscriptions.
+    """
+    DEFAULT_LEASE = 86400
+    MAX_LEASE = 30 * 86400
+    MAX_SUBSCRIPTIONS = 50
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs = None
+    def _load(self) -> dict:
+        with self._lock:
+            if self._subs is None:
+                subs = {}
+                try:
+                    conn = db()
+                    for topic, callback, secret, expires_at in conn.execute(
+                            "SELECT topic, callback, secret, expires_at FROM websub_subscriptions"):
+                        subs[(topic, callback)] = {"secret": secret or "", "expires_at": expires_at}
+                    conn.close()
+                except Exception as e:
+                    print(f"[WebSub] failed to load subscriptions: {e}")
+                self._subs = subs
+            return self._subs
+    @staticmethod
+    def feed_name(topic: str):
+        """Feed name ("LOCKDOWN", "all") for a topic URL, or None."""
+        path = urllib.parse.urlsplit(topic or "").path
+        if not path.startswith("/rss/") or not path.endswith(".xml"):
+            return None
+        name = path[len("/rss/"):-len(".xml")].upper()
+        return "all" if name == "ALL" else (name if name in ALERTS else None)
+    def _max_subscriptions(self) -> int:
+        try:
+            return int((CFG.get("websub", {}) or {}).get("max_subscriptions", self.MAX_SUBSCRIPTIONS))
+        except (TypeError, ValueError):
+            return self.MAX_SUBSCRIPTIONS
+    @staticmethod
+    def callback_allowed(callback: str) -> bool:
+        """Whether callback's host is in CFG["websub"]["callback_hosts"]."""
+        host = (urllib.parse.urlsplit(callback).hostname or "").lower()
+        allowed = [str(h).lower().strip(".") for h in (CFG.get("websub", {}) or {}).get("callback_hosts") or []]
+        return bool(host) and any(host == h or host.endswith("." + h) for h in allowed)
+    def subscribed(self, topic: str, callback: str) -> bool:
+        return (topic, callback) in self._load()
+    def purge(self):
+        """Forget subscriptions whose lease ran out."""
+        subs, now = self._load(), int(time.time())
+        with self._lock:
+            expired = [k for k, s in subs.items() if s["expires_at"] <= now]
+            for k in expired:
+                subs.pop(k, None)
+        if not expired:
+            return
+        try:
+            conn = db()
+            conn.execute("DELETE FROM websub_subscriptions WHERE expires_at <= ?", (now,))
+            conn.commit(); conn.close()
+            print(f"[WebSub] dropped {len(expired)} expired subscription(s)")
+        except Exception as e:
+            print(f"[WebSub] failed to drop expired subscriptions: {e}")
+    def full(self, topic: str, callback: str) -> bool:
+        """True if a new (topic, callback) would exceed max_subscriptions."""
+        return not self.subscribed(topic, callback) and self.count() >= self._max_subscriptions()
+    def request(self, mode: str, topic: str, callback: str, lease: int = None, secret: str = ""):
+        """Queue intent verification for a (un)subscribe; the change applies once the callback confirms."""
+        self.purge()
+        lease = max(60, min(int(lease or self.DEFAULT_LEASE), self.MAX_LEASE))
+        OUTBOUND.submit(self._verify(mode, topic, callback, lease, secret))
+    async def _verify(self, mode, topic, callback, lease, secret):
+        challenge = uuid.uuid4().hex
+        query = urllib.parse.urlencode({"hub.mode": mode, "hub.topic": topic, "hub.challenge": challenge,
+                                        "hub.lease_seconds": lease})
+        url = callback + ("&" if "?" in callback else "?") + query
+        try:
+            r = await OUTBOUND.http.request("GET", url, timeout=5)
+            confirmed = 200 <= r.status < 300 and r.body.decode("utf-8", errors="replace").strip() == challenge
+        except Exception as e:
+            print(f"[WebSub] {mode} verification for {callback} failed: {e}")
+            return
+        if not confirmed:
+            print(f"[WebSub] {mode} for {callback} not confirmed")
+            return
+        # SQLite writes stay off the outbound loop, which is also carrying the phone pushes
+        await asyncio.get_running_loop().run_in_executor(None, self._store, mode, topic, callback, lease, secret)
+    def _store(self, mode, topic, callback, lease, secret):
+        subs = self._load()
+        try:
+            conn = db()
+            if mode == "subscribe":
+                if self.full(topic, callback):
+                    conn.close()
+                    print(f"[WebSub] subscription limit reached; {callback} not added")
+                    return
+                expires_at = int(time.time()) + lease
+                conn.execute(
+                    "INSERT INTO websub_subscriptions (topic, callback, secret, expires_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(topic, callback) DO UPDATE SET secret=excluded.secret, expires_at=excluded.expires_at",
+                    (topic, callback, secret, expires_at))
+                with self._lock:
+                    subs[(topic, callback)] = {"secret": secret, "expires_at": expires_at}
+            else:
+                conn.execute("DELETE FROM websub_subscriptions WHERE topic=? AND callback=?", (topic, callback))
+                with self._lock:
+                    subs.pop((topic, callback), None)
+            conn.commit(); conn.close()
+            print(f"[WebSub] {mode}d {callback} to {topic}")
+        except Exception as e:
+            print(f"[WebSub] failed to store subscription: {e}")
+    def publish(self, name: str, feed: dict):
+        """Push feed to every live subscriber of this feed (leader only)."""
+        if not BACKEND.is_leader():
+            return
+        self.purge()
+        subs, now = self._load(), time.time()
+        with self._lock:
+            targets = [(topic, cb, s["secret"]) for (topic, cb), s in subs.items()
+                       if s["expires_at"] > now and self.feed_name(topic) == name]
+        for topic, callback, secret in targets:
+            OUTBOUND.submit(self._deliver(topic, callback, secret, feed))
+    async def _deliver(self, topic, callback, secret, feed):
+        headers = {"Content-Type": "application/rss+xml",
+                   "Link": f'<{_public_url()}/websub>; rel="hub", <{topic}>; rel="self"'}
+        if secret:
+            sig = hmac.new(secret.encode("utf-8"), feed["body"], hashlib.sha256).hexdigest()
+            headers["X-Hub-Signature"] = f"sha256={sig}"
+        if not HEALTH.allow("websub", callback, _endpoint_addr(callback)):
+            return
+        started = time.perf_counter()
+        try:
+            r = await OUTBOUND.http.request("POST", callback, feed["body"], headers, timeout=HEALTH.timeout("websub", callback, 5))
+            HEALTH.record("websub", callback, True, time.perf_counter() - started)
+            if r.status == 410:
+                # subscriber is gone for good
+                await asyncio.get_running_loop().run_in_executor(None, self._store, "unsubscribe", topic, callback, 0, "")
+        except Exception as e:
+            HEALTH.record("websub", callback, False, error=str(e) or type(e).__name__)
+            print(f"[WebSub] push to {callback} failed: {e}")
+    def count(self) -> int:
+        now = time.time()
+        return sum(1 for s in self._load().values() if s["expires_at"] > now)
+HUB = WebSubHub()
+STORE.subscribe(FEEDS.on_change, remote=True)
+def _serve_feed(name: str) -> Response:
+    feed = FEEDS.get(name)
+    headers = {"ETag": f'"{feed["etag"]}"', "Last-Modified": feed["last_modified"], "Cache-Control": "no-cache",
+               "Link": f'<{_public_url()}/websub>; rel="hub", <{FEEDS._self_url(name)}>; rel="self"'}
+    if request.if_none_match:
+        if request.if_none_match.contains(feed["etag"]):
+            return Response(status=304, headers=headers)
+    elif request.if_modified_since and int(request.if_modified_since.timestamp()) >= feed["modified"]:
+        return Response(status=304, headers=headers)
+    return Response(feed["body"], 200, headers, mimetype="application/rss+xml")
+@app.get("/rss/all.xml")
+def rss_feed_all():
+    """Combined feed: one item per alert type, most recently triggered first."""
+    return _serve_feed("all")
 @app.get("/rss/<alert>.xml")
 def rss_feed(alert):
     a = (alert or "").upper().strip()
     if a not in ALERTS:
         return "Invalid alert", 404
-    guid = FEED_STATE.get(a, 0)
-    now = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
-    xml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<rss version="2.0">
-  <channel>
-    <title>{a} Alert Feed</title>
-    <link>{_public_url()}/rss/{a.lower()}.xml</link>
-    <description>Auto-trigger feed for {a} alerts</description>
-    <lastBuildDate>{now}</lastBuildDate>
-    <item>
-      <title>{a} Update</title>
-      <description>Alert state token: {guid}</description>
-      <guid isPermaLink="false">{guid}</guid>
-      <pubDate>{now}</pubDate>
-    </item>
-  </channel>
-</rss>"""
-    return Response(xml, 200, {"Content-Type": "application/rss+xml"})
+    return _serve_feed(a)
+@app.post("/websub")
+def websub_hub():
+    """WebSub hub endpoint: subscribe / unsubscribe a callback to a feed."""
+    mode = (request.form.get("hub.mode") or "").lower()
+    topic = (request.form.get("hub.topic") or "").strip()
+    callback = (request.form.get("hub.callback") or "").strip()
+    if mode not in ("subscribe", "unsubscribe"):
+        return "hub.mode must be subscribe or unsubscribe", 400
+    if HUB.feed_name(topic) is None:
+        return "hub.topic is not a feed of this hub", 400
+    if urllib.parse.urlsplit(callback).scheme not in ("http", "https"):
+        return "hub.callback must be an http(s) URL", 400
+    # the hub GETs (and later POSTs to) the callback, so only vetted hosts or a signed-in teacher
+    known = mode == "unsubscribe" and HUB.subscribed(topic, callback)
+    if not (known or HUB.callback_allowed(callback) or require_teacher()):
+        return "hub.callback host is not allowed", 403
+    if mode == "subscribe" and HUB.full(topic, callback):
+        return "subscription limit reached", 429
+    try:
+        lease = int(request.form.get("hub.lease_seconds") or 0) or None
+    except ValueError:
+        return "hub.lease_seconds must be a number", 400
+    HUB.request(mode, topic, callback, lease, request.form.get("hub.secret") or "")
+    return "", 202
 # ---------------- Teacher auth/views ----------------
 @app.route("/login", methods=["GET","POST"])
 def login():
@@ -744,28 +3940,18 @@ def dashboard():
     conn = db(); c = conn.cursor()
     c.execute("SELECT student FROM roster WHERE teacher_id=?", (session["teacher_id"],))
     roster = [r[0] for r in c.fetchall()]; conn.close()
-    # Compute ack summary for current alert
-    mode = LAST_ALERT.get("mode") or "IDLE"
-    action = LAST_ALERT.get("action") or ""
-    alert_ts = LAST_ALERT.get("timestamp") or 0
-    current = []
-    for row in ACK_LOG:
-        if row.get("mode") == mode and row.get("action") == action and row.get("alert_ts") == alert_ts:
-            current.append(row)
-    ack_summary = {
-        "mode": mode,
-        "action": action,
-        "alert_ts": alert_ts,
-        "count": len(current),
-        "acks": current,
-    }
+    # Ack summary for current alert (first page of stations only)
+    last_alert = STORE.alert
+    ack_summary = _ack_summary(last_alert, 0, ACK_PAGE_DEFAULT)
     return render_template("dashboard.html",
         branding={"service_name": _service_name(), "site_name": _brand_site()},
         actions=sorted(list(ALLOWED)),
         has_sio=HAS_SIO,
         default_mode="DRILL",
         ack_summary=ack_summary,
-        last_alert=LAST_ALERT
+        last_alert=last_alert,
+        trigger_key=uuid.uuid4().hex,
+        cisco_progress=CISCO.snapshot()
     )
 # ---------------- Admin ----------------
 @app.get("/admin")
@@ -795,39 +3981,40 @@ def admin_save():
     code = request.form.get("passcode","")
     if not check_admin_passcode(code):
         flash("Invalid admin passcode","error"); return redirect(url_for("admin_page"))
+    data = CFG.to_dict()
     # Branding
-    CFG["branding"]["service_name"] = request.form.get("service_name", CFG["branding"].get("service_name","G Schools EMS"))
-    CFG["branding"]["site_name"] = request.form.get("site_name", CFG["branding"].get("site_name","Glenwood Academy"))
-    CFG["branding"]["from_display"] = request.form.get("from_display", CFG["branding"].get("from_display","G-District Alerts"))
+    branding = data.setdefault("branding", {})
+    branding["service_name"] = request.form.get("service_name", branding.get("service_name","G Schools EMS"))
+    branding["site_name"] = request.form.get("site_name", branding.get("site_name","Glenwood Academy"))
+    branding["from_display"] = request.form.get("from_display", branding.get("from_display","G-District Alerts"))
     recips = [ln.strip() for ln in (request.form.get("fixed_recipients","")).splitlines() if ln.strip()]
-    if recips: CFG["branding"]["fixed_recipients"] = recips
+    if recips: branding["fixed_recipients"] = recips
     # Asterisk
-    CFG["asterisk"]["ami_host"] = request.form.get("ami_host", CFG["asterisk"]["ami_host"])
-    CFG["asterisk"]["ami_port"] = int(request.form.get("ami_port", CFG["asterisk"]["ami_port"]))
-    CFG["asterisk"]["ami_username"] = request.form.get("ami_username", CFG["asterisk"]["ami_username"])
-    CFG["asterisk"]["ami_secret"] = request.form.get("ami_secret", CFG["asterisk"]["ami_secret"])
-    CFG["asterisk"]["page_extension"] = request.form.get("page_extension", CFG["asterisk"]["page_extension"])
+    asterisk = data.setdefault("asterisk", {})
+    for key in ("ami_host", "ami_port", "ami_username", "ami_secret", "page_extension"):
+        asterisk[key] = request.form.get(key, asterisk.get(key))
     # Cisco
-    CFG.setdefault("cisco", {})
-    CFG["cisco"]["enabled"] = (request.form.get("cisco_enabled") == "on")
-    CFG["cisco"]["username"] = request.form.get("cisco_username", CFG["cisco"].get("username","admin"))
-    CFG["cisco"]["password"] = request.form.get("cisco_password", CFG["cisco"].get("password","admin"))
+    cisco = data.setdefault("cisco", {})
+    cisco["enabled"] = (request.form.get("cisco_enabled") == "on")
+    cisco["username"] = request.form.get("cisco_username", cisco.get("username","admin"))
+    cisco["password"] = request.form.get("cisco_password", cisco.get("password","admin"))
     phones_txt = request.form.get("cisco_phones","")
-    CFG["cisco"]["phones"] = [ln.strip() for ln in phones_txt.splitlines() if ln.strip()]
+    cisco["phones"] = [ln.strip() for ln in phones_txt.splitlines() if ln.strip()]
     # ClockWise / ANETD
-    CFG.setdefault("clockwise", {})
-    CFG["clockwise"]["enabled"] = (request.form.get("clockwise_enabled") == "on")
-    CFG["clockwise"]["ip"] = request.form.get("clockwise_ip", CFG["clockwise"].get("ip", "172.16.50.191"))
-    CFG["clockwise"]["port"] = int(request.form.get("clockwise_port", CFG["clockwise"].get("port", 8090)))
-    trig = CFG["clockwise"].get("triggers", {})
+    clockwise = data.setdefault("clockwise", {})
+    clockwise["enabled"] = (request.form.get("clockwise_enabled") == "on")
+    clockwise["ip"] = request.form.get("clockwise_ip", clockwise.get("ip", "172.16.50.191"))
+    clockwise["port"] = request.form.get("clockwise_port", clockwise.get("port", 8090))
+    trig = clockwise.setdefault("triggers", {})
     for act in ALLOWED:
         field = f"clockwise_{act}"
         if field in request.form:
             trig[act] = request.form.get(field, trig.get(act, act))
-    CFG["clockwise"]["triggers"] = trig
-    # Save
-    with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-        yaml.safe_dump(CFG, f, sort_keys=False)
+    # Swap in now; the file is written in the background
+    try:
+        CONFIG.save(data)
+    except ConfigError as e:
+        flash(f"Settings not saved: {e}","error"); return redirect(url_for("admin_page"))
     flash("Settings saved.","ok"); return redirect(url_for("admin_page"))
 @app.post("/display/send")
 def display_send():
@@ -841,7 +4028,7 @@ def display_send():
     if not msg:
         flash("Message cannot be empty","error")
         return redirect(url_for("dashboard"))
-    DISPLAY_STATE[display_id] = {"mode": "MESSAGE", "text": msg[:64]}
+    set_display(display_id, "MESSAGE", msg[:64])
     flash(f"Sent display message to {display_id}","ok")
     return redirect(url_for("dashboard"))
 @app.get("/app")
@@ -853,10 +4040,13 @@ def pwa_app():
 def trigger_page():
     return render_template("trigger.html",
         branding={"service_name": _service_name(), "site_name": _brand_site()},
-        actions=sorted(list(ALLOWED)))
+        actions=sorted(list(ALLOWED)),
+        trigger_key=uuid.uuid4().hex)
 def broadcast_web_banner(action, mode):
+    banner = {"action": action, "mode": mode, "ts": int(time.time())}
+    STORE.publish_event("banner", banner)
     if HAS_SIO and socketio:
-        socketio.emit("alert", {"action": action, "mode": mode, "ts": int(time.time())})
+        socketio.emit("alert", banner)
 @app.post("/trigger")
 def trigger_action():
     # Accepts from dashboard & manual trigger forms
@@ -871,116 +4061,109 @@ def trigger_action():
     if not require_teacher():
         flash("Login required", "error")
         return redirect(url_for("login"))
-    threads = []
-    # Cisco broadcast
-    try:
-        threads.append(_fire_and_forget(cisco_broadcast, action))
-    except Exception as e:
-        print(f"[Error] Cisco failed: {e}")
-    # PBX / Asterisk page
-    try:
-        threads.append(_fire_and_forget(page_group))
-    except Exception as e:
-        print(f"[Error] PBX failed: {e}")
-    # RSS token update
-    try:
-        threads.append(_fire_and_forget(update_rss_token, action))
-    except Exception as e:
-        print(f"[Error] RSS failed: {e}")
-    # Email broadcast
-    try:
-        threads.append(_fire_and_forget(send_email, mode, action, details))
-    except Exception as e:
-        print(f"[Error] Email failed: {e}")
-    # Gotify push
-    try:
-        msg = f"{mode} {action} triggered by {session.get('teacher_name','Unknown')}" + (f" | Severity: {severity}" if severity else "") + (f" | {details}" if details else "")
-        threads.append(_fire_and_forget(
-            send_gotify,
-            msg,
-            f"{_service_name()} Alert: {action}"
-        ))
-    except Exception as e:
-        print(f"[Gotify] Error: {e}")
-    # ClockWise UDP
-    try:
-        threads.append(_fire_and_forget(clockwise_udp_trigger, action, zone))
-    except Exception as e:
-        print(f"[ClockWise-UDP] Error: {e}")
-    # Web banner for dashboards
-    broadcast_web_banner(action, mode)
-    # Determine displays for this zone
-    zones_cfg = CFG.get("zones", {})
-    target_displays = []
-    if zones_cfg:
-        z_cfg = zones_cfg.get(zone) or zones_cfg.get(zone.upper())
-        if z_cfg and isinstance(z_cfg, dict):
-            target_displays = z_cfg.get("displays", [])
-        if not target_displays:
-            all_cfg = zones_cfg.get("ALL") or {}
-            target_displays = all_cfg.get("displays", [])
-    if not target_displays:
-        target_displays = ["display-1", "display-2"]
-    # Update display state so LED panels can show the alert text
-    for display_id in target_displays:
-        DISPLAY_STATE[display_id] = {"mode": "ALERT", "text": (f"{mode} {action} – {details}" if details else f"{mode} {action}")[:64]}
-    # Update latest alert for API consumers (Chrome extension, PWA, etc.)
-    LAST_ALERT["mode"] = mode
-    LAST_ALERT["action"] = action
-    LAST_ALERT["text"] = f"{mode} {action}"
-    LAST_ALERT["details"] = details
-    LAST_ALERT["severity"] = severity
-    LAST_ALERT["timestamp"] = int(time.time())
-    LAST_ALERT["zone"] = zone
-    # Persist into alerts_history
-    try:
-        ensure_alerts_table()
-        conn = db(); c = conn.cursor()
-        c.execute(
-            "INSERT INTO alerts_history (mode, action, text, details, severity, zone, started_at, resolved_at, resolved_by, total_acks) "
-            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (mode, action, f"{mode} {action}", details, severity, zone, int(time.time()), None, str(session.get("teacher_id") or ""), None),
-        )
-        LAST_ALERT["id"] = c.lastrowid
-        conn.commit(); conn.close()
-    except Exception as e:
-        print(f"[alerts_history] insert failed: {e}")
-    # New alert -> clear previous acknowledgements
-    ACK_LOG.clear()
-    flash(f"Sent {mode} {action} (all channels launched)", "ok")
+    key = (request.headers.get("Idempotency-Key") or request.form.get("idempotency_key") or "").strip()[:128]
+    outcome, _ = trigger_alert(
+        mode, action, zone, details, severity,
+        initiator=session.get("teacher_name", "Unknown"),
+        created_by=str(session.get("teacher_id") or ""),
+        key=key,
+    )
+    if outcome == "joined":
+        flash(f"{mode} {action} is already in progress; you were added as an initiator (not re-sent)", "ok")
+    elif outcome == "duplicate":
+        flash(f"{mode} {action} was already submitted (duplicate ignored)", "ok")
+    else:
+        flash(f"Sent {mode} {action} (all channels launched)", "ok")
     return redirect(url_for("dashboard"))
 @app.get("/admin/displays")
 def admin_displays():
     if not require_teacher():
         return redirect(url_for("login"))
-    now_ts = int(time.time())
-    displays = []
-    for did, state in DISPLAY_STATE.items():
-        last = DISPLAY_LAST_SEEN.get(did)
-        displays.append({
-            "id": did,
-            "mode": state.get("mode"),
-            "text": state.get("text"),
-            "last_seen": last,
-            "age": (now_ts - last) if last else None,
-        })
-    displays.sort(key=lambda d: d["id"])
+    states = STORE.displays
+    displays = FLEET.rows()
+    for d in displays:
+        state = states.get(d["id"]) or IDLE_DISPLAY
+        d["mode"], d["text"] = state.get("mode"), state.get("text")
     return render_template(
         "displays.html",
         branding={"service_name": _service_name(), "site_name": _brand_site()},
         displays=displays,
+        unknown=FLEET.unknown(),
+        zones=sorted(ZONES.table()),
+    )
+@app.post("/admin/displays/register")
+def admin_displays_register():
+    if not require_teacher():
+        return redirect(url_for("login"))
+    did = (request.form.get("display_id") or "").strip()
+    try:
+        FLEET.register(did, request.form.get("zone", ""), (request.form.get("model") or "").strip(),
+                       (request.form.get("label") or "").strip())
+    except Exception as e:
+        flash(f"Could not register display: {e}", "error")
+        return redirect(url_for("admin_displays"))
+    flash(f"Registered display {did}", "ok")
+    return redirect(url_for("admin_displays"))
+@app.post("/admin/displays/<display_id>/remove")
+def admin_displays_remove(display_id):
+    if not require_teacher():
+        return redirect(url_for("login"))
+    try:
+        FLEET.unregister(display_id)
+    except Exception as e:
+        flash(f"Could not remove display: {e}", "error")
+        return redirect(url_for("admin_displays"))
+    flash(f"Removed display {display_id}", "ok")
+    return redirect(url_for("admin_displays"))
+@app.get("/api/displays/health")
+def api_displays_health():
+    """Fleet counters and offline panel ids; ?full=1 adds every panel's heartbeat stats."""
+    if request.args.get("full"):
+        return jsonify(dict(json.loads(FLEET.summary()), displays=FLEET.rows()))
+    return Response(FLEET.summary(), 200, mimetype="application/json")
+@app.get("/admin/health")
+def admin_health():
+    if not require_teacher():
+        return redirect(url_for("login"))
+    return render_template(
+        "health.html",
+        branding={"service_name": _service_name(), "site_name": _brand_site()},
+        endpoints=HEALTH.snapshot(),
     )
+@app.post("/admin/health/reset")
+def admin_health_reset():
+    """Close one endpoint's breaker (or all of them) by hand."""
+    if not require_teacher():
+        return redirect(url_for("login"))
+    channel = (request.form.get("channel") or "").strip() or None
+    target = (request.form.get("target") or "").strip() or None
+    HEALTH.reset(channel, target)
+    flash(f"Circuit reset for {target or 'all endpoints'}", "ok")
+    return redirect(url_for("admin_health"))
+@app.get("/api/health/endpoints")
+def api_health_endpoints():
+    """Breaker state and rolling latency / error stats per outbound endpoint."""
+    return jsonify({"endpoints": HEALTH.snapshot()})
 @app.get("/api/display/<display_id>/text")
 def api_display_text(display_id):
-    """Return current state for a display (ESP32 polls this)."""
-    state = DISPLAY_STATE.get(display_id)
-    if not state:
-        state = {"mode": "IDLE", "text": ""}
-    try:
-        DISPLAY_LAST_SEEN[display_id] = int(time.time())
-    except Exception:
-        pass
-    return jsonify(state)
+    """Return current state for a display (ESP32 polls this).
+
+    With ?since=<version> the request is held (up to ?wait=, max 30s) until
+    this display changes after that version; X-State-Version carries the
+    version to pass next time.
+    """
+    if not FLEET.admit(display_id):
+        return jsonify({"error": "unregistered display, rate limited"}), 429, {"Retry-After": "5"}
+    _long_poll("display", display_id)
+    started = time.perf_counter()
+    version, state = STORE.snapshot("display", display_id)
+    if state is None:
+        # unknown ids share one cached IDLE body instead of growing the cache
+        resp = _versioned_json("display", None, 0, lambda: {"mode": "IDLE", "text": ""})
+    else:
+        resp = _versioned_json("display", display_id, version, lambda: state)
+    FLEET.heartbeat(display_id, (time.perf_counter() - started) * 1000)
+    return resp
 @app.post("/api/display/<display_id>/message")
 def api_display_message(display_id):
     """Admin-only: push a one-time custom message to a display."""
@@ -990,16 +4173,102 @@ def api_display_message(display_id):
     msg = (request.form.get("message") or "").strip()
     if not msg:
         return jsonify({"error": "empty message"}), 400
-    DISPLAY_STATE[display_id] = {"mode": "MESSAGE", "text": msg[:64]}
+    set_display(display_id, "MESSAGE", msg[:64])
     return jsonify({"ok": True})
 @app.get("/api/alerts/latest")
 def api_latest_alert():
-    """Return the last alert fired (for Chrome extension / dashboards)."""
-    from flask import make_response
-    resp = make_response(jsonify(LAST_ALERT))
+    """Return the last alert fired (for Chrome extension / dashboards).
+
+    Supports the same ?since=<version>&wait=<secs> long-poll as display text.
+    """
+    _long_poll("alert", None)
+    version, alert = STORE.snapshot("alert")
+    resp = _versioned_json("alert", None, version, lambda: alert)
     # Allow cross-origin access so Chrome extension can fetch this
     resp.headers["Access-Control-Allow-Origin"] = "*"
+    resp.headers["Access-Control-Expose-Headers"] = "ETag, X-State-Version"
     return resp
+# one random id per process so ETags from before a restart never match
+BOOT_ID = uuid.uuid4().hex[:8]
+# (topic, key) -> (version, serialized body)
+_JSON_CACHE = {}
+def _versioned_json(topic: str, key, version: int, build, cache: bool = True) -> Response:
+    """Serve build() as JSON with a strong ETag for this state version.
+
+    The body is serialized once per version (unless cache is False, for
+    variants that would grow the cache without bound); a matching
+    If-None-Match gets a 304 without touching the state or the encoder.
+    """
+    etag = f"{BOOT_ID}-{topic}-{version}"
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache", "X-State-Version": str(STORE.version)}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    cached = _JSON_CACHE.get((topic, key))
+    if cached is None or cached[0] != version:
+        cached = (version, (json.dumps(build(), separators=(",", ":"), sort_keys=True) + "\n").encode("utf-8"))
+        if cache:
+            _JSON_CACHE[(topic, key)] = cached
+    return Response(cached[1], 200, headers, mimetype="application/json")
+def _long_poll(topic: str, key):
+    """Hold the request while ?since= is current, until a change or the wait expires."""
+    since = request.args.get("since", type=int)
+    if since is None:
+        return
+    wait = min(max(request.args.get("wait", 25, type=float), 0), 30)
+    if since > STORE.version:
+        # a version from another worker or before a restart; answer now
+        return
+    STORE.wait_key(topic, key, since, wait)
+@app.get("/api/stream")
+def api_stream():
+    """Server-Sent Events: alert, display and banner changes as they happen.
+
+    ?display=<id> limits display events to one panel. Reconnecting clients
+    resume from Last-Event-ID (or ?since=); otherwise, or if the gap is too
+    old, they get a fresh snapshot first.
+    """
+    display_id = request.args.get("display")
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None:
+        since = request.args.get("since", type=int)
+    def fmt(version, topic, data):
+        return f"id: {version}\nevent: {topic}\ndata: {json.dumps(data)}\n\n"
+    def snapshot():
+        version, alert, displays = STORE.version, STORE.alert, STORE.displays
+        out = [fmt(version, "alert", alert)]
+        ids = [display_id] if display_id else list(displays)
+        for did in ids:
+            out.append(fmt(version, "display", dict(displays.get(did) or IDLE_DISPLAY, id=did)))
+        return version, out
+    def stream(since):
+        events = STORE.events_since(since) if since is not None else None
+        if events is None:
+            since, chunks = snapshot()
+            yield "retry: 3000\n" + "".join(chunks)
+        else:
+            yield "retry: 3000\n\n"
+            for version, topic, key, data in events:
+                if topic != "display" or not display_id or key == display_id:
+                    yield fmt(version, topic, data)
+                since = version
+        while True:
+            if not STORE.wait(since, 15):
+                yield ": keepalive\n\n"
+                continue
+            events = STORE.events_since(since)
+            if events is None:
+                since, chunks = snapshot()
+                yield "".join(chunks)
+                continue
+            for version, topic, key, data in events:
+                if topic != "display" or not display_id or key == display_id:
+                    yield fmt(version, topic, data)
+                since = version
+    return Response(stream(since), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        "Access-Control-Allow-Origin": "*",
+    })
 @app.post("/api/acknowledge")
 def api_acknowledge():
     """Record that a station / client acknowledged the current alert."""
@@ -1008,88 +4277,90 @@ def api_acknowledge():
         data = request.get_json(force=True, silent=True) or {}
     except Exception:
         data = {}
-    station = (data.get("station") or "").strip() or "unknown"
-    mode = LAST_ALERT.get("mode") or "IDLE"
-    action = LAST_ALERT.get("action") or ""
-    alert_ts = LAST_ALERT.get("timestamp") or 0
-    now_ts = int(time.time())
+    station = (data.get("station") or "").strip()[:64] or "unknown"
+    group = (data.get("group") or "").strip()[:64]
+    last_alert = STORE.alert
+    mode = last_alert.get("mode") or "IDLE"
+    alert_ts = last_alert.get("timestamp") or 0
+    out = {"ok": True}
     # Only log if something is actually active
     if mode != "IDLE" and alert_ts:
-        ACK_LOG.append({
-            "station": station,
-            "mode": mode,
-            "action": action,
-            "alert_ts": alert_ts,
-            "ack_ts": now_ts,
-        })
-    resp = make_response(jsonify({"ok": True}))
+        alert_id = last_alert.get("id")
+        row, first = ACKS.ack(alert_id, station, group)
+        out["duplicate"] = not first
+        # repeats change the repeat counters and last_ack_ts in summaries, so they bump the version too
+        STORE.publish_event("acks", {"alert_id": alert_id, "station": station, "group": row["group"],
+                                     "ts": row["last_ack_ts"], "repeat": not first})
+    resp = make_response(jsonify(out))
     resp.headers["Access-Control-Allow-Origin"] = "*"
     return resp
-@app.get("/api/acknowledge/summary")
-def api_ack_summary():
-    """Return acknowledgment summary for the current alert."""
-    from flask import make_response
-    mode = LAST_ALERT.get("mode") or "IDLE"
-    action = LAST_ALERT.get("action") or ""
-    alert_ts = LAST_ALERT.get("timestamp") or 0
-    # Filter ACK_LOG for current alert
-    current = []
-    for row in ACK_LOG:
-        if (
-            row.get("mode") == mode
-            and row.get("action") == action
-            and row.get("alert_ts") == alert_ts
-        ):
-            current.append(row)
-    summary = {
+ACK_PAGE_DEFAULT = 100
+ACK_PAGE_MAX = 500
+def _ack_summary(alert: dict, offset: int = 0, limit: int = None) -> dict:
+    mode = alert.get("mode") or "IDLE"
+    out = {
+        "alert_id": alert.get("id"),
         "mode": mode,
-        "action": action,
-        "alert_ts": alert_ts,
-        "count": len(current),
-        "acks": current,
+        "action": alert.get("action") or "",
+        "alert_ts": alert.get("timestamp") or 0,
     }
-    resp = make_response(jsonify(summary))
+    if mode == "IDLE":
+        out.update({"count": 0, "repeats": 0, "groups": {}})
+        if limit is not None:
+            out.update({"acks": [], "offset": offset, "next_offset": None})
+        return out
+    out.update(ACKS.summary(alert.get("id"), offset, limit))
+    return out
+@app.get("/api/acknowledge/summary")
+def api_ack_summary():
+    """Acknowledgment summary for the current alert.
+
+    Counts and per-group rollup, plus one page of stations in ack order
+    (?offset=, ?limit= up to 500, default 100); ?summary=1 skips the rows.
+    """
+    # the summary depends on both the alert and the ack set; the ack rows are read after their
+    # version, so a race can only cache newer rows under an older version, never the reverse
+    alert_version, last_alert = STORE.snapshot("alert")
+    version = max(alert_version, STORE.snapshot("acks")[0])
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", ACK_PAGE_DEFAULT, type=int), 0), ACK_PAGE_MAX)
+    if request.args.get("summary") in ("1", "true", "yes"):
+        limit = None
+    variant = "summary" if limit is None else f"{offset}-{limit}"
+    resp = _versioned_json(f"acks-{variant}", None, version, lambda: _ack_summary(last_alert, offset, limit),
+                           cache=(offset == 0))
     resp.headers["Access-Control-Allow-Origin"] = "*"
+    resp.headers["Access-Control-Expose-Headers"] = "ETag, X-State-Version"
     return resp
 @app.post("/resolve")
 def resolve_current_alert():
     """Clear the current alert and reset all displays + ACKs."""
     if not require_teacher():
         return redirect(url_for("login"))
-    alert_id = LAST_ALERT.get("id")
+    alert_id = STORE.alert.get("id")
     # Update history row
     try:
         if alert_id:
-            ensure_alerts_table()
+            total_acks = ACKS.count(alert_id)
             conn = db(); c = conn.cursor()
             c.execute(
                 "UPDATE alerts_history SET resolved_at=?, resolved_by=?, total_acks=? WHERE id=?",
-                (int(time.time()), str(session.get("teacher_id") or ""), len(ACK_LOG), alert_id),
+                (int(time.time()), str(session.get("teacher_id") or ""), total_acks, alert_id),
             )
             conn.commit(); conn.close()
     except Exception as e:
         print(f"[alerts_history] resolve update failed: {e}")
     # Reset alert state
-    LAST_ALERT["id"] = None
-    LAST_ALERT["mode"] = "IDLE"
-    LAST_ALERT["action"] = None
-    LAST_ALERT["text"] = ""
-    LAST_ALERT["details"] = ""
-    LAST_ALERT["severity"] = ""
-    LAST_ALERT["timestamp"] = int(time.time())
-    LAST_ALERT["zone"] = "ALL"
+    STORE.set_alert({"timestamp": int(time.time())})
     # Reset displays
-    for display_id in list(DISPLAY_STATE.keys()):
-        DISPLAY_STATE[display_id] = {"mode": "IDLE", "text": ""}
-    # Clear acknowledgements
-    ACK_LOG.clear()
+    STORE.set_displays({display_id: IDLE_DISPLAY for display_id in STORE.displays})
     # Clear web banners if any
     try:
         broadcast_web_banner("", "IDLE")
     except Exception as e:
         print(f"[Resolve] broadcast_web_banner error: {e}")
     try:
-        send_resolution_notice(session.get("teacher_name",""))
+        send_resolution_notice(session.get("teacher_name",""), alert_id)
     except Exception as e:
         print(f"[Resolve] resolution broadcast error: {e}")
     flash("Current alert resolved and system reset to IDLE.", "ok")
@@ -1106,26 +4377,33 @@ def announce():
     send_announcement(msg, session.get("teacher_name", ""))
     flash("Announcement sent", "ok")
     return redirect(url_for("dashboard"))
+@app.get("/api/zones")
+def api_zones():
+    """The compiled zone routing table (each zone's displays, phones, page extensions, ClockWise payloads)."""
+    if not require_teacher():
+        return jsonify({"error": "login required"}), 401
+    return jsonify({name: dict(r._asdict(), clockwise_payloads=dict(r.clockwise_payloads))
+                    for name, r in ZONES.table().items()})
 @app.get("/admin/config")
 def admin_config():
     if not require_teacher():
         return redirect(url_for("login"))
     cw = CFG.get("clockwise", {})
-    zones = CFG.get("zones", {}) or {}
+    zones = _thaw(CFG.get("zones", {}) or {})
     zones_yaml = yaml.safe_dump(zones, sort_keys=False) if zones else ""
     ctx = {
         "branding": {"service_name": _service_name(), "site_name": _brand_site()},
         "clockwise": cw,
         "zones_yaml": zones_yaml,
-        "clockwise_triggers_yaml": yaml.safe_dump(cw.get("triggers", {}), sort_keys=False) if cw.get("triggers") else ""
+        "clockwise_triggers_yaml": yaml.safe_dump(_thaw(cw.get("triggers", {})), sort_keys=False) if cw.get("triggers") else ""
     }
     return render_template("admin_config.html", **ctx)
 @app.post("/admin/config")
 def admin_config_post():
     if not require_teacher():
         return redirect(url_for("login"))
-    global CFG
-    cw = CFG.get("clockwise", {}) or {}
+    data = CFG.to_dict()
+    cw = data.setdefault("clockwise", {})
     cw["enabled"] = True if request.form.get("clockwise_enabled") == "on" else False
     cw["ip"] = (request.form.get("clockwise_ip") or cw.get("ip") or "").strip()
     try:
@@ -1143,62 +4421,216 @@ def admin_config_post():
                 cw["triggers"] = tdata
         except Exception as e:
             print(f"[admin_config] triggers parse failed: {e}")
-    CFG["clockwise"] = cw
     zones_txt = (request.form.get("zones_yaml") or "").strip()
     if zones_txt:
         try:
             zdata = yaml.safe_load(zones_txt)
             if isinstance(zdata, dict):
-                CFG["zones"] = zdata
+                data["zones"] = zdata
         except Exception as e:
             print(f"[admin_config] zones parse failed: {e}")
     try:
-        with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-            yaml.safe_dump(CFG, f, sort_keys=False)
+        CONFIG.save(data)
         flash("Configuration saved.", "ok")
-    except Exception as e:
-        print(f"[admin_config] failed to write config: {e}")
-        flash("Failed to write config file. Check server logs.", "error")
+    except ConfigError as e:
+        print(f"[admin_config] rejected config: {e}")
+        flash(f"Configuration not saved: {e}", "error")
     return redirect(url_for("admin_config"))
+HISTORY_COLUMNS = "id, mode, action, text, details, severity, zone, started_at, resolved_at, resolved_by, total_acks"
+def _parse_day(value: str, end: bool = False):
+    """YYYY-MM-DD (server local time) or a UNIX timestamp -> timestamp; end=True gives the end of that day."""
+    value = (value or "").strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        ts = int(time.mktime(time.strptime(value[:10], "%Y-%m-%d")))
+    except ValueError:
+        return None
+    return ts + 86400 - 1 if end else ts
+def _history_filters(args) -> dict:
+    """Normalized alerts_history filters from query args (mode, action, zone, resolved, from, to)."""
+    resolved = (args.get("resolved") or "").lower()
+    return {
+        "mode": (args.get("mode") or "").upper().strip(),
+        "action": (args.get("action") or "").upper().strip(),
+        "zone": (args.get("zone") or "").upper().strip(),
+        "resolved": resolved if resolved in ("yes", "no") else "",
+        "from": (args.get("from") or "").strip(),
+        "to": (args.get("to") or "").strip(),
+    }
+def _history_where(filters: dict):
+    """WHERE clause + params for _history_filters(); every combination can use an index."""
+    where, params = [], []
+    for col in ("mode", "action", "zone"):
+        if filters.get(col):
+            where.append(f"{col}=?"); params.append(filters[col])
+    if filters.get("resolved") == "yes":
+        where.append("resolved_at IS NOT NULL")
+    elif filters.get("resolved") == "no":
+        where.append("resolved_at IS NULL")
+    start, end = _parse_day(filters.get("from")), _parse_day(filters.get("to"), end=True)
+    if start is not None:
+        where.append("started_at >= ?"); params.append(start)
+    if end is not None:
+        where.append("started_at <= ?"); params.append(end)
+    return where, params
+def _parse_cursor(value: str):
+    """History cursor "<started_at>.<id>" -> (started_at, id), or None."""
+    try:
+        started_at, row_id = (value or "").split(".", 1)
+        return int(started_at), int(row_id)
+    except ValueError:
+        return None
+def fetch_history_page(filters: dict, before=None, limit: int = 100):
+    """One page of alerts_history, newest first, with keyset pagination.
+
+    Rows are ordered by (started_at, id) and the next page starts strictly
+    below the last row of this one, so a page costs an index seek plus
+    `limit` rows however deep it is. Returns (rows, next_cursor or None).
+    """
+    where, params = _history_where(filters)
+    if before:
+        where.append("(started_at, id) < (?, ?)"); params.extend(before)
+    sql = f"SELECT {HISTORY_COLUMNS} FROM alerts_history"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY started_at DESC, id DESC LIMIT ?"
+    params.append(limit + 1)
+    conn = db(); c = conn.cursor()
+    c.execute(sql, params)
+    rows = c.fetchall()
+    conn.close()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1]['started_at']}.{rows[-1]['id']}"
+    return rows, next_cursor
+@app.get("/api/alerts/history")
+def api_alerts_history():
+    """Filtered alert history as JSON: ?mode= &action= &zone= &resolved=yes|no &from= &to= &limit= &before=<cursor>."""
+    if not require_teacher():
+        return jsonify({"error": "login required"}), 401
+    filters = _history_filters(request.args)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    rows, next_cursor = fetch_history_page(filters, _parse_cursor(request.args.get("before")), limit)
+    return jsonify({
+        "alerts": [dict(r) for r in rows],
+        "next": next_cursor,
+        "filters": {k: v for k, v in filters.items() if v},
+    })
 @app.get("/alerts/history")
 def alerts_history():
     if not require_teacher():
         return redirect(url_for("login"))
-    ensure_alerts_table()
-    conn = db(); c = conn.cursor()
-    c.execute("SELECT id, mode, action, text, details, severity, zone, started_at, resolved_at, resolved_by, total_acks FROM alerts_history ORDER BY started_at DESC LIMIT 200")
-    rows = c.fetchall()
-    conn.close()
+    filters = _history_filters(request.args)
+    rows, next_cursor = fetch_history_page(filters, _parse_cursor(request.args.get("before")), 100)
     return render_template(
         "alerts_history.html",
         branding={"service_name": _service_name(), "site_name": _brand_site()},
         alerts=rows,
+        filters=filters,
+        actions=ALERTS,
+        next_cursor=next_cursor,
+        paged=bool(request.args.get("before")),
     )
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_FORMATS = {
+    # format -> (mimetype, file extension)
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "columnar": ("application/x-ndjson", "columnar.ndjson"),
+}
+def _export_rows(filters: dict, fields: list):
+    """Yield lists of row tuples from alerts_history, EXPORT_CHUNK_ROWS at a time, newest first."""
+    where, params = _history_where(filters)
+    sql = f"SELECT {', '.join(fields)} FROM alerts_history"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY started_at DESC, id DESC"
+    conn = db()
+    try:
+        c = conn.cursor()
+        c.execute(sql, params)
+        while True:
+            rows = c.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                break
+            yield [tuple(r) for r in rows]
+    finally:
+        conn.close()
+def _export_csv(chunks, fields):
+    import io, csv
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(fields)
+    for rows in chunks:
+        w.writerows(rows)
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0); buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+def _export_ndjson(chunks, fields):
+    for rows in chunks:
+        yield "".join(json.dumps(dict(zip(fields, r)), separators=(",", ":")) + "\n" for r in rows).encode("utf-8")
+def _export_columnar(chunks, fields):
+    """Column-oriented row groups, one JSON line per chunk after a schema line.
+
+    A stdlib-only stand-in for Parquet: each line holds one array per column,
+    so readers can load or skip whole columns without parsing every row.
+    """
+    types = {"id": "int64", "started_at": "int64", "resolved_at": "int64", "total_acks": "int64"}
+    yield (json.dumps({"schema": [{"name": f, "type": types.get(f, "string")} for f in fields]}) + "\n").encode("utf-8")
+    for rows in chunks:
+        columns = {f: [r[i] for r in rows] for i, f in enumerate(fields)}
+        yield (json.dumps({"rows": len(rows), "columns": columns}, separators=(",", ":")) + "\n").encode("utf-8")
+def _gzip_stream(parts):
+    import zlib
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    for part in parts:
+        data = z.compress(part)
+        if data:
+            yield data
+    yield z.flush()
 @app.get("/alerts/history.csv")
+@app.get("/alerts/history/export")
 def alerts_history_csv():
+    """Stream alerts_history as CSV (default), NDJSON or columnar JSON.
+
+    Takes the same filters as /alerts/history plus ?fields=id,mode,... and
+    ?gzip=1. Rows are read from the cursor in chunks and written out as they
+    arrive, so memory stays flat however large the export is.
+    """
     if not require_teacher():
         return redirect(url_for("login"))
-    ensure_alerts_table()
-    conn = db(); c = conn.cursor()
-    c.execute("SELECT id, mode, action, text, details, severity, zone, started_at, resolved_at, resolved_by, total_acks FROM alerts_history ORDER BY started_at DESC")
-    rows = c.fetchall()
-    conn.close()
-    import io, csv
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["id","mode","action","text","details","severity","zone","started_at","resolved_at","resolved_by","total_acks"])
-    for r in rows:
-        w.writerow([r["id"], r["mode"], r["action"], r["text"], r.get("details"), r.get("severity"), r["zone"], r["started_at"], r["resolved_at"], r["resolved_by"], r["total_acks"]])
-    csv_data = buf.getvalue()
-    return Response(csv_data, mimetype="text/csv", headers={"Content-Disposition": "attachment; filename=alerts_history.csv"})
+    fmt = (request.args.get("format") or "csv").lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    columns = [c.strip() for c in HISTORY_COLUMNS.split(",")]
+    fields = [f.strip() for f in (request.args.get("fields") or "").split(",") if f.strip()] or columns
+    unknown = [f for f in fields if f not in columns]
+    if unknown:
+        return jsonify({"error": f"unknown field(s): {', '.join(unknown)}"}), 400
+    filters = _history_filters(request.args)
+    writer = {"csv": _export_csv, "ndjson": _export_ndjson, "columnar": _export_columnar}[fmt]
+    body = writer(_export_rows(filters, fields), fields)
+    mimetype, ext = EXPORT_FORMATS[fmt]
+    filename = f"alerts_history.{ext}"
+    if request.args.get("gzip") in ("1", "true", "yes"):
+        body = _gzip_stream(body)
+        mimetype, filename = "application/gzip", filename + ".gz"
+    return Response(body, mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename={filename}",
+        "X-Accel-Buffering": "no",
+    })
 @app.get("/admin/drills")
 def admin_drills():
     if not require_teacher():
         return redirect(url_for("login"))
-    ensure_drills_table()
     conn = db(); c = conn.cursor()
     c.execute(
-        "SELECT id, label, mode, action, zone, run_at, enabled, last_run_at, created_by, created_at "
+        "SELECT id, label, mode, action, zone, run_at, enabled, last_run_at, created_by, created_at, recurrence, last_jitter_ms "
         "FROM scheduled_drills ORDER BY run_at DESC"
     )
     rows = c.fetchall()
@@ -1207,12 +4639,12 @@ def admin_drills():
         "drills.html",
         branding={"service_name": _service_name(), "site_name": _brand_site()},
         drills=rows,
+        scheduler=SCHEDULER.stats(),
     )
 @app.post("/admin/drills")
 def admin_drills_post():
     if not require_teacher():
         return redirect(url_for("login"))
-    ensure_drills_table()
     op = (request.form.get("op") or "").lower()
     try:
         import datetime
@@ -1231,9 +4663,17 @@ def admin_drills_post():
                 except Exception as e:
                     print(f"[drills] parse run_at failed: {e}")
             enabled = 1 if request.form.get("enabled") == "on" else 0
+            recurrence = (request.form.get("recurrence") or "").strip().upper() or None
+            if recurrence:
+                try:
+                    parse_rrule(recurrence)
+                except ValueError as e:
+                    conn.close()
+                    flash(f"Invalid repeat rule: {e}", "error")
+                    return redirect(url_for("admin_drills"))
             c.execute(
-                "INSERT INTO scheduled_drills (label, mode, action, zone, run_at, enabled, last_run_at, created_by, created_at) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                "INSERT INTO scheduled_drills (label, mode, action, zone, run_at, enabled, last_run_at, created_by, created_at, recurrence) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                 (
                     label,
                     mode,
@@ -1244,6 +4684,7 @@ def admin_drills_post():
                     None,
                     str(session.get("teacher_id") or ""),
                     int(time.time()),
+                    recurrence,
                 ),
             )
             conn.commit()
@@ -1253,63 +4694,283 @@ def admin_drills_post():
                 c.execute("DELETE FROM scheduled_drills WHERE id=?", (did,))
                 conn.commit()
         conn.close()
+        SCHEDULER.wake()
     except Exception as e:
         print(f"[drills] admin_drills_post error: {e}")
     return redirect(url_for("admin_drills"))
 # Hosted XML for Cisco screens
 @app.get("/xml/<action>")
 def xml_display(action):
+    """Screen a pushed phone fetches; pre-rendered bytes (see CiscoXML), ?k= selects the alert's details."""
     a = (action or "").upper().strip()
     if a not in ALLOWED:
         return "Invalid", 400, {"Content-Type": "text/plain"}
-    _, pretty, directive = default_copy(a)
-    body = (
-        '<?xml version="1.0"?>\n'
-        "<CiscoIPPhoneText>\n"
-        "  <Title>G School Alerts</Title>\n"
-        f"  <Prompt>{a}</Prompt>\n"
-        f"  <Text>{a} - {directive}</Text>\n"
-        "</CiscoIPPhoneText>"
-    )
-    return body, 200, {"Content-Type": "text/xml"}
-if __name__ == "__main__":
-    port = int(os.environ.get("PORT","5000"))
-    app.run(host="0.0.0.0", port=port, debug=True)
-def drill_scheduler_loop():
-    """Background loop to fire scheduled drills."""
-    while True:
-        try:
-            ensure_drills_table()
-            now_ts = int(time.time())
-            conn = db(); c = conn.cursor()
-            c.execute(
-                "SELECT id, label, mode, action, zone, run_at, enabled, last_run_at "
-                "FROM scheduled_drills "
-                "WHERE enabled=1 AND run_at IS NOT NULL AND run_at <= ? "
-                "AND (last_run_at IS NULL OR last_run_at < run_at)",
-                (now_ts,),
-            )
-            rows = c.fetchall()
-            for r in rows:
-                try:
-                    print(f"[scheduler] firing drill id={r['id']} {r['mode']} {r['action']} zone={r['zone']}")
-                    fire_scheduled_alert(r["mode"], r["action"], r["zone"] or "ALL")
-                    c.execute(
-                        "UPDATE scheduled_drills SET last_run_at=? WHERE id=?",
-                        (int(time.time()), r["id"]),
-                    )
-                except Exception as e:
-                    print(f"[scheduler] error firing drill {r['id']}: {e}")
-            conn.commit(); conn.close()
-        except Exception as e:
-            print(f"[scheduler] loop error: {e}")
-        time.sleep(30)
+    body = CISCO_XML.lookup(a, request.args.get("k") or a.lower())
+    if body is None:
+        # unknown / expired details key (e.g. after a restart): the plain directive
+        body = CISCO_XML.screen(a)[1]
+    return Response(body, 200, {"Content-Type": "text/xml", "Cache-Control": "no-store"})
+# ---------------- Drill scheduler ----------------
+import heapq, datetime
+RRULE_FREQS = ("HOURLY", "DAILY", "WEEKLY", "MONTHLY")
+RRULE_DAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+def parse_rrule(text: str) -> dict:
+    """Parse the RRULE subset used for recurring drills; raises ValueError.
+
+    FREQ=HOURLY|DAILY|WEEKLY|MONTHLY, INTERVAL=n, BYDAY=MO,WE (DAILY/WEEKLY)
+    and UNTIL=YYYYMMDD, e.g. "FREQ=WEEKLY;INTERVAL=2;BYDAY=MO".
+    """
+    rule = {"freq": None, "interval": 1, "byday": None, "until": None}
+    for part in (text or "").upper().replace("RRULE:", "").split(";"):
+        if not part.strip():
+            continue
+        key, _, value = part.strip().partition("=")
+        if key == "FREQ" and value in RRULE_FREQS:
+            rule["freq"] = value
+        elif key == "INTERVAL" and value.isdigit() and int(value) > 0:
+            rule["interval"] = int(value)
+        elif key == "BYDAY" and value and all(d in RRULE_DAYS for d in value.split(",")):
+            rule["byday"] = {RRULE_DAYS.index(d) for d in value.split(",")}
+        elif key == "UNTIL" and len(value) >= 8 and value[:8].isdigit():
+            until = datetime.datetime.strptime(value[:8], "%Y%m%d") + datetime.timedelta(days=1)
+            rule["until"] = int(until.timestamp()) - 1
+        else:
+            raise ValueError(f"unsupported RRULE part {part!r}")
+    if not rule["freq"]:
+        raise ValueError("RRULE needs FREQ=HOURLY|DAILY|WEEKLY|MONTHLY")
+    return rule
+def next_occurrence(rule: dict, anchor_ts: int, after_ts: int):
+    """First occurrence of rule strictly after after_ts, keeping anchor_ts's time of day (server local time)."""
+    anchor = datetime.datetime.fromtimestamp(anchor_ts)
+    after = datetime.datetime.fromtimestamp(max(after_ts, anchor_ts - 1))
+    interval, freq = rule["interval"], rule["freq"]
+    found = None
+    if freq == "HOURLY":
+        step = interval * 3600
+        n = (after_ts - anchor_ts) // step + 1 if after_ts >= anchor_ts else 0
+        found = anchor + datetime.timedelta(seconds=n * step)
+    elif freq == "MONTHLY":
+        months = max((after.year - anchor.year) * 12 + after.month - anchor.month, 0)
+        months -= months % interval
+        for _ in range(48):
+            y, m = divmod(anchor.month - 1 + months, 12)
+            try:
+                candidate = anchor.replace(year=anchor.year + y, month=m + 1)
+            except ValueError:
+                candidate = None  # e.g. the 31st in a 30-day month
+            if candidate and candidate > after:
+                found = candidate
+                break
+            months += interval
+    else:
+        # DAILY / WEEKLY: walk days from `after`, checking weekday and interval
+        day = max(after.date(), anchor.date())
+        byday = rule["byday"] if rule["byday"] is not None else ({anchor.weekday()} if freq == "WEEKLY" else None)
+        anchor_week = anchor.date() - datetime.timedelta(days=anchor.weekday())
+        for _ in range(7 * interval * 2 + 7):
+            candidate = datetime.datetime.combine(day, anchor.time())
+            if freq == "DAILY":
+                ok = (day - anchor.date()).days % interval == 0
+            else:
+                ok = ((day - anchor_week).days // 7) % interval == 0
+            if ok and (byday is None or day.weekday() in byday) and candidate > after:
+                found = candidate
+                break
+            day += datetime.timedelta(days=1)
+    if found is None:
+        return None
+    ts = int(found.timestamp())
+    if rule["until"] is not None and ts > rule["until"]:
+        return None
+    return ts
+class DrillScheduler:
+    """Fires scheduled_drills from an in-memory min-heap of (run_at, id).
+
+    The thread sleeps exactly until the earliest run_at; wake() (called after
+    admin edits) makes it reload the heap at once. At startup, drills that
+    came due while the server was down fire if they are no older than
+    drills.catch_up_secs (default 15 min) and are skipped otherwise.
+    Recurring drills (recurrence = RRULE subset, see parse_rrule) move run_at
+    to their next occurrence after each run. How late each drill actually
+    fired is kept in last_jitter_ms.
+    """
+    JITTER_WARN_MS = 1000
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._dirty = True
+        self._thread = None
+        self._started_at = None
+        self.jitter_ms = deque(maxlen=100)
+    def start(self):
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._started_at = time.time()
+            self._thread = threading.Thread(target=self._run, name="drill-scheduler", daemon=True)
+            self._thread.start()
+        print("[scheduler] background drill scheduler started")
+    def wake(self):
+        """Reload drills from the DB now (after a create / delete / edit)."""
+        with self._cond:
+            self._dirty = True
+            self._cond.notify_all()
+    def _reload(self):
+        conn = db(); c = conn.cursor()
+        c.execute(
+            "SELECT id, run_at FROM scheduled_drills "
+            "WHERE enabled=1 AND run_at IS NOT NULL AND (last_run_at IS NULL OR last_run_at < run_at)"
+        )
+        self._heap = [(r["run_at"], r["id"]) for r in c.fetchall()]
+        conn.close()
+        heapq.heapify(self._heap)
+    def _run(self):
+        while True:
+            try:
+                with self._cond:
+                    if self._dirty:
+                        self._dirty = False
+                        self._reload()
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    run_at, drill_id = self._heap[0]
+                    delay = run_at - time.time()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                    if not BACKEND.is_leader():
+                        # another worker fires it; check again in case leadership moves here
+                        self._cond.wait(1)
+                        continue
+                    heapq.heappop(self._heap)
+                self._fire(drill_id, run_at)
+            except Exception as e:
+                print(f"[scheduler] loop error: {e}")
+                time.sleep(1)
+                self.wake()
+    def _fire(self, drill_id: int, run_at: int):
+        now = time.time()
+        conn = db(); c = conn.cursor()
+        # claim this run first so no other scheduler (e.g. an old leader) fires it too
+        c.execute(
+            "UPDATE scheduled_drills SET last_run_at=? "
+            "WHERE id=? AND enabled=1 AND run_at=? AND (last_run_at IS NULL OR last_run_at < run_at)",
+            (max(int(now), run_at), drill_id, run_at),
+        )
+        conn.commit()
+        if c.rowcount != 1:
+            conn.close()
+            return
+        c.execute(
+            "SELECT id, label, mode, action, zone, run_at, enabled, last_run_at, recurrence, created_at "
+            "FROM scheduled_drills WHERE id=?",
+            (drill_id,),
+        )
+        r = c.fetchone()
+        late = now - run_at
+        catch_up = int((CFG.get("drills", {}) or {}).get("catch_up_secs", 900))
+        if run_at < (self._started_at or now) and late > catch_up:
+            print(f"[scheduler] skipping drill id={drill_id}: missed by {int(late)} s while down (catch_up_secs={catch_up})")
+            jitter_ms = None
+        else:
+            jitter_ms = round(late * 1000, 1)
+            print(f"[scheduler] firing drill id={r['id']} {r['mode']} {r['action']} zone={r['zone']} (jitter {jitter_ms} ms)")
+            # catch-up runs are late by design; only count drills that came due while running
+            if run_at >= (self._started_at or now):
+                self.jitter_ms.append(jitter_ms)
+                if jitter_ms > self.JITTER_WARN_MS:
+                    print(f"[scheduler] drill id={drill_id} fired {jitter_ms} ms late")
+            try:
+                fire_scheduled_alert(r["mode"], r["action"], r["zone"] or "ALL")
+            except Exception as e:
+                print(f"[scheduler] error firing drill {drill_id}: {e}")
+        next_run = None
+        if r["recurrence"]:
+            try:
+                next_run = next_occurrence(parse_rrule(r["recurrence"]), run_at, int(now))
+            except ValueError as e:
+                print(f"[scheduler] drill id={drill_id} has a bad recurrence: {e}")
+        c.execute(
+            "UPDATE scheduled_drills SET last_jitter_ms=?, run_at=COALESCE(?, run_at) WHERE id=?",
+            (jitter_ms, next_run, drill_id),
+        )
+        conn.commit(); conn.close()
+        if next_run:
+            with self._cond:
+                heapq.heappush(self._heap, (next_run, drill_id))
+    def stats(self) -> dict:
+        samples = sorted(self.jitter_ms)
+        return {
+            "pending": len(self._heap),
+            "next_run_at": self._heap[0][0] if self._heap else None,
+            "fired": len(samples),
+            "jitter_ms_max": samples[-1] if samples else None,
+            "jitter_ms_p50": samples[len(samples) // 2] if samples else None,
+        }
+SCHEDULER = DrillScheduler()
 def start_background_threads():
+    # restore the active alert / panels before anything else can change them
     try:
-        t = threading.Thread(target=drill_scheduler_loop, daemon=True)
-        t.start()
-        print("[scheduler] background drill scheduler started")
+        JOURNAL.start(STORE)
+    except Exception as e:
+        print(f"[journal] failed to start: {e}")
+    try:
+        BACKEND.on_command("dispatch", _forwarded_dispatch)
+        BACKEND.ensure_started(STORE)
+    except Exception as e:
+        print(f"[state] {BACKEND.name} backend failed to start: {e}")
+    try:
+        AMI.start()
+    except Exception as e:
+        print(f"[PBX] failed to start AMI keepalive: {e}")
+    try:
+        EMAIL_TEMPLATES.rebuild()
+    except Exception as e:
+        print(f"[Email] template pre-render failed: {e}")
+    try:
+        ZONES.rebuild()
+    except Exception as e:
+        print(f"[zones] routing table build failed: {e}")
+    try:
+        CISCO_XML.warm()
+    except Exception as e:
+        print(f"[Cisco] XML pre-render failed: {e}")
+    try:
+        CONFIG.start()
+    except Exception as e:
+        print(f"[config] failed to start file watcher: {e}")
+    try:
+        SMTP_POOL.start()
+    except Exception as e:
+        print(f"[Email] failed to start SMTP keepalive: {e}")
+    try:
+        ACKS.start()
+    except Exception as e:
+        print(f"[acks] failed to start writer: {e}")
+    try:
+        FLEET.start()
+    except Exception as e:
+        print(f"[fleet] failed to start: {e}")
+    try:
+        SCHEDULER.start()
     except Exception as e:
         print(f"[scheduler] failed to start: {e}")
-# start scheduler on import
-start_background_threads()
\ No newline at end of file
+def create_app():
+    """WSGI factory for production servers, e.g.
+
+        gunicorn -w 4 -b 0.0.0.0:8000 'app:create_app()'
+
+    Starts this worker's background threads (safe to call again, including
+    after a fork) and returns the Flask app. For more than one worker set
+    state.backend to sqlite (same host) or redis; see README.md.
+    """
+    start_background_threads()
+    return app
+# start scheduler on import; under the debug reloader only the serving child runs them.
+# EMS_NO_BACKGROUND=1 imports the module without them (scripts such as bench/).
+if os.environ.get("EMS_NO_BACKGROUND") != "1" and (__name__ != "__main__" or os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+    start_background_threads()
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT","5000"))
+    app.run(host="0.0.0.0", port=port, debug=True)
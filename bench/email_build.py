@@ -0,0 +1,67 @@
+"""Time building one alert email: the pre-rendered EmailTemplateCache against
+the MIMEMultipart builder it replaced (kept here as the reference).
+
+    python bench/email_build.py [iterations]
+
+Run from the repo root with config.yaml in place. The app module is
+imported with EMS_NO_BACKGROUND=1, so no background threads start (no AMI /
+SMTP keepalives, outbound loop or drill scheduler) and nothing is sent;
+the import still applies any pending schema migrations to gschool_ems.db.
+"""
+import os, sys, time
+from email import message_from_string
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.image import MIMEImage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["EMS_NO_BACKGROUND"] = "1"
+import app  # noqa: E402
+
+ACTION, MODE = "LOCKDOWN", "DRILL"
+
+def old_build(action, mode, details_text, subject, recipients) -> str:
+    # send_email before EmailTemplateCache: render, build the MIME tree, read the icon, per message
+    _, _, directive = app.default_copy(action)
+    html = app.catapult_style_email_html(action, mode, details_text, directive)
+    msg = MIMEMultipart("related")
+    msg["From"] = app.CFG.sender
+    msg["To"] = ", ".join(recipients)
+    msg["Subject"] = subject
+    alt = MIMEMultipart("alternative")
+    alt.attach(MIMEText(html, "html"))
+    msg.attach(alt)
+    icon = app._icon_bytes(action)
+    if icon:
+        part = MIMEImage(icon); part.add_header("Content-ID", "<action_icon>")
+        part.add_header("Content-Disposition", "inline", filename="icon.png")
+        msg.attach(part)
+    return msg.as_string()
+
+def new_build(action, mode, details_text, subject, recipients) -> str:
+    return app.EMAIL_TEMPLATES.build(action, mode, details_text, subject, app.CFG.sender, recipients)
+
+def parts(text):
+    msg = message_from_string(text)
+    return [(p.get_content_type(), p.get_payload(decode=True)) for p in msg.walk()], msg["Subject"]
+
+def timed(build, n, *args) -> float:
+    build(*args)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        build(*args)
+    return (time.perf_counter() - t0) / n * 1e6
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    app.EMAIL_TEMPLATES.rebuild()
+    args = (ACTION, MODE, "THIS IS A DRILL!\n\nNorth wing", f"{app._service_name()} – Action Alert! (DRILL)",
+            list(app.CFG.recipients))
+    same = parts(old_build(*args)) == parts(new_build(*args))
+    print(f"{n} builds of a {MODE} {ACTION} message")
+    print(f"  before: {timed(old_build, n, *args):7.0f} us/message")
+    print(f"  after:  {timed(new_build, n, *args):7.0f} us/message")
+    print(f"  same parts and subject: {same}")
+
+if __name__ == "__main__":
+    main()
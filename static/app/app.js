@@ -71,10 +71,31 @@ function formatTime(ts) {
   return d.toLocaleString();
 }
 
+function renderAlert(data) {
+  const ackBtn = $("ackBtn");
+  const mode = (data.mode || "IDLE").toUpperCase();
+  const text = data.text || "";
+  const action = data.action || "";
+  const ts = data.timestamp || 0;
+
+  setBadge(mode);
+  if (mode === "IDLE") {
+    $("alertAction").textContent = "No Active Alert";
+    $("alertText").textContent = "—";
+    $("alertTime").textContent = "—";
+    ackBtn.disabled = true;
+  } else {
+    $("alertAction").textContent = action || text || "ALERT";
+    $("alertText").textContent = text || (mode + " " + action);
+    $("alertTime").textContent = formatTime(ts);
+    ackBtn.disabled = false;
+  }
+
+  lastTs = ts;
+}
+
 async function loadAlert() {
   const statusEl = $("status");
-  const card = $("alertCard");
-  const ackBtn = $("ackBtn");
   statusEl.textContent = "Updating…";
 
   try {
@@ -83,32 +104,29 @@ async function loadAlert() {
       statusEl.textContent = "Error " + res.status;
       return;
     }
-    const data = await res.json();
-    const mode = (data.mode || "IDLE").toUpperCase();
-    const text = data.text || "";
-    const action = data.action || "";
-    const ts = data.timestamp || 0;
-
-    setBadge(mode);
-    if (mode === "IDLE") {
-      $("alertAction").textContent = "No Active Alert";
-      $("alertText").textContent = "—";
-      $("alertTime").textContent = "—";
-      ackBtn.disabled = true;
-    } else {
-      $("alertAction").textContent = action || text || "ALERT";
-      $("alertText").textContent = text || (mode + " " + action);
-      $("alertTime").textContent = formatTime(ts);
-      ackBtn.disabled = false;
-    }
-
-    lastTs = ts;
+    renderAlert(await res.json());
     statusEl.textContent = "Connected";
   } catch (e) {
     statusEl.textContent = "Offline";
   }
 }
 
+// Live updates over Server-Sent Events; falls back to polling if unsupported.
+function startStream() {
+  if (!window.EventSource) {
+    loadAlert();
+    setInterval(loadAlert, 5000);
+    return;
+  }
+  const statusEl = $("status");
+  const es = new EventSource("/api/stream");
+  es.addEventListener("alert", (ev) => {
+    renderAlert(JSON.parse(ev.data));
+    statusEl.textContent = "Connected";
+  });
+  es.onerror = () => { statusEl.textContent = "Reconnecting…"; };
+}
+
 async function sendAck() {
   const ackBtn = $("ackBtn");
   const ackStatus = $("ackStatus");
@@ -172,8 +190,7 @@ function setup() {
     });
   });
 
-  loadAlert();
-  setInterval(loadAlert, 5000);
+  startStream();
 
   if ("serviceWorker" in navigator) {
     navigator.serviceWorker.register("sw.js").catch(() => {});
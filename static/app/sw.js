@@ -11,6 +11,8 @@ self.addEventListener("install", (event) => {
 });
 
 self.addEventListener("fetch", (event) => {
+  // live API traffic (including the /api/stream event stream) bypasses the cache
+  if (new URL(event.request.url).pathname.startsWith("/api/")) return;
   event.respondWith(
     caches.match(event.request).then((res) => res || fetch(event.request))
   );
@@ -50,6 +50,22 @@
     });
   }
 
+  const cisco = document.getElementById('ciscoProgress');
+  if(cisco && Number(cisco.dataset.pending) > 0){
+    const timer = setInterval(async ()=>{
+      try{
+        const r = await fetch('/api/cisco/progress', {cache:'no-cache'});
+        if(!r.ok) return;
+        const p = await r.json();
+        ['pushed','failed','pending'].forEach(k=>{
+          const el = cisco.querySelector(`[data-field="${k}"]`);
+          if(el) el.textContent = p[k];
+        });
+        if(!p.pending) clearInterval(timer);
+      }catch(e){ console.error(e); }
+    }, 1000);
+  }
+
   if(window.io){
     const s = io();
     s.on('hello', ()=>{});
@@ -57,5 +73,13 @@
       showBanner(`${data.mode || 'LIVE'} ${data.action}`);
       try{ new Audio('/static/notify.mp3').play(); }catch(e){}
     });
+  } else if(window.EventSource && banner){
+    const es = new EventSource('/api/stream');
+    es.addEventListener('banner', (ev)=>{
+      const data = JSON.parse(ev.data);
+      if(!data.action) return;
+      showBanner(`${data.mode || 'LIVE'} ${data.action}`);
+      try{ new Audio('/static/notify.mp3').play(); }catch(e){}
+    });
   }
 })();